@@ -0,0 +1,157 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import heapq
+import math
+from typing import List, Optional
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request is rejected by the admission controller."""
+
+    def __init__(self, detail: str, retry_after: float) -> None:
+        super().__init__(detail)
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    """Returned as result of a request whose deadline passed before it reached the pipeline."""
+
+
+class AdmissionController:
+    """
+    Bounded admission layer in front of the DiffusionService queue.
+
+    A request is rejected early, instead of waiting until its client times out, when the queue
+    is full or when its estimated completion time is past its deadline. The completion time is
+    estimated from the queue depth and the measured batch latency: each of the `parallelism`
+    pipeline replicas is free once its running batch is done, and the batches ahead of the request
+    (its own included) each take the next free replica for one batch latency. The wait window is
+    added when the batch of the request won't be full.
+
+    Until a first batch has been measured, only the queue bound applies.
+    """
+
+    def __init__(
+        self,
+        max_queue_size: int,
+        default_deadline: Optional[float] = None,
+        alpha: float = 0.2,
+        parallelism: int = 1,
+    ) -> None:
+        """
+        Initialize the admission controller.
+
+        Args:
+            max_queue_size (int): The maximum number of pending requests.
+            default_deadline (Optional[float]): The deadline, in seconds, of requests which don't set one.
+                None means no deadline.
+            alpha (float): The weight of the newest batch in the batch latency moving average.
+            parallelism (int): The number of batches running at once, i.e. the number of pipeline replicas.
+        """
+        self.max_queue_size = max_queue_size
+        self.default_deadline = default_deadline
+        self.alpha = alpha
+        self.parallelism = parallelism
+
+        self.batch_time: Optional[float] = None
+        # The estimated end of each running batch, in loop time
+        self.busy_until: List[float] = []
+        self.rejected = 0
+        self.shed = 0
+
+    def batch_started(self, now: float) -> None:
+        """Record the start of a batch."""
+        self.busy_until.append(now + (self.batch_time or 0.0))
+
+    def batch_finished(self, duration: Optional[float] = None) -> None:
+        """Record the end of a batch, and its latency. A failed batch has no latency, it only frees its replica."""
+        if duration is not None:
+            if self.batch_time is None:
+                self.batch_time = duration
+            else:
+                self.batch_time += self.alpha * (duration - self.batch_time)
+        # The batches end in about the order they started, the one expected first is done.
+        if self.busy_until:
+            self.busy_until.remove(min(self.busy_until))
+
+    def estimate(self, depth: int, max_batch_size: int, max_wait: float, now: float) -> Optional[float]:
+        """
+        Estimate the completion time, in seconds from now, of a request joining the queue.
+
+        Args:
+            depth (int): The number of requests already pending.
+            max_batch_size (int): The current maximum batch size.
+            max_wait (float): The current maximum wait before a batch is processed.
+            now (float): The current loop time.
+
+        Returns:
+            Optional[float]: The estimated completion time, or None while no batch has been measured.
+        """
+        if self.batch_time is None:
+            return None
+
+        # The time each replica is free, from now: the replicas without a running batch are free right away.
+        running = sorted(max(0.0, busy_until - now) for busy_until in self.busy_until)[: self.parallelism]
+        free = [0.0] * (self.parallelism - len(running)) + running
+        heapq.heapify(free)
+
+        end = 0.0
+        for _ in range(math.ceil((depth + 1) / max_batch_size)):
+            end = heapq.heappop(free) + self.batch_time
+            heapq.heappush(free, end)
+        fill_wait = max_wait if (depth + 1) % max_batch_size else 0.0
+
+        return end + fill_wait
+
+    def admit(
+        self,
+        depth: int,
+        max_batch_size: int,
+        max_wait: float,
+        now: float,
+        deadline: Optional[float] = None,
+    ) -> Optional[float]:
+        """
+        Decide whether a new request can join the queue.
+
+        Args:
+            depth (int): The number of requests already pending.
+            max_batch_size (int): The current maximum batch size.
+            max_wait (float): The current maximum wait before a batch is processed.
+            now (float): The current loop time.
+            deadline (Optional[float]): The deadline of the request, in seconds from now.
+
+        Returns:
+            Optional[float]: The absolute loop time deadline of the request, or None if it has none.
+
+        Raises:
+            AdmissionRejected: If the queue is full or the request can't meet its deadline.
+        """
+        deadline = deadline if deadline is not None else self.default_deadline
+        estimate = self.estimate(depth, max_batch_size, max_wait, now)
+
+        if depth >= self.max_queue_size:
+            self.rejected += 1
+            overflow = depth - self.max_queue_size + 1
+            retry_after = math.ceil(overflow / (max_batch_size * self.parallelism)) * (self.batch_time or max_wait)
+            raise AdmissionRejected(f"The queue is full ({depth} pending requests).", retry_after)
+
+        if deadline is not None and estimate is not None and estimate > deadline:
+            self.rejected += 1
+            raise AdmissionRejected(
+                f"The request can't be completed within its deadline ({estimate:.1f}s estimated, {deadline:.1f}s"
+                " requested).",
+                estimate - deadline,
+            )
+
+        return now + deadline if deadline is not None else None
+
+    def stats(self) -> dict:
+        """Export the admission statistics."""
+        return {
+            "max_queue_size": self.max_queue_size,
+            "batch_time": self.batch_time,
+            "rejected": self.rejected,
+            "shed": self.shed,
+        }
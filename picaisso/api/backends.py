@@ -0,0 +1,331 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import inspect
+import time
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+import tomesd
+import torch
+from diffusers.pipelines import DiffusionPipeline
+from loguru import logger
+from PIL import Image
+from tasks import SHARED_COMPONENT_TASKS, TASK_DEFAULT_MODEL, TASK_MAPPING
+
+
+# Tiny Stable Diffusion pipeline with random weights, from the diffusers test fixtures
+TINY_MODEL = "hf-internal-testing/tiny-stable-diffusion-pipe"
+TINY_BACKEND_TASKS = ("image_to_image", "text_to_image")
+# The components a pipeline runs without, when the model ships none
+OPTIONAL_COMPONENTS = ("safety_checker", "feature_extractor")
+
+
+def from_pretrained(pipeline_class: type, model: str, dtype: torch.dtype) -> DiffusionPipeline:
+    """
+    Load the weights of a pipeline, preferring the safetensors files.
+
+    Safetensors files are memory-mapped instead of unpickled, and `low_cpu_mem_usage` skips the random
+    initialization of the modules, so the weights are read once, straight into their final tensors.
+    Models without safetensors files fall back to their pickled weights.
+
+    Args:
+        pipeline_class (type): The diffusers pipeline class.
+        model (str): The model name to use.
+        dtype (torch.dtype): The torch dtype to use.
+
+    Returns:
+        DiffusionPipeline: The loaded pipeline.
+    """
+    try:
+        return pipeline_class.from_pretrained(model, torch_dtype=dtype, use_safetensors=True, low_cpu_mem_usage=True)
+    except EnvironmentError as e:
+        logger.warning(f"No safetensors weights for the model {model}, loading the pickled ones: {e}")
+
+    return pipeline_class.from_pretrained(model, torch_dtype=dtype, low_cpu_mem_usage=True)
+
+
+def import_pipeline(task: str, model: str, dtype: torch.dtype) -> DiffusionPipeline:
+    """Import the pipeline from the task.
+
+    The task is used to determine the pipeline name,
+    e.g. task = "text_to_image" -> pipeline_name = "StableDiffusionPipeline"
+
+    Args:
+        task (str): The task to perform. Must be one of the keys of TASK_MAPPING.
+        model (str): The model name to use.
+        dtype (torch.dtype): The torch dtype to use.
+
+    Returns:
+        DiffusionPipeline: The pipeline to use from the diffusers library.
+
+    Raises:
+        ValueError: If the task is not supported.
+    """
+    diffusers_module = __import__("diffusers")
+
+    try:
+        pipeline = from_pretrained(getattr(diffusers_module, TASK_MAPPING[task]), model, dtype)
+
+    except ValueError as e:
+        if "Pipeline" in str(e):
+            logger.warning(
+                f"The model {model} is not compatible with the task {task}. "
+                f"Using the default model {TASK_DEFAULT_MODEL[task]} instead."
+            )
+            pipeline = from_pretrained(getattr(diffusers_module, TASK_MAPPING[task]), TASK_DEFAULT_MODEL[task], dtype)
+
+    return pipeline
+
+
+def pipeline_components(task: str) -> Dict[str, bool]:
+    """Return the components expected by the pipeline of a task, and whether each one is required."""
+    pipeline_class = getattr(__import__("diffusers"), TASK_MAPPING[task])
+    parameters = inspect.signature(pipeline_class.__init__).parameters
+
+    return {
+        name: parameter.default is inspect.Parameter.empty
+        for name, parameter in parameters.items()
+        if name not in ("self", "args", "kwargs")
+    }
+
+
+def shares_components(task: str, other_task: str) -> bool:
+    """
+    Whether the pipeline of `other_task` can be built from the components of the pipeline of `task`.
+
+    Matching component names aren't enough, e.g. the upscaler has a UNet and a VAE like the text to image
+    pipeline, but not the same weights. Only the tasks of a group of SHARED_COMPONENT_TASKS share.
+    """
+    if not any(task in group and other_task in group for group in SHARED_COMPONENT_TASKS):
+        return False
+
+    components = pipeline_components(task)
+    required = [name for name, is_required in pipeline_components(other_task).items() if is_required]
+
+    return all(name in components for name in required)
+
+
+def derive_pipeline(pipeline: DiffusionPipeline, task: str) -> DiffusionPipeline:
+    """
+    Build the pipeline of a task from the components of a loaded pipeline, without copying any weights.
+
+    Args:
+        pipeline (DiffusionPipeline): The loaded pipeline.
+        task (str): The task of the new pipeline. Must share its components with the loaded pipeline.
+
+    Returns:
+        DiffusionPipeline: The new pipeline, using the very same modules as the loaded one.
+
+    Raises:
+        ValueError: If the loaded pipeline lacks a component required by the new one.
+    """
+    expected = pipeline_components(task)
+    components = {name: component for name, component in pipeline.components.items() if name in expected}
+
+    missing = [
+        name
+        for name, required in expected.items()
+        if required and components.get(name) is None and name not in OPTIONAL_COMPONENTS
+    ]
+    if missing:
+        raise ValueError(f"The {type(pipeline).__name__} can't serve the task {task}, it has no {missing}.")
+
+    return getattr(__import__("diffusers"), TASK_MAPPING[task])(**components)
+
+
+class InferenceBackend:
+    """
+    Interface of the inference backends, which build the pipelines of the replicas.
+
+    A pipeline is called with the batched inputs and the parameters of its task, and returns an object
+    with the generated `images`, like a diffusers pipeline.
+    """
+
+    # Whether the pipelines run on their device, so a CUDA device requires CUDA to be available.
+    uses_device = True
+
+    def load_pipeline(self, task: str, model: str, dtype: torch.dtype, device: str) -> DiffusionPipeline:
+        """
+        Load the pipeline of a task on a device.
+
+        Args:
+            task (str): The task to perform. Must be one of the keys of TASK_MAPPING.
+            model (str): The model name to use.
+            dtype (torch.dtype): The torch dtype to use.
+            device (str): The device to load the pipeline on.
+
+        Returns:
+            DiffusionPipeline: The loaded pipeline.
+        """
+        raise NotImplementedError
+
+    def derive_pipeline(self, pipeline: DiffusionPipeline, task: str) -> DiffusionPipeline:
+        """Build the pipeline of another task from a loaded pipeline, sharing its weights."""
+        raise NotImplementedError
+
+
+class DiffusersBackend(InferenceBackend):
+    """The pretrained diffusers pipelines, patched with token merging."""
+
+    def load_pipeline(self, task: str, model: str, dtype: torch.dtype, device: str) -> DiffusionPipeline:
+        pipeline = import_pipeline(task, model, dtype)
+        pipeline.to(device)
+        tomesd.apply_patch(pipeline, ratio=0.5)
+
+        return pipeline
+
+    def derive_pipeline(self, pipeline: DiffusionPipeline, task: str) -> DiffusionPipeline:
+        return derive_pipeline(pipeline, task)
+
+
+class TinyBackend(DiffusersBackend):
+    """
+    A tiny diffusers pipeline with random weights, whatever the model name.
+
+    It runs the real diffusers code path, schedulers and callbacks included, in a fraction of a second
+    per batch on CPU, so the serving code can be exercised without a GPU or the real weights.
+    """
+
+    def load_pipeline(self, task: str, model: str, dtype: torch.dtype, device: str) -> DiffusionPipeline:
+        if task not in TINY_BACKEND_TASKS:
+            raise ValueError(f"The tiny backend only supports the tasks {list(TINY_BACKEND_TASKS)}.")
+
+        logger.warning(f"The tiny backend serves {TINY_MODEL} with random weights instead of {model}")
+        pipeline = getattr(__import__("diffusers"), TASK_MAPPING[task]).from_pretrained(
+            TINY_MODEL, torch_dtype=torch.float32
+        )
+
+        return pipeline.to(device)
+
+
+class LatencyModelPipeline:
+    """
+    Stand-in for a diffusers pipeline, which sleeps instead of denoising.
+
+    Each denoising step of a batch of n images takes `step_time + image_step_time * n` seconds, the
+    linear latency model of a GPU. The step callbacks are called like in a diffusers pipeline, so the
+    progress reports and the cancellation of running requests behave the same. Each image is filled
+    with a color drawn from its generator, so the outputs still depend on the seeds only.
+    """
+
+    def __init__(self, task: str, step_time: float = 0.01, image_step_time: float = 0.005) -> None:
+        """
+        Initialize the pipeline.
+
+        Args:
+            task (str): The task of the pipeline.
+            step_time (float): The fixed time of a denoising step, in seconds.
+            image_step_time (float): The additional time of a denoising step per image of the batch, in seconds.
+        """
+        self.task = task
+        self.step_time = step_time
+        self.image_step_time = image_step_time
+        self.components = {}
+        self._interrupt = False
+
+    def to(self, device: str) -> "LatencyModelPipeline":
+        return self
+
+    def output_size(self, image: Optional[List[Image.Image]], height: Optional[int], width: Optional[int]) -> tuple:
+        """Return the (width, height) of the generated images."""
+        if image:
+            scale = 4 if self.task == "super_resolution" else 1
+            return image[0].size[0] * scale, image[0].size[1] * scale
+
+        return width or 512, height or 512
+
+    def __call__(
+        self,
+        prompt: Optional[List[str]] = None,
+        image: Optional[List[Image.Image]] = None,
+        num_inference_steps: int = 50,
+        height: Optional[int] = None,
+        width: Optional[int] = None,
+        generator: Optional[List[torch.Generator]] = None,
+        callback_on_step_end=None,
+        callback_on_step_end_tensor_inputs: Optional[List[str]] = None,
+        output_type: str = "pil",
+        **kwargs,
+    ) -> SimpleNamespace:
+        size = len(prompt) if prompt is not None else len(image)
+        output_width, output_height = self.output_size(image, height, width)
+        generators = generator if isinstance(generator, list) else [generator] * size
+
+        # The color of each image travels with its latents, so it survives the requests dropped from the batch.
+        latents = torch.zeros(size, 4, max(1, output_height // 8), max(1, output_width // 8))
+        for index, gen in enumerate(generators):
+            latents[index, :3] = torch.randint(0, 256, (3,), generator=gen).float()[:, None, None] / 255
+        prompt_embeds = torch.zeros(2 * size, 1, 1)
+
+        self._interrupt = False
+        for step in range(num_inference_steps):
+            if self._interrupt:
+                break
+            time.sleep(self.step_time + self.image_step_time * latents.shape[0])
+
+            if callback_on_step_end is not None:
+                callback_kwargs = {"latents": latents, "prompt_embeds": prompt_embeds}
+                inputs = callback_on_step_end_tensor_inputs or ["latents"]
+                outputs = callback_on_step_end(self, step, step, {name: callback_kwargs[name] for name in inputs})
+                latents = outputs.get("latents", latents)
+                prompt_embeds = outputs.get("prompt_embeds", prompt_embeds)
+
+        if output_type == "pt":
+            # A (B, 3, H, W) batch in [0, 1], like the diffusers pipelines
+            images = latents[:, :3, :1, :1].expand(-1, -1, output_height, output_width).contiguous()
+            return SimpleNamespace(images=images)
+
+        colors = (latents[:, :3, 0, 0] * 255).round().to(torch.uint8).tolist()
+        images = [Image.new("RGB", (output_width, output_height), tuple(color)) for color in colors]
+
+        return SimpleNamespace(images=images)
+
+
+class StubBackend(InferenceBackend):
+    """Latency model stand-ins for the pipelines, to measure the serving code alone, without any model."""
+
+    uses_device = False
+
+    def __init__(self, step_time: float = 0.01, image_step_time: float = 0.005) -> None:
+        """
+        Initialize the backend.
+
+        Args:
+            step_time (float): The fixed time of a denoising step, in seconds.
+            image_step_time (float): The additional time of a denoising step per image of the batch, in seconds.
+        """
+        self.step_time = step_time
+        self.image_step_time = image_step_time
+
+    def load_pipeline(self, task: str, model: str, dtype: torch.dtype, device: str) -> LatencyModelPipeline:
+        return LatencyModelPipeline(task, step_time=self.step_time, image_step_time=self.image_step_time)
+
+    def derive_pipeline(self, pipeline: LatencyModelPipeline, task: str) -> LatencyModelPipeline:
+        return LatencyModelPipeline(task, step_time=self.step_time, image_step_time=self.image_step_time)
+
+
+BACKEND_MAPPING = {
+    "diffusers": DiffusersBackend,
+    "tiny": TinyBackend,
+    "stub": StubBackend,
+}
+
+
+def get_backend(name: str, **kwargs) -> InferenceBackend:
+    """
+    Build an inference backend from its name.
+
+    Args:
+        name (str): The backend name. Must be one of the keys of BACKEND_MAPPING.
+        **kwargs: The options of the backend, e.g. the latency model of the stub backend.
+
+    Returns:
+        InferenceBackend: The backend instance.
+
+    Raises:
+        ValueError: If the backend is not supported.
+    """
+    if name not in BACKEND_MAPPING:
+        raise ValueError(f"Backend {name} is not supported. Must be one of {list(BACKEND_MAPPING.keys())}.")
+
+    return BACKEND_MAPPING[name](**kwargs)
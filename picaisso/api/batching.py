@@ -0,0 +1,118 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import time
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+from scheduler import BaseScheduler, FifoScheduler
+
+
+class BucketBatcher(BaseScheduler):
+    """
+    Parameter-aware batcher keeping one scheduler per batch shape.
+
+    Requests can only share a denoising call if they agree on the parameters used by the
+    whole batch (number of steps, resolution, guidance scale, strength, ...). Each task
+    carries a hashable `bucket` key built from those parameters, and the batcher keeps one
+    scheduler per key. A new request is never blocked by an incompatible one ahead of it,
+    it simply waits in its own bucket.
+
+    The bucket to flush is the one with the best score, where the score adds the fill level
+    of the bucket (0 to 1) to the wait of its oldest task relative to `max_wait`. A full
+    bucket or a bucket whose oldest task waited for `max_wait` always wins against a bucket
+    which is neither.
+    """
+
+    def __init__(
+        self,
+        scheduler_factory: Callable[[], BaseScheduler] = FifoScheduler,
+        max_wait: float = 0.5,
+        stats_window: int = 1000,
+    ) -> None:
+        """
+        Initialize the batcher.
+
+        Args:
+            scheduler_factory (Callable[[], BaseScheduler]): Builds the scheduler of a new bucket.
+            max_wait (float): The maximum time a task should wait before its bucket is flushed.
+            stats_window (int): The number of most recent waits kept per tenant for the statistics.
+        """
+        super().__init__(stats_window=stats_window)
+        self.scheduler_factory = scheduler_factory
+        self.max_wait = max_wait
+        self.buckets: Dict[Hashable, BaseScheduler] = {}
+        self.scheduler_name = type(scheduler_factory()).__name__
+
+    def __len__(self) -> int:
+        return sum(len(bucket) for bucket in self.buckets.values())
+
+    def push(self, task: dict) -> None:
+        key = task.get("bucket")
+        if key not in self.buckets:
+            bucket = self.scheduler_factory()
+            # All the buckets share the tenant statistics of the batcher.
+            bucket.stats_window = self.stats_window
+            bucket.tenant_stats = self.tenant_stats
+            self.buckets[key] = bucket
+
+        self.buckets[key].push(task)
+
+    def has_full_batch(self, max_size: int) -> bool:
+        return any(len(bucket) >= max_size for bucket in self.buckets.values())
+
+    def score(self, bucket: BaseScheduler, max_size: int, now: float) -> Tuple[bool, float]:
+        """Return the flush score of a bucket, the higher the better."""
+        fill = min(1.0, len(bucket) / max_size)
+        wait = (now - bucket.oldest_time()) / self.max_wait if self.max_wait > 0 else 1.0
+        ready = fill >= 1.0 or wait >= 1.0
+
+        return ready, fill + wait
+
+    def select_bucket(self, max_size: int, now: float) -> Optional[Hashable]:
+        """Return the key of the bucket to flush next, or None if every bucket is empty."""
+        candidates = [(self.score(bucket, max_size, now), key) for key, bucket in self.buckets.items() if len(bucket)]
+        if not candidates:
+            return None
+
+        return max(candidates, key=lambda candidate: candidate[0])[1]
+
+    def pop_batch(self, max_size: int, now: Optional[float] = None) -> List[dict]:
+        now = time.monotonic() if now is None else now
+        key = self.select_bucket(max_size, now)
+        if key is None:
+            return []
+
+        batch = self.buckets[key].pop_batch(max_size, now=now)
+        if not len(self.buckets[key]):
+            del self.buckets[key]
+
+        return batch
+
+    def remove(self, task: dict) -> bool:
+        key = task.get("bucket")
+        if key not in self.buckets or not self.buckets[key].remove(task):
+            return False
+
+        if not len(self.buckets[key]):
+            del self.buckets[key]
+
+        return True
+
+    def oldest_time(self) -> Optional[float]:
+        heads = [bucket.oldest_time() for bucket in self.buckets.values() if len(bucket)]
+
+        return min(heads) if heads else None
+
+    def pending_by_tenant(self) -> Dict[str, int]:
+        pending: Dict[str, int] = {}
+        for bucket in self.buckets.values():
+            for tenant, count in bucket.pending_by_tenant().items():
+                pending[tenant] = pending.get(tenant, 0) + count
+
+        return pending
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats["scheduler"] = self.scheduler_name
+        stats["buckets"] = len(self.buckets)
+
+        return stats
@@ -0,0 +1,234 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import asyncio
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from loguru import logger
+
+
+def make_cache_key(**fields) -> str:
+    """
+    Build a stable cache key from the given fields.
+
+    Args:
+        **fields: JSON-serializable values identifying a generation.
+
+    Returns:
+        str: The hexadecimal sha256 of the fields.
+    """
+    payload = json.dumps(fields, sort_keys=True, default=str)
+
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def normalize_prompt(prompt: Optional[str]) -> Optional[str]:
+    """
+    Normalize a prompt for the cache keys, so the prompts giving the same image share a key.
+
+    The CLIP tokenizer of the pipelines lowercases the prompts and collapses their whitespaces,
+    so the case and the spacing of a prompt don't change the image.
+    """
+    return " ".join(prompt.lower().split()) if prompt is not None else None
+
+
+class MemoryCache:
+    """LRU cache of encoded results, bounded by the total size of its values."""
+
+    def __init__(self, max_bytes: int, sizeof: Callable[[Any], int] = len) -> None:
+        """
+        Initialize the cache.
+
+        Args:
+            max_bytes (int): The maximum total size of the cached values.
+            sizeof (Callable[[Any], int]): Returns the size of a value. Defaults to `len`, for bytes.
+        """
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.entries: "OrderedDict[str, Any]" = OrderedDict()
+        self.bytes = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return the cached value of a key and mark it as recently used, or None."""
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+
+        return value
+
+    def put(self, key: str, value: Any) -> None:
+        """Cache a value, evicting the least recently used ones if needed."""
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+
+        if key in self.entries:
+            self.bytes -= self.sizeof(self.entries.pop(key))
+
+        self.entries[key] = value
+        self.bytes += size
+
+        while self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= self.sizeof(evicted)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        """Drop every cached value."""
+        self.entries.clear()
+        self.bytes = 0
+
+
+class DiskCache:
+    """
+    Size-capped on-disk cache of encoded results, one file per key.
+
+    The index of the cached files is rebuilt from the directory at startup, ordered by
+    modification time, so the cache survives restarts. When the files take more than
+    `max_bytes`, the least recently used ones are deleted.
+    """
+
+    def __init__(self, path: str, max_bytes: int) -> None:
+        """
+        Initialize the cache.
+
+        Args:
+            path (str): The directory of the cached files. Created if needed.
+            max_bytes (int): The maximum total size of the cached files.
+        """
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.evictions = 0
+
+        self.entries: "OrderedDict[str, int]" = OrderedDict()
+        for file in sorted(self.path.glob("*.bin"), key=lambda file: file.stat().st_mtime):
+            self.entries[file.stem] = file.stat().st_size
+        self.bytes = sum(self.entries.values())
+        self.evict()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def file(self, key: str) -> Path:
+        return self.path / f"{key}.bin"
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Return the cached value of a key and mark it as recently used, or None."""
+        if key not in self.entries:
+            return None
+
+        try:
+            value = self.file(key).read_bytes()
+        except OSError:
+            self.bytes -= self.entries.pop(key)
+            return None
+
+        self.entries.move_to_end(key)
+        os.utime(self.file(key))
+
+        return value
+
+    def put(self, key: str, value: bytes) -> None:
+        """Cache a value, evicting the least recently used ones if needed."""
+        if len(value) > self.max_bytes:
+            return
+
+        # Write then rename, so a crash never leaves a truncated file behind.
+        tmp = self.path / f"{key}.tmp"
+        tmp.write_bytes(value)
+        tmp.replace(self.file(key))
+
+        if key in self.entries:
+            self.bytes -= self.entries.pop(key)
+        self.entries[key] = len(value)
+        self.bytes += len(value)
+        self.evict()
+
+    def evict(self) -> None:
+        """Delete the least recently used files until the cache is within its size cap."""
+        while self.bytes > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+            try:
+                self.file(key).unlink()
+            except OSError as e:
+                logger.warning(f"Could not delete the cached result {key}: {e}")
+
+
+class ResultCache:
+    """
+    Two-tier cache of generated images: an LRU in memory in front of an optional on-disk store.
+
+    Values found on disk are promoted to the memory tier. Only deterministic generations,
+    i.e. the ones with an explicit seed, should be cached. The disk tier is read and written on
+    its own thread, so a slow disk never stalls the event loop.
+    """
+
+    def __init__(self, memory_bytes: int, disk_path: Optional[str] = None, disk_bytes: int = 0) -> None:
+        """
+        Initialize the cache.
+
+        Args:
+            memory_bytes (int): The maximum total size of the memory tier.
+            disk_path (Optional[str]): The directory of the disk tier. None disables the disk tier.
+            disk_bytes (int): The maximum total size of the disk tier.
+        """
+        self.memory = MemoryCache(memory_bytes)
+        self.disk = DiskCache(disk_path, disk_bytes) if disk_path else None
+        # A single thread, so the index of the disk tier is never updated concurrently
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="result-cache")
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    async def get(self, key: str) -> Optional[bytes]:
+        """Return the cached result of a key, or None."""
+        value = self.memory.get(key)
+        if value is not None:
+            self.memory_hits += 1
+            return value
+
+        if self.disk is not None:
+            value = await asyncio.get_event_loop().run_in_executor(self.executor, self.disk.get, key)
+            if value is not None:
+                self.disk_hits += 1
+                self.memory.put(key, value)
+                return value
+
+        self.misses += 1
+
+        return None
+
+    async def put(self, key: str, value: bytes) -> None:
+        """Cache a result in both tiers."""
+        self.memory.put(key, value)
+        if self.disk is not None:
+            await asyncio.get_event_loop().run_in_executor(self.executor, self.disk.put, key, value)
+
+    def stats(self) -> dict:
+        """Export the cache statistics."""
+        lookups = self.memory_hits + self.disk_hits + self.misses
+
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "memory_entries": len(self.memory),
+            "memory_bytes": self.memory.bytes,
+            "memory_evictions": self.memory.evictions,
+            "disk_entries": len(self.disk) if self.disk is not None else 0,
+            "disk_bytes": self.disk.bytes if self.disk is not None else 0,
+            "disk_evictions": self.disk.evictions if self.disk is not None else 0,
+        }
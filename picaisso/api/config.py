@@ -1,13 +1,22 @@
 # Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
 
+import re
 from os import getenv
-from typing import Optional, Union
+from typing import List, Optional, Union
 
-from diffusion_service import TASK_MAPPING
 from dotenv import load_dotenv
+from encoding import IMAGE_FORMATS
 from loguru import logger
 from pydantic import Field, validator
 from pydantic.dataclasses import dataclass
+from scheduler import SCHEDULER_MAPPING
+from tasks import (
+    BACKENDS,
+    BATCHING_MODES,
+    CONTINUOUS_BATCHING_TASKS,
+    OFFLOAD_POLICIES,
+    TASK_MAPPING,
+)
 
 
 @dataclass
@@ -30,11 +39,59 @@ class Settings:
     model_name: str
     model_precision: str
     n_steps: int
+    devices: List[str]
+    workers: bool
+    multi_task: bool
+    models: List[str]
+    model_memory_bytes: int
+    model_offload: str
+    backend: str
+    stub_step_time: float
+    stub_image_step_time: float
+    # Scheduling Configuration
+    scheduler: str
+    scheduler_aging: float
+    batching_mode: str
+    adaptive_batching: bool
+    latency_target: float
+    pipelining: bool
+    # Admission Configuration
+    max_queue_size: int
+    default_deadline: Optional[float]
+    # Progress Configuration
+    preview_every: int
+    # Cache Configuration
+    cache_memory_bytes: int
+    cache_disk_path: Optional[str]
+    cache_disk_bytes: int
+    prompt_cache_bytes: int
+    latent_cache_bytes: int
+    # Jobs Configuration
+    job_ttl: float
+    job_store_max_bytes: int
+    job_store_max_jobs: int
+    # Encoding Configuration
+    output_format: str
+    image_quality: int
+    encode_workers: int
+    # Fetcher Configuration
+    fetch_max_connections: int
+    fetch_max_connections_per_host: int
+    fetch_max_bytes: int
+    fetch_timeout: float
+    fetch_cache_bytes: int
+    # Tracing Configuration
+    trace_sample_rate: float
+    trace_export_path: Optional[str]
     # S3 Configuration
     bucket_name: Optional[str] = None
     region_name: Optional[str] = None
     access_key_id: Optional[str] = None
     secret_access_key: Optional[str] = None
+    endpoint_url: Optional[str] = None
+    upload_spool_path: str = "uploads"
+    upload_concurrency: int = 4
+    upload_max_retries: int = 5
     using_s3: bool = Field(init=False)
 
     @validator("username", "password", "openssl_key", "algorithm")
@@ -44,13 +101,51 @@ class Settings:
             raise ValueError(f"{field.name} must not be None, please verify the `config/api/.env` file.")
         return value
 
-    @validator("max_batch_size", "max_wait", "n_steps")
+    @validator(
+        "max_batch_size",
+        "max_wait",
+        "n_steps",
+        "latency_target",
+        "max_queue_size",
+        "job_ttl",
+        "job_store_max_bytes",
+        "job_store_max_jobs",
+        "cache_memory_bytes",
+        "cache_disk_bytes",
+        "encode_workers",
+        "fetch_max_connections",
+        "fetch_max_connections_per_host",
+        "fetch_max_bytes",
+        "fetch_timeout",
+        "upload_concurrency",
+    )
     def model_parameters_must_be_positive(cls, value: Union[int, float], field: str):
         """Check that the model parameters are positive."""
         if value <= 0:
             raise ValueError(f"{field.name} must be positive.")
         return value
 
+    @validator(
+        "preview_every",
+        "prompt_cache_bytes",
+        "latent_cache_bytes",
+        "model_memory_bytes",
+        "fetch_cache_bytes",
+        "upload_max_retries",
+    )
+    def must_not_be_negative(cls, value: int, field: str):
+        """Check that the preview interval, cache sizes, model memory budget and retries are not negative."""
+        if value < 0:
+            raise ValueError(f"{field.name} must not be negative.")
+        return value
+
+    @validator("default_deadline")
+    def default_deadline_must_be_positive(cls, value: Optional[float]):
+        """Check that the default deadline is positive when set."""
+        if value is not None and value <= 0:
+            raise ValueError("default_deadline must be positive.")
+        return value
+
     @validator("username", "password")
     def authentication_parameters_must_not_be_default(cls, value: str, field: str):
         """Check that the authentication parameters are not the default ones."""
@@ -65,6 +160,27 @@ class Settings:
             raise ValueError(f"openssl_key must not be the default one, please verify the `config/api/.env` file.")
         return value
 
+    @validator("output_format")
+    def output_format_must_be_valid(cls, value: str):
+        """Check that the default output format is supported."""
+        if value not in IMAGE_FORMATS.keys():
+            raise ValueError(f"output_format must be one of {list(IMAGE_FORMATS.keys())}.")
+        return value
+
+    @validator("image_quality")
+    def image_quality_must_be_between_1_and_100(cls, value: int):
+        """Check that the quality of the lossy formats is between 1 and 100."""
+        if not 1 <= value <= 100:
+            raise ValueError("image_quality must be between 1 and 100.")
+        return value
+
+    @validator("trace_sample_rate")
+    def trace_sample_rate_must_be_a_fraction(cls, value: float):
+        """Check that the trace sample rate is between 0 and 1."""
+        if not 0 <= value <= 1:
+            raise ValueError("trace_sample_rate must be between 0 and 1.")
+        return value
+
     @validator("model_precision")
     def model_precision_must_be_valid(cls, value: str):
         """Check that the model precision is valid."""
@@ -72,6 +188,59 @@ class Settings:
             raise ValueError("model_precision must be either `fp16`, `fp32` or `bf16`.")
         return value
 
+    @validator("devices")
+    def devices_must_be_valid(cls, value: List[str]):
+        """Check that the devices are valid torch devices."""
+        if not value:
+            raise ValueError("devices must not be empty.")
+        for device in value:
+            if not re.fullmatch(r"cpu|mps|cuda(:\d+)?", device):
+                raise ValueError(f"device {device} must be `cpu`, `mps` or `cuda:<index>`.")
+        return value
+
+    @validator("models")
+    def models_must_include_the_default_model(cls, value: List[str], values: dict):
+        """Check that several models are only served with threads, and put the default model first."""
+        models = [values.get("model_name")] + [model for model in value if model != values.get("model_name")]
+        if len(models) > 1 and values.get("workers"):
+            raise ValueError("serving several models is not supported by the inference workers.")
+        return models
+
+    @validator("backend")
+    def backend_must_be_valid(cls, value: str):
+        """Check that the inference backend is valid."""
+        if value not in BACKENDS:
+            raise ValueError(f"backend must be one of {list(BACKENDS)}.")
+        return value
+
+    @validator("stub_step_time", "stub_image_step_time")
+    def stub_latency_must_not_be_negative(cls, value: float, field: str):
+        """Check that the latency model of the stub backend is not negative."""
+        if value < 0:
+            raise ValueError(f"{field.name} must not be negative.")
+        return value
+
+    @validator("model_offload")
+    def model_offload_must_be_valid(cls, value: str):
+        """Check that the model offload policy is valid."""
+        if value not in OFFLOAD_POLICIES:
+            raise ValueError(f"model_offload must be one of {list(OFFLOAD_POLICIES)}.")
+        return value
+
+    @validator("scheduler")
+    def scheduler_must_be_valid(cls, value: str):
+        """Check that the scheduler is valid."""
+        if value not in SCHEDULER_MAPPING.keys():
+            raise ValueError(f"scheduler must be one of {list(SCHEDULER_MAPPING.keys())}.")
+        return value
+
+    @validator("scheduler_aging")
+    def scheduler_aging_must_not_be_negative(cls, value: float):
+        """Check that the scheduler aging interval is not negative."""
+        if value < 0:
+            raise ValueError("scheduler_aging must not be negative.")
+        return value
+
     @validator("task")
     def task_must_be_valid(cls, value: str):
         """Check that the task is valid."""
@@ -79,6 +248,34 @@ class Settings:
             raise ValueError(f"task must be one of {list(TASK_MAPPING.keys())}.")
         return value
 
+    @validator("batching_mode")
+    def batching_mode_must_be_valid(cls, value: str, values: dict):
+        """Check that the batching mode is valid and supported by the task."""
+        if value not in BATCHING_MODES:
+            raise ValueError(f"batching_mode must be one of {list(BATCHING_MODES)}.")
+        if value == "continuous" and values.get("task") not in CONTINUOUS_BATCHING_TASKS:
+            raise ValueError(f"continuous batching is only supported for {list(CONTINUOUS_BATCHING_TASKS)}.")
+        if value == "continuous" and len(values.get("devices") or []) > 1:
+            raise ValueError("continuous batching only supports a single device.")
+        if value == "continuous" and values.get("workers"):
+            raise ValueError("continuous batching is not supported by the inference workers.")
+        if value == "continuous" and values.get("multi_task"):
+            raise ValueError("continuous batching only supports a single task.")
+        if value == "continuous" and len(values.get("models") or []) > 1:
+            raise ValueError("continuous batching only supports a single model.")
+        if value == "continuous" and values.get("backend") == "stub":
+            raise ValueError("continuous batching is not supported by the stub backend.")
+        return value
+
+    @validator("pipelining")
+    def pipelining_must_be_supported(cls, value: bool, values: dict):
+        """Check that the pipelined stages are supported by the batching mode and the replicas."""
+        if value and values.get("batching_mode") == "continuous":
+            raise ValueError("pipelining is not supported by continuous batching.")
+        if value and values.get("workers"):
+            raise ValueError("pipelining is not supported by the inference workers.")
+        return value
+
     def __post_init__(self):
         """Post init hook."""
         self.using_s3 = all(
@@ -120,9 +317,57 @@ settings = Settings(
     model_name=getenv("MODEL_NAME", "prompthero/openjourney"),
     model_precision=getenv("MODEL_PRECISION", "fp16"),
     n_steps=getenv("N_STEPS", 50),
+    devices=[device.strip() for device in getenv("DEVICES", "cuda:0").split(",") if device.strip()],
+    workers=getenv("WORKERS", False),
+    multi_task=getenv("MULTI_TASK", False),
+    models=[model.strip() for model in getenv("MODELS", "").split(",") if model.strip()],
+    model_memory_bytes=getenv("MODEL_MEMORY_BYTES", 0),
+    model_offload=getenv("MODEL_OFFLOAD", "cpu"),
+    backend=getenv("BACKEND", "diffusers"),
+    stub_step_time=getenv("STUB_STEP_TIME", 0.01),
+    stub_image_step_time=getenv("STUB_IMAGE_STEP_TIME", 0.005),
+    # Scheduling Configuration
+    scheduler=getenv("SCHEDULER", "fair"),
+    scheduler_aging=getenv("SCHEDULER_AGING", 120.0),
+    batching_mode=getenv("BATCHING_MODE", "static"),
+    adaptive_batching=getenv("ADAPTIVE_BATCHING", False),
+    latency_target=getenv("LATENCY_TARGET", 30.0),
+    pipelining=getenv("PIPELINING", False),
+    # Admission Configuration
+    max_queue_size=getenv("MAX_QUEUE_SIZE", 64),
+    default_deadline=getenv("DEFAULT_DEADLINE", None) or None,
+    # Progress Configuration
+    preview_every=getenv("PREVIEW_EVERY", 5),
+    # Cache Configuration
+    cache_memory_bytes=getenv("CACHE_MEMORY_BYTES", 256 * 1024 * 1024),
+    cache_disk_path=getenv("CACHE_DISK_PATH", None) or None,
+    cache_disk_bytes=getenv("CACHE_DISK_BYTES", 2 * 1024 * 1024 * 1024),
+    prompt_cache_bytes=getenv("PROMPT_CACHE_BYTES", 64 * 1024 * 1024),
+    latent_cache_bytes=getenv("LATENT_CACHE_BYTES", 64 * 1024 * 1024),
+    # Jobs Configuration
+    job_ttl=getenv("JOB_TTL", 3600),
+    job_store_max_bytes=getenv("JOB_STORE_MAX_BYTES", 512 * 1024 * 1024),
+    job_store_max_jobs=getenv("JOB_STORE_MAX_JOBS", 1000),
+    # Encoding Configuration
+    output_format=getenv("OUTPUT_FORMAT", "png"),
+    image_quality=getenv("IMAGE_QUALITY", 90),
+    encode_workers=getenv("ENCODE_WORKERS", 4),
+    # Fetcher Configuration
+    fetch_max_connections=getenv("FETCH_MAX_CONNECTIONS", 100),
+    fetch_max_connections_per_host=getenv("FETCH_MAX_CONNECTIONS_PER_HOST", 8),
+    fetch_max_bytes=getenv("FETCH_MAX_BYTES", 20 * 1024 * 1024),
+    fetch_timeout=getenv("FETCH_TIMEOUT", 10.0),
+    fetch_cache_bytes=getenv("FETCH_CACHE_BYTES", 64 * 1024 * 1024),
+    # Tracing Configuration
+    trace_sample_rate=getenv("TRACE_SAMPLE_RATE", 1.0),
+    trace_export_path=getenv("TRACE_EXPORT_PATH", None) or None,
     # S3 Configuration
     bucket_name=getenv("BUCKET_NAME", None),
     region_name=getenv("REGION_NAME", None),
     access_key_id=getenv("ACCESS_KEY_ID", None),
     secret_access_key=getenv("SECRET_ACCESS_KEY", None),
+    endpoint_url=getenv("ENDPOINT_URL", None) or None,
+    upload_spool_path=getenv("UPLOAD_SPOOL_PATH", "uploads"),
+    upload_concurrency=getenv("UPLOAD_CONCURRENCY", 4),
+    upload_max_retries=getenv("UPLOAD_MAX_RETRIES", 5),
 )
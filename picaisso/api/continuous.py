@@ -0,0 +1,241 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+from diffusers.pipelines import DiffusionPipeline
+from postprocessing import to_pixels
+
+
+class RunningRequest:
+    """State of a request inside the running latent batch."""
+
+    def __init__(
+        self,
+        task: dict,
+        latents: torch.Tensor,
+        cond_embeds: torch.Tensor,
+        uncond_embeds: torch.Tensor,
+        scheduler,
+        guidance_scale: float,
+    ) -> None:
+        self.task = task
+        self.latents = latents
+        self.cond_embeds = cond_embeds
+        self.uncond_embeds = uncond_embeds
+        self.scheduler = scheduler
+        self.timesteps = scheduler.timesteps
+        self.guidance_scale = guidance_scale
+        self.step_index = 0
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return tuple(self.latents.shape)
+
+    @property
+    def finished(self) -> bool:
+        return self.step_index >= len(self.timesteps)
+
+
+class ContinuousBatchingEngine:
+    """
+    Iteration-level batching engine built around the diffusers UNet denoising loop.
+
+    Instead of running a fixed batch for the whole pipeline call, the engine keeps a running
+    latent batch and advances it one denoising step at a time. New requests join the running
+    batch at step boundaries, and each request leaves it as soon as its own timesteps are
+    exhausted to be decoded by the VAE, independently of the others. Every request owns its
+    noise scheduler, so requests with different step counts or guidance scales can share the
+    same UNet call. Requests with different latent shapes (resolutions) run in separate UNet
+    calls during the same iteration.
+
+    The engine only relies on the pipeline components (unet, vae, scheduler and the prompt
+    encoder) and on the given device, so it runs as well on a tiny random-weights CPU UNet
+    as on a full StableDiffusionPipeline on a GPU. The safety checker is not applied.
+    """
+
+    def __init__(
+        self,
+        unet: torch.nn.Module,
+        vae: torch.nn.Module,
+        scheduler,
+        encode_prompt: Callable[[List[str]], Tuple[torch.Tensor, torch.Tensor]],
+        device: str = "cuda:0",
+        default_guidance_scale: float = 7.5,
+    ) -> None:
+        """
+        Initialize the engine.
+
+        Args:
+            unet (torch.nn.Module): The conditional UNet predicting the noise.
+            vae (torch.nn.Module): The VAE used to decode the final latents.
+            scheduler: The noise scheduler, used as a template for the per-request schedulers.
+            encode_prompt (Callable[[List[str]], Tuple[torch.Tensor, torch.Tensor]]): Encodes a list of prompts
+                into their conditional and unconditional embeddings.
+            device (str): The device to run on.
+            default_guidance_scale (float): The guidance scale used when a request doesn't set one.
+        """
+        self.unet = unet
+        self.vae = vae
+        self.scheduler = scheduler
+        self.encode_prompt = encode_prompt
+        self.device = device
+        self.default_guidance_scale = default_guidance_scale
+
+        self.vae_scale_factor = 2 ** (len(vae.config.block_out_channels) - 1)
+        self.running: List[RunningRequest] = []
+        self.step_time = 0.0
+        # Optional ProgressReporter called for every request after each of its steps
+        self.progress = None
+
+    @classmethod
+    def from_pipeline(
+        cls,
+        pipeline: DiffusionPipeline,
+        device: str = "cuda:0",
+        encode_prompt: Optional[Callable[[List[str]], Tuple[torch.Tensor, torch.Tensor]]] = None,
+    ) -> "ContinuousBatchingEngine":
+        """
+        Build the engine from a loaded StableDiffusionPipeline.
+
+        Args:
+            pipeline (DiffusionPipeline): The text to image pipeline to take the components from.
+            device (str): The device the pipeline lives on.
+            encode_prompt (Optional[Callable[[List[str]], Tuple[torch.Tensor, torch.Tensor]]]): Replaces the
+                prompt encoder of the pipeline, e.g. with a PromptEmbeddingCache. Defaults to None.
+
+        Returns:
+            ContinuousBatchingEngine: The engine sharing the components of the pipeline.
+        """
+
+        def encode_pipeline_prompt(prompts: List[str]) -> Tuple[torch.Tensor, torch.Tensor]:
+            if hasattr(pipeline, "encode_prompt"):
+                cond, uncond = pipeline.encode_prompt(prompts, device, 1, True)
+            else:
+                uncond, cond = pipeline._encode_prompt(prompts, device, 1, True).chunk(2)
+
+            return cond, uncond
+
+        return cls(
+            pipeline.unet, pipeline.vae, pipeline.scheduler, encode_prompt or encode_pipeline_prompt, device=device
+        )
+
+    def __len__(self) -> int:
+        return len(self.running)
+
+    def new_scheduler(self, num_inference_steps: int):
+        """Build a fresh noise scheduler for a single request."""
+        scheduler = self.scheduler.__class__.from_config(self.scheduler.config)
+        scheduler.set_timesteps(num_inference_steps, device=self.device)
+
+        return scheduler
+
+    def add(self, tasks: List[dict]) -> None:
+        """
+        Make the given tasks join the running batch at the next step boundary.
+
+        Args:
+            tasks (List[dict]): The tasks to add. Each one must have a `prompt` and its `parameters`.
+        """
+        if not tasks:
+            return
+
+        cond, uncond = self.encode_prompt([task["prompt"] for task in tasks])
+        default_size = self.unet.config.sample_size * self.vae_scale_factor
+
+        for index, task in enumerate(tasks):
+            parameters = task["parameters"]
+            scheduler = self.new_scheduler(parameters["num_inference_steps"])
+            height = parameters.get("height", default_size)
+            width = parameters.get("width", default_size)
+
+            shape = (1, self.unet.config.in_channels, height // self.vae_scale_factor, width // self.vae_scale_factor)
+            latents = torch.randn(shape, generator=task.get("generator"), dtype=torch.float32)
+            latents = latents.to(self.device, cond.dtype) * scheduler.init_noise_sigma
+
+            self.running.append(
+                RunningRequest(
+                    task,
+                    latents,
+                    cond[index : index + 1],
+                    uncond[index : index + 1],
+                    scheduler,
+                    parameters.get("guidance_scale", self.default_guidance_scale),
+                )
+            )
+
+    def remove(self, task: dict) -> bool:
+        """Drop a task from the running batch. Returns True if it was running."""
+        for request in self.running:
+            if request.task is task:
+                self.running.remove(request)
+                return True
+
+        return False
+
+    def denoise(self, group: List[RunningRequest]) -> None:
+        """Run one denoising step for a group of requests sharing the same latent shape."""
+        latent_inputs, timesteps, embeds = [], [], []
+        for request in group:
+            t = request.timesteps[request.step_index]
+            latent_input = request.scheduler.scale_model_input(request.latents, t)
+            # Classifier-free guidance: unconditional and conditional passes side by side.
+            latent_inputs.extend([latent_input, latent_input])
+            timesteps.extend([t, t])
+            embeds.extend([request.uncond_embeds, request.cond_embeds])
+
+        noise_pred = self.unet(
+            torch.cat(latent_inputs),
+            torch.stack([torch.as_tensor(t, device=self.device) for t in timesteps]),
+            encoder_hidden_states=torch.cat(embeds),
+        ).sample
+
+        for index, request in enumerate(group):
+            noise_uncond, noise_cond = noise_pred[2 * index : 2 * index + 1], noise_pred[2 * index + 1 : 2 * index + 2]
+            guided = noise_uncond + request.guidance_scale * (noise_cond - noise_uncond)
+            t = request.timesteps[request.step_index]
+            request.latents = request.scheduler.step(guided, t, request.latents).prev_sample
+            if self.progress is not None:
+                self.progress.report(request.task, request.step_index, len(request.timesteps), request.latents)
+            request.step_index += 1
+
+    def decode(self, latents: torch.Tensor) -> np.ndarray:
+        """Decode a batch of latents into (B, H, W, 3) uint8 pixels."""
+        images = self.vae.decode(latents / self.vae.config.scaling_factor).sample
+
+        return to_pixels(images, signed=True)
+
+    @torch.inference_mode()
+    def iterate(self, new_tasks: Optional[List[dict]] = None) -> List[Tuple[dict, np.ndarray]]:
+        """
+        Admit the new tasks, run one denoising step on the running batch and decode the finished requests.
+
+        Args:
+            new_tasks (Optional[List[dict]]): The tasks joining the running batch at this step boundary.
+
+        Returns:
+            List[Tuple[dict, np.ndarray]]: The finished tasks with the (H, W, 3) uint8 pixels of their image.
+        """
+        self.add(new_tasks or [])
+
+        groups: Dict[Tuple[int, ...], List[RunningRequest]] = {}
+        for request in self.running:
+            groups.setdefault(request.shape, []).append(request)
+
+        start = time.perf_counter()
+        for group in groups.values():
+            self.denoise(group)
+        self.step_time = time.perf_counter() - start
+
+        finished = [request for request in self.running if request.finished]
+        self.running = [request for request in self.running if not request.finished]
+
+        results = []
+        for shape in {request.shape for request in finished}:
+            same_shape = [request for request in finished if request.shape == shape]
+            images = self.decode(torch.cat([request.latents for request in same_shape]))
+            results.extend((request.task, image) for request, image in zip(same_shape, images))
+
+        return results
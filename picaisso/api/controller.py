@@ -0,0 +1,218 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import math
+from typing import Dict, Optional, Tuple
+
+
+# z-score of the 95th percentile of a normal distribution
+Z_P95 = 1.645
+
+
+class LatencyEstimate:
+    """Exponentially weighted mean and variance of the inference time of one batch size."""
+
+    def __init__(self, alpha: float = 0.2) -> None:
+        """
+        Initialize the estimate.
+
+        Args:
+            alpha (float): The weight of the newest observation.
+        """
+        self.alpha = alpha
+        self.count = 0
+        self.mean = 0.0
+        self.variance = 0.0
+
+    def update(self, value: float) -> None:
+        """Add a new observation."""
+        self.count += 1
+        if self.count == 1:
+            self.mean = value
+            return
+
+        delta = value - self.mean
+        self.mean += self.alpha * delta
+        self.variance = (1 - self.alpha) * (self.variance + self.alpha * delta * delta)
+
+    @property
+    def p95(self) -> float:
+        return self.mean + Z_P95 * math.sqrt(self.variance)
+
+
+class AdaptiveBatchController:
+    """
+    SLO-driven controller choosing the effective max_batch_size and max_wait.
+
+    The controller learns online how long a batch takes for each batch size, and how fast
+    requests arrive. A request waits at most `max_wait` for its batch to fill, then for the
+    whole batch to run, so its p95 latency is estimated as `wait(b) + p95_time(b)`, where
+    `wait(b)` is the time needed for `b - 1` more requests to arrive (capped by the configured
+    max_wait). Among the batch sizes meeting the latency target, the one with the best
+    throughput `filled(b) / time(b)` is chosen, where `filled(b)` is the number of requests
+    expected to arrive within the wait window. On quiet nights batches can't fill, so the
+    controller falls back to small batches with no wait, and on busy evenings batches fill
+    quickly and it grows them up to `max_batch_size`.
+
+    Batch sizes never observed are estimated from a linear fit `time(b) = a + c * b` of the
+    observed ones. With a single observed size, half of the time is assumed to be a fixed cost.
+    """
+
+    def __init__(
+        self,
+        max_batch_size: int,
+        max_wait: float,
+        latency_target: float,
+        alpha: float = 0.2,
+    ) -> None:
+        """
+        Initialize the controller.
+
+        Args:
+            max_batch_size (int): The largest batch size the controller can choose.
+            max_wait (float): The longest wait window the controller can choose.
+            latency_target (float): The p95 latency target, in seconds.
+            alpha (float): The weight of the newest observation in the moving averages.
+        """
+        self.max_batch_size_cap = max_batch_size
+        self.max_wait_cap = max_wait
+        self.latency_target = latency_target
+        self.alpha = alpha
+
+        self.estimates: Dict[int, LatencyEstimate] = {}
+        self.last_arrival: Optional[float] = None
+        self.mean_interarrival: Optional[float] = None
+
+        self.batch_size = max_batch_size
+        self.max_wait = max_wait
+
+    def record_arrival(self, now: float) -> None:
+        """Record the arrival time of a new request."""
+        if self.last_arrival is not None:
+            interarrival = max(0.0, now - self.last_arrival)
+            if self.mean_interarrival is None:
+                self.mean_interarrival = interarrival
+            else:
+                self.mean_interarrival += self.alpha * (interarrival - self.mean_interarrival)
+
+        self.last_arrival = now
+
+    def record_batch(self, batch_size: int, duration: float) -> Tuple[int, float]:
+        """
+        Record the inference time of a batch and update the decision.
+
+        Args:
+            batch_size (int): The number of requests in the batch.
+            duration (float): The inference time of the batch, in seconds.
+
+        Returns:
+            Tuple[int, float]: The new effective max_batch_size and max_wait.
+        """
+        if batch_size not in self.estimates:
+            self.estimates[batch_size] = LatencyEstimate(alpha=self.alpha)
+        self.estimates[batch_size].update(duration)
+
+        return self.decide()
+
+    @property
+    def arrival_rate(self) -> float:
+        """The estimated number of requests per second."""
+        if not self.mean_interarrival:
+            return 0.0
+
+        return 1 / self.mean_interarrival
+
+    def fit(self) -> Tuple[float, float]:
+        """Fit the linear model `time(b) = intercept + slope * b` on the observed batch sizes."""
+        sizes = list(self.estimates)
+        if len(sizes) == 1:
+            size = sizes[0]
+            mean = self.estimates[size].mean
+
+            return mean / 2, mean / (2 * size)
+
+        weights = [self.estimates[size].count for size in sizes]
+        total = sum(weights)
+        mean_x = sum(w * x for w, x in zip(weights, sizes)) / total
+        mean_y = sum(w * self.estimates[x].mean for w, x in zip(weights, sizes)) / total
+        var_x = sum(w * (x - mean_x) ** 2 for w, x in zip(weights, sizes))
+        cov_xy = sum(w * (x - mean_x) * (self.estimates[x].mean - mean_y) for w, x in zip(weights, sizes))
+        slope = max(0.0, cov_xy / var_x) if var_x else 0.0
+
+        return max(0.0, mean_y - slope * mean_x), slope
+
+    def predict(self, batch_size: int) -> Tuple[float, float]:
+        """Return the estimated mean and p95 inference time of a batch size."""
+        estimate = self.estimates.get(batch_size)
+        if estimate is not None and estimate.count >= 2:
+            return estimate.mean, estimate.p95
+
+        intercept, slope = self.fit()
+        mean = intercept + slope * batch_size
+        relative_spread = max(
+            (e.p95 / e.mean - 1 for e in self.estimates.values() if e.count >= 2 and e.mean > 0), default=0.0
+        )
+
+        return mean, mean * (1 + relative_spread)
+
+    def fill_time(self, batch_size: int) -> float:
+        """Return the expected time needed for `batch_size - 1` more requests to arrive."""
+        if batch_size <= 1:
+            return 0.0
+
+        rate = self.arrival_rate
+        if rate <= 0:
+            return math.inf
+
+        return (batch_size - 1) / rate
+
+    def decide(self) -> Tuple[int, float]:
+        """
+        Choose the effective max_batch_size and max_wait from the learned model.
+
+        Returns:
+            Tuple[int, float]: The effective max_batch_size and max_wait.
+        """
+        if not self.estimates:
+            return self.batch_size, self.max_wait
+
+        best: Optional[Tuple[float, int, float]] = None
+        fallback: Optional[Tuple[float, int, float]] = None
+        for batch_size in range(1, self.max_batch_size_cap + 1):
+            mean, p95 = self.predict(batch_size)
+            wait = min(self.max_wait_cap, self.fill_time(batch_size))
+            # A batch which can't fill within the wait window only runs with the requests that arrived.
+            filled = min(batch_size, 1 + self.arrival_rate * wait)
+            throughput = filled / mean if mean > 0 else math.inf
+            candidate = (throughput, batch_size, wait)
+
+            if wait + p95 <= self.latency_target and (best is None or throughput > best[0]):
+                best = candidate
+            if fallback is None or throughput > fallback[0]:
+                fallback = candidate
+
+        # When nothing meets the target we are overloaded: maximizing throughput drains the queue fastest.
+        _, self.batch_size, wait = best if best is not None else fallback
+        _, p95 = self.predict(self.batch_size)
+        self.max_wait = max(0.0, min(wait, self.latency_target - p95))
+
+        return self.batch_size, self.max_wait
+
+    def state(self) -> dict:
+        """Export the current decision and the learned model."""
+        model = {}
+        for batch_size in range(1, self.max_batch_size_cap + 1):
+            estimate = self.estimates.get(batch_size)
+            mean, p95 = self.predict(batch_size) if self.estimates else (None, None)
+            model[batch_size] = {
+                "observations": estimate.count if estimate else 0,
+                "mean_time": mean,
+                "p95_time": p95,
+            }
+
+        return {
+            "max_batch_size": self.batch_size,
+            "max_wait": self.max_wait,
+            "latency_target": self.latency_target,
+            "arrival_rate": self.arrival_rate,
+            "model": model,
+        }
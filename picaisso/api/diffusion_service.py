@@ -2,15 +2,48 @@
 
 import asyncio
 import functools
-from collections import OrderedDict
-from typing import Optional
+import hashlib
+import inspect
+import random
+import time
+from typing import Dict, Hashable, List, Optional
 
-import tomesd
+import numpy as np
 import torch
-from diffusers.pipelines import DiffusionPipeline
+from admission import AdmissionController, DeadlineExceeded
+from backends import get_backend, shares_components
+from batching import BucketBatcher
+from cache import make_cache_key, normalize_prompt
+from continuous import ContinuousBatchingEngine
+from controller import AdaptiveBatchController
+from encoders import LatentCache, PromptEmbeddingCache
 from loguru import logger
+from metrics import (
+    BATCH_SIZE,
+    GENERATION_FAILURES,
+    IMAGES,
+    INFERENCE_TIME,
+    QUEUE_WAIT,
+    STAGE_BUSY,
+)
 from PIL import Image
-from torch import autocast
+from pool import STAGES, PipelineReplica, ReplicaPool
+from postprocessing import GeneratedImage
+from progress import ProgressReporter
+from registry import ModelRegistry
+from scheduler import BaseScheduler
+from tasks import (
+    BATCHING_MODES,
+    CONTINUOUS_BATCHING_TASKS,
+    LATENT_CACHE_TASKS,
+    STEP_CALLBACK_TASKS,
+    TASK_IMAGE_SIZE,
+    TASK_INPUT_MAPPING,
+    TASK_MAPPING,
+    TASK_PARAMETER_MAPPING,
+)
+from tracing import Trace
+from workers import WorkerReplica
 
 
 # Torch optimizations for inference
@@ -18,31 +51,64 @@ torch.backends.cudnn.benchmark = True
 torch.backends.cuda.matmul.allow_tf32 = True
 
 DTYPE_MAPPING = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
-TASK_MAPPING = OrderedDict(
-    [
-        ("image_to_image", "StableDiffusionImg2ImgPipeline"),
-        ("image_variation", "StableDiffusionImageVariationPipeline"),
-        ("super_resolution", "StableDiffusionUpscalePipeline"),
-        ("text_to_image", "StableDiffusionPipeline"),
-    ]
-)
 
-TASK_INPUT_MAPPING = OrderedDict(
-    [
-        ("image_to_image", ("image", "prompt")),
-        ("image_variation", ("image",)),
-        ("super_resolution", ("image", "prompt")),
-        ("text_to_image", ("prompt",)),
-    ]
-)
-TASK_DEFAULT_MODEL = OrderedDict(
-    [
-        ("image_to_image", "stabilityai/stable-diffusion-2-1-base"),
-        ("image_variation", "lambdalabs/sd-image-variations-diffusers"),
-        ("super_resolution", "stabilityai/stable-diffusion-x4-upscaler"),
-        ("text_to_image", "stabilityai/stable-diffusion-2-1-base"),
-    ]
-)
+
+def load_replica(
+    task: str,
+    model: str,
+    dtype: torch.dtype,
+    device: str,
+    prompt_cache_bytes: int = 0,
+    latent_cache_bytes: int = 0,
+    tasks: Optional[List[str]] = None,
+    backend: str = "diffusers",
+    backend_options: Optional[dict] = None,
+) -> PipelineReplica:
+    """
+    Load a pipeline replica, and its encoder caches, on a device.
+
+    Half precision is only used on CUDA devices, CPU replicas are loaded in full precision.
+    This is a module level function so inference worker processes can load their replica too.
+
+    Args:
+        task (str): The task to perform. Must be one of the keys of TASK_MAPPING.
+        model (str): The model name to use.
+        dtype (torch.dtype): The torch dtype to use on CUDA devices.
+        device (str): The device to load the replica on.
+        prompt_cache_bytes (int): The size of the prompt embeddings cache. 0 disables the cache.
+        latent_cache_bytes (int): The size of the source image latents cache. 0 disables the cache.
+        tasks (Optional[List[str]]): Other tasks to serve with the components of the `task` pipeline.
+            They must share their components with it, see `shares_components`.
+        backend (str): The inference backend building the pipelines, one of BACKEND_MAPPING.
+        backend_options (Optional[dict]): The options of the backend.
+
+    Returns:
+        PipelineReplica: The loaded replica.
+    """
+    backend = get_backend(backend, **(backend_options or {}))
+    pipeline = backend.load_pipeline(task, model, dtype if device.startswith("cuda") else torch.float32, device)
+
+    pipelines = {task: pipeline}
+    for other_task in tasks or []:
+        if other_task not in pipelines:
+            pipelines[other_task] = backend.derive_pipeline(pipeline, other_task)
+
+    pipeline_parameters = inspect.signature(pipeline.__call__).parameters
+
+    prompt_cache = None
+    if prompt_cache_bytes and "prompt" in TASK_INPUT_MAPPING[task] and "prompt_embeds" in pipeline_parameters:
+        prompt_cache = PromptEmbeddingCache.from_pipeline(pipeline, model, prompt_cache_bytes, device=device)
+
+    latent_cache = None
+    latent_task = next((name for name in pipelines if name in LATENT_CACHE_TASKS), None)
+    if latent_cache_bytes and latent_task is not None and hasattr(pipelines[latent_task], "image_processor"):
+        latent_cache = LatentCache.from_pipeline(pipelines[latent_task], model, latent_cache_bytes, device=device)
+
+    logger.info(f"Loaded a {', '.join(pipelines)} pipeline replica on {device}")
+
+    return PipelineReplica(
+        pipeline, device, prompt_cache=prompt_cache, latent_cache=latent_cache, pipelines=pipelines, model=model
+    )
 
 
 class DiffusionService:
@@ -56,6 +122,22 @@ class DiffusionService:
         n_steps: int,
         max_batch_size: int,
         max_wait: int,
+        scheduler: Optional[BaseScheduler] = None,
+        batching_mode: str = "static",
+        pipelining: bool = False,
+        controller: Optional[AdaptiveBatchController] = None,
+        admission: Optional[AdmissionController] = None,
+        preview_every: int = 5,
+        prompt_cache_bytes: int = 0,
+        latent_cache_bytes: int = 0,
+        devices: Optional[List[str]] = None,
+        workers: bool = False,
+        multi_task: bool = False,
+        models: Optional[List[str]] = None,
+        model_memory_bytes: int = 0,
+        model_offload: str = "cpu",
+        backend: str = "diffusers",
+        backend_options: Optional[dict] = None,
     ) -> None:
         """
         Initialize the service with the given parameters and the task.
@@ -67,15 +149,56 @@ class DiffusionService:
             n_steps (int): The number of steps to use.
             max_batch_size (int): The maximum batch size to use.
             max_wait (int): The maximum time to wait before processing the batch.
+            scheduler (Optional[BaseScheduler]): The scheduler deciding which requests form a batch.
+                Defaults to a BucketBatcher of FIFO buckets.
+            batching_mode (str): "static" runs each batch through the whole pipeline call, "continuous"
+                lets requests join and leave the running batch at every denoising step. Defaults to "static".
+            pipelining (bool): Run up to one static batch per stage on each replica at once, so the prompts of the
+                next batch are encoded and the images of the previous one are decoded while a batch denoises.
+                Not supported by continuous batching and inference workers. Defaults to False.
+            controller (Optional[AdaptiveBatchController]): When set, the effective max_batch_size and max_wait
+                are chosen online by the controller after each static batch, with the given values as upper bounds.
+            admission (Optional[AdmissionController]): When set, bounds the queue, rejects the requests which
+                can't meet their deadline and sheds the expired ones before they reach the pipeline.
+            preview_every (int): Send a latent preview to the progress subscribers every `preview_every` steps.
+                0 disables the previews. Defaults to 5.
+            prompt_cache_bytes (int): The size of the prompt embeddings cache in front of the text encoder.
+                0 disables the cache. Defaults to 0.
+            latent_cache_bytes (int): The size of the source image latents cache in front of the VAE encoder,
+                for the tasks of LATENT_CACHE_TASKS. 0 disables the cache. Defaults to 0.
+            devices (Optional[List[str]]): The devices to load a pipeline replica on, e.g. ["cuda:0", "cuda:1"]
+                or ["cpu", "cpu"]. Each batch is dispatched to the least loaded replica. Defaults to ["cuda:0"].
+            workers (bool): Run each replica in a dedicated inference worker process instead of a thread of the API
+                process. Only static batching is supported, without per-step progress and cancellation.
+                Defaults to False.
+            multi_task (bool): Also serve every other task of TASK_MAPPING whose pipeline can be built from the
+                components of the `task` pipeline, so the weights are loaded only once. Requests choose their task,
+                and the batches are kept per task. Defaults to False.
+            models (Optional[List[str]]): The models requests can use, on top of `model_name` which is loaded at
+                startup and used by default. The other ones are loaded on demand. Defaults to `model_name` alone.
+            model_memory_bytes (int): The memory budget of the resident models on each device. The least recently
+                used models are evicted when it is exceeded. 0 means no budget. Defaults to 0.
+            model_offload (str): What to do with evicted models: "cpu" moves them to CPU memory, "release" frees
+                them. Defaults to "cpu".
+            backend (str): The inference backend building the pipelines: "diffusers" for the real models, "tiny"
+                for a tiny random-weights pipeline or "stub" for a latency model without any model. Defaults to
+                "diffusers".
+            backend_options (Optional[dict]): The options of the backend, e.g. the latency model of the stub.
 
         Raises:
-            ValueError: If the task is not supported.
+            ValueError: If the task, the batching mode, the devices or the models are not supported.
         """
         if task not in TASK_MAPPING.keys():
             raise ValueError(f"Task {task} is not supported. Must be one of {list(TASK_MAPPING.keys())}.")
         else:
             self.task = task
             self.input_names = TASK_INPUT_MAPPING[task]
+            self.parameter_names = TASK_PARAMETER_MAPPING[task]
+
+        self.tasks = [task]
+        if multi_task:
+            self.tasks += [other for other in TASK_MAPPING if other != task and shares_components(task, other)]
+            logger.info(f"Serving the tasks {self.tasks} with the components of the {task} pipeline")
 
         self.model = model_name
         self.dtype = DTYPE_MAPPING[dtype]
@@ -83,106 +206,720 @@ class DiffusionService:
         self.max_batch_size = max_batch_size
         self.max_wait = max_wait
 
+        if batching_mode not in BATCHING_MODES:
+            raise ValueError(f"Batching mode {batching_mode} is not supported. Must be one of {list(BATCHING_MODES)}.")
+        if batching_mode == "continuous" and task not in CONTINUOUS_BATCHING_TASKS:
+            raise ValueError(f"Continuous batching is only supported for {list(CONTINUOUS_BATCHING_TASKS)}.")
+        self.batching_mode = batching_mode
+
+        self.devices = devices if devices else ["cuda:0"]
+        if batching_mode == "continuous" and len(self.devices) > 1:
+            raise ValueError("Continuous batching only supports a single device.")
+        if batching_mode == "continuous" and len(self.tasks) > 1:
+            raise ValueError("Continuous batching only supports a single task.")
+        if batching_mode == "continuous" and workers:
+            raise ValueError("Continuous batching is not supported by the inference workers.")
+        if batching_mode == "continuous" and backend == "stub":
+            raise ValueError("Continuous batching is not supported by the stub backend.")
+        if pipelining and (batching_mode == "continuous" or workers):
+            raise ValueError("Pipelining is not supported by continuous batching and inference workers.")
+        self.workers = workers
+        # A batch per stage, so the hand-off between the stages of a replica is bounded by the pool.
+        self.max_running = len(STAGES) if pipelining else 1
+
+        models = [model_name] + [model for model in models or [] if model != model_name]
+        if len(models) > 1 and (batching_mode == "continuous" or workers):
+            raise ValueError("Serving several models is not supported by continuous batching and inference workers.")
+
+        self.controller = controller
+        self.admission = admission
+        self.preview_every = preview_every
+
+        # Cancellation accounting
+        self.request_time = None
+        self.cancellation_stats = {"cancelled_queued": 0, "cancelled_running": 0, "gpu_seconds_saved": 0.0}
+
+        # Identical requests in flight, by cache key
+        self.in_flight: Dict[str, dict] = {}
+        self.coalescing_stats = {"coalesced": 0}
+
+        # Batch fill accounting of the static batches: the capacity is the max batch size in force for each batch
+        self.batch_stats = {"batches": 0, "images": 0, "capacity": 0}
+
         # Multi requests support
-        self.queue = []
+        self.queue = scheduler if scheduler is not None else BucketBatcher(max_wait=max_wait)
         self.queue_lock = None
         self.needs_processing = None
         self.needs_processing_timer = None
 
-        assert torch.cuda.is_available(), "CUDA is not available"
-        self.pipeline = self.import_pipeline()
-        self.pipeline.to("cuda:0")
-        tomesd.apply_patch(self.pipeline, ratio=0.5)
+        # The source images are hashed for the latents caches, which live with the replicas.
+        self.hash_images = bool(latent_cache_bytes)
+        self.prompt_cache_bytes = prompt_cache_bytes
+        self.latent_cache_bytes = latent_cache_bytes
+        self.backend = backend
+        self.backend_options = backend_options
+        loaders = self.replica_loaders(self.model)
+
+        if self.workers:
+            # The pipelines are loaded by the worker processes, the API process only batches the requests.
+            self.pool = ReplicaPool(
+                [WorkerReplica(device, loader, model=self.model) for device, loader in zip(self.devices, loaders)]
+            )
+            self.pipeline = None
+            self.step_end_callback_tasks = set()
+            self.legacy_callback_tasks = set()
+        else:
+            uses_cuda = any(device.startswith("cuda") for device in self.devices)
+            if uses_cuda and get_backend(backend, **(backend_options or {})).uses_device:
+                assert torch.cuda.is_available(), "CUDA is not available"
+            self.pool = ReplicaPool([loader() for loader in loaders], max_running=self.max_running)
+            # The replicas are identical, the first one stands for all of them.
+            self.pipeline = self.pool.replicas[0].pipeline
+
+            # The pipelines derived for the other tasks don't necessarily take the callbacks of the main one.
+            self.step_end_callback_tasks, self.legacy_callback_tasks = set(), set()
+            for name, pipeline in (self.pool.replicas[0].pipelines or {self.task: self.pipeline}).items():
+                pipeline_parameters = inspect.signature(pipeline.__call__).parameters
+                if "callback_on_step_end" in pipeline_parameters:
+                    self.step_end_callback_tasks.add(name)
+                if "callback" in pipeline_parameters:
+                    self.legacy_callback_tasks.add(name)
+        self.progress = None
+        # time.perf_counter() of the first generated image, for the startup timings
+        self.first_image_time: Optional[float] = None
+
+        # The noise scheduler of each task, by model, known once the model is loaded
+        self.samplers: Dict[str, Dict[str, Optional[dict]]] = {self.model: self.describe_samplers(self.pool)}
+
+        # The other models are loaded on demand, with the same task, precision and devices.
+        self.registry = ModelRegistry(models, self.load_pool, max_bytes=model_memory_bytes, offload=model_offload)
+        self.registry.add(self.model, self.pool)
+
+        self.engine = None
+        if self.batching_mode == "continuous":
+            replica = self.pool.replicas[0]
+            self.engine = ContinuousBatchingEngine.from_pipeline(
+                replica.pipeline, device=replica.device, encode_prompt=replica.prompt_cache
+            )
+
+    def replica_loaders(self, model: str) -> List[functools.partial]:
+        """Return the loaders of the replicas of a model, one per device. They are picklable, for the workers."""
+        return [
+            functools.partial(
+                load_replica,
+                self.task,
+                model,
+                self.dtype,
+                device,
+                prompt_cache_bytes=self.prompt_cache_bytes,
+                latent_cache_bytes=self.latent_cache_bytes,
+                tasks=self.tasks,
+                backend=self.backend,
+                backend_options=self.backend_options,
+            )
+            for device in self.devices
+        ]
+
+    def load_pool(self, model: str) -> ReplicaPool:
+        """Load the replicas of a model on every device."""
+        pool = ReplicaPool([loader() for loader in self.replica_loaders(model)], max_running=self.max_running)
+        self.samplers[model] = self.describe_samplers(pool)
+
+        return pool
+
+    def describe_samplers(self, pool: ReplicaPool) -> Dict[str, Optional[dict]]:
+        """
+        Describe the noise scheduler of each task of a model: its class and its configuration.
+
+        The pipelines of the worker processes are out of reach, their schedulers are described as None.
+        """
+        replica = pool.replicas[0]
+        pipelines = replica.pipelines or {self.task: replica.pipeline}
+        samplers = {}
+        for task, pipeline in pipelines.items():
+            scheduler = getattr(pipeline, "scheduler", None)
+            samplers[task] = (
+                {
+                    "class": type(scheduler).__name__,
+                    "config": {key: value for key, value in scheduler.config.items() if not key.startswith("_")},
+                }
+                if scheduler is not None
+                else None
+            )
+
+        return samplers
 
-    def import_pipeline(self) -> DiffusionPipeline:
-        """Import the pipeline from the task.
+    def task_parameters(
+        self, num_inference_steps: Optional[int] = None, task: Optional[str] = None, **parameters
+    ) -> dict:
+        """
+        Filter the generation parameters of a request.
 
-        The task is used to determine the pipeline name,
-        e.g. task = "text_to_image" -> pipeline_name = "StableDiffusionPipeline"
+        Parameters left to None use the pipeline defaults, the ones unknown to the task are ignored.
 
         Args:
-            task (str): The task to perform. Must be one of the keys of TASK_MAPPING.
-            model (str): The model name to use.
-            dtype (torch.dtype): The torch dtype to use.
+            num_inference_steps (Optional[int]): The number of denoising steps. Defaults to n_steps.
+            task (Optional[str]): The task of the request. Defaults to the service task.
+            **parameters: The other generation parameters of the request.
 
         Returns:
-            DiffusionPipeline: The pipeline to use from the diffusers library.
+            dict: The parameters to give to the pipeline.
+        """
+        parameters = {"num_inference_steps": num_inference_steps or self.n_steps, **parameters}
+        parameter_names = TASK_PARAMETER_MAPPING[task] if task is not None else self.parameter_names
 
-        Raises:
-            ValueError: If the task is not supported.
+        return {name: value for name, value in parameters.items() if name in parameter_names and value is not None}
+
+    def cache_key(
+        self,
+        prompt: Optional[str] = None,
+        image: Optional[Image.Image] = None,
+        seed: Optional[int] = None,
+        num_inference_steps: Optional[int] = None,
+        guidance_scale: Optional[float] = None,
+        height: Optional[int] = None,
+        width: Optional[int] = None,
+        strength: Optional[float] = None,
+        task: Optional[str] = None,
+        model: Optional[str] = None,
+        **kwargs,
+    ) -> str:
         """
-        diffusers_module = __import__("diffusers")
+        Build the result cache key of a request, i.e. everything its output depends on.
 
-        try:
-            pipeline = getattr(diffusers_module, TASK_MAPPING[self.task]).from_pretrained(
-                self.model,
-                torch_dtype=self.dtype,
-            )
+        The noise scheduler of a model is described once the model is loaded. Until then the key leaves it out,
+        which is safe since the model and the backend alone determine it.
+
+        Args:
+            prompt (Optional[str]): The prompt of the request.
+            image (Optional[Image.Image]): The source image of the request.
+            seed (Optional[int]): The seed of the request.
+            num_inference_steps, guidance_scale, height, width, strength: The generation parameters of the request.
+            task (Optional[str]): The task of the request. Defaults to the service task.
+            model (Optional[str]): The model of the request. Defaults to the service model.
+            **kwargs: The other arguments of `process_input`, which don't change the output.
+
+        Returns:
+            str: The cache key of the request.
+        """
+        task = task or self.task
+        input_names = TASK_INPUT_MAPPING[task]
 
-        except ValueError as e:
-            if "Pipeline" in str(e):
-                logger.warning(
-                    f"The model {self.model} is not compatible with the task {self.task}. "
-                    f"Using the default model {TASK_DEFAULT_MODEL[self.task]} instead."
-                )
-                pipeline = getattr(diffusers_module, TASK_MAPPING[self.task]).from_pretrained(
-                    TASK_DEFAULT_MODEL[self.task], torch_dtype=self.dtype
-                )
+        return make_cache_key(
+            model=model or self.model,
+            dtype=str(self.dtype),
+            task=task,
+            prompt=normalize_prompt(prompt) if "prompt" in input_names else None,
+            image=self.image_hash(image) if image is not None and "image" in input_names else None,
+            seed=seed,
+            # How the images are sampled: the noise scheduler, the backend and its token merging, the batching loop
+            sampler={
+                "scheduler": self.samplers.get(model or self.model, {}).get(task),
+                "backend": self.backend,
+                "backend_options": self.backend_options,
+                "batching_mode": self.batching_mode,
+            },
+            parameters=self.task_parameters(
+                task=task,
+                num_inference_steps=num_inference_steps,
+                guidance_scale=guidance_scale,
+                height=height,
+                width=width,
+                strength=strength,
+            ),
+        )
 
-        return pipeline
+    @staticmethod
+    def image_hash(image: Image.Image) -> str:
+        """Hash the decoded pixels of an image."""
+        return hashlib.sha256(image.tobytes()).hexdigest() + f"-{image.mode}-{image.size}"
+
+    def bucket_key(self, task: dict) -> Hashable:
+        """
+        Build the bucket key of a task, i.e. everything that must match inside one denoising call.
+
+        Args:
+            task (dict): The task with its inputs and its `parameters`.
+
+        Returns:
+            Hashable: The bucket key of the task.
+        """
+        key = (("model", task["model"]), ("task", task["task"])) + tuple(sorted(task["parameters"].items()))
+        if "image" in task:
+            # The pipelines can only stack source images of the same size.
+            key += (("image_size", task["image"].size),)
+
+        return key
 
     def schedule_processing_if_needed(self):
-        if len(self.queue) >= self.max_batch_size:
+        if self.batching_mode == "continuous":
+            # Requests join the running batch at the next step boundary, there is no batch to fill.
+            if self.queue:
+                self.needs_processing.set()
+        elif self.queue.has_full_batch(self.max_batch_size):
             self.needs_processing.set()
         elif self.queue:
             self.needs_processing_timer = asyncio.get_event_loop().call_at(
-                self.queue[0]["time"] + self.max_wait, self.needs_processing.set
+                self.queue.oldest_time() + self.max_wait, self.needs_processing.set
             )
 
-    async def process_input(self, prompt: Optional[str] = None, image: Optional[Image.Image] = None) -> Image.Image:
+    def apply_batching_decision(self, max_batch_size: int, max_wait: float) -> None:
+        """
+        Update the effective max_batch_size and max_wait, e.g. with the decision of the adaptive controller.
+
+        Args:
+            max_batch_size (int): The new maximum batch size.
+            max_wait (float): The new maximum time to wait before processing a batch.
+        """
+        if (max_batch_size, max_wait) != (self.max_batch_size, self.max_wait):
+            logger.debug(f"Batching decision: max_batch_size={max_batch_size}, max_wait={max_wait:.3f}")
+
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        if hasattr(self.queue, "max_wait"):
+            self.queue.max_wait = max_wait
+
+    def fill_stats(self) -> dict:
+        """Export the number of static batches, of generated images, and the average fill ratio of the batches."""
+        capacity = self.batch_stats["capacity"]
+
+        return {
+            "batches": self.batch_stats["batches"],
+            "images": self.batch_stats["images"],
+            "fill_ratio": self.batch_stats["images"] / capacity if capacity else None,
+        }
+
+    def device_memory(self) -> Dict[str, Dict[str, int]]:
+        """
+        Return the allocated and reserved memory of each CUDA device of the service, in bytes.
+
+        The pipelines of the inference workers live in other processes, their memory isn't reported.
+        """
+        if self.workers or not torch.cuda.is_available():
+            return {}
+
+        return {
+            device: {
+                "allocated": torch.cuda.memory_allocated(device),
+                "reserved": torch.cuda.memory_reserved(device),
+            }
+            for device in self.devices
+            if device.startswith("cuda")
+        }
+
+    async def process_input(
+        self,
+        prompt: Optional[str] = None,
+        image: Optional[Image.Image] = None,
+        author: str = "anonymous",
+        priority: str = "normal",
+        num_inference_steps: Optional[int] = None,
+        guidance_scale: Optional[float] = None,
+        height: Optional[int] = None,
+        width: Optional[int] = None,
+        strength: Optional[float] = None,
+        deadline: Optional[float] = None,
+        progress: Optional[asyncio.Queue] = None,
+        seed: Optional[int] = None,
+        task: Optional[str] = None,
+        model: Optional[str] = None,
+        trace: Optional[Trace] = None,
+    ) -> GeneratedImage:
         """Process the input and wait for the result before returning.
 
         Args:
             prompt (Optional[str], optional): The prompt to use. Defaults to None.
             image (Optional[Image.Image], optional): The image to use. Defaults to None.
+            author (str, optional): The tenant the request belongs to, used for fair scheduling.
+                Defaults to "anonymous".
+            priority (str, optional): The priority class of the request. Defaults to "normal".
+            num_inference_steps (Optional[int], optional): The number of denoising steps. Defaults to n_steps.
+            guidance_scale (Optional[float], optional): The classifier-free guidance scale. Defaults to None.
+            height (Optional[int], optional): The height of the generated image. Defaults to None.
+            width (Optional[int], optional): The width of the generated image. Defaults to None.
+            strength (Optional[float], optional): How much the source image is transformed. Defaults to None.
+            deadline (Optional[float], optional): The time, in seconds, the client is willing to wait for the result.
+                Defaults to the default deadline of the admission controller.
+            progress (Optional[asyncio.Queue], optional): A queue receiving the progress and preview events of the
+                generation. Defaults to None.
+            seed (Optional[int], optional): The seed of the generation, for reproducible outputs.
+                Defaults to a random seed.
+            task (Optional[str], optional): The task of the request, one of the served tasks. Defaults to the
+                service task.
+            model (Optional[str], optional): The model of the request, one of the registered models. Defaults to the
+                service model.
+            trace (Optional[Trace], optional): The trace of the request, receiving the model loading, queue and
+                inference stages. Defaults to None.
 
         Returns:
-            Image.Image: The processed image as a PIL Image.
+            GeneratedImage: The processed image, with its seed in its `info`.
+
+        Raises:
+            AdmissionRejected: If the queue is full or the request can't meet its deadline.
         """
         our_task = {
             "done_event": asyncio.Event(),
             "time": asyncio.get_event_loop().time(),
+            "author": author,
+            "priority": priority,
+            "progress": [progress] if progress is not None else [],
+            "traces": [trace] if trace is not None else [],
+            "task": task or self.task,
+            "model": model or self.model,
         }
 
-        if prompt is not None and "prompt" in self.input_names:
+        if our_task["model"] not in self.registry:
+            our_task["done_event"].set()
+
+            return ValueError(f"Model {our_task['model']} is not served. Must be one of {self.registry.models}.")
+
+        if our_task["task"] not in self.tasks:
+            our_task["done_event"].set()
+
+            return ValueError(f"Task {our_task['task']} is not served. Must be one of {self.tasks}.")
+
+        input_names = TASK_INPUT_MAPPING[our_task["task"]]
+
+        if prompt is not None and "prompt" in input_names:
             our_task["prompt"] = prompt
 
-        if image is not None and "image" in self.input_names:
-            if self.task == "super_resolution":
-                our_task["image"] = image.resize((128, 128))
+        if image is not None and "image" in input_names:
+            if our_task["task"] in TASK_IMAGE_SIZE:
+                our_task["image"] = image.resize(TASK_IMAGE_SIZE[our_task["task"]])
             else:
                 our_task["image"] = image
 
-        if not all([k in our_task for k in self.input_names]):
-            logger.error(f"Missing inputs for task {self.task}: {self.input_names}")
+            if self.hash_images and our_task["task"] in LATENT_CACHE_TASKS:
+                our_task["image_hash"] = self.image_hash(our_task["image"])
+
+        our_task["parameters"] = self.task_parameters(
+            task=our_task["task"],
+            num_inference_steps=num_inference_steps,
+            guidance_scale=guidance_scale,
+            height=height,
+            width=width,
+            strength=strength,
+        )
+
+        # Each request gets its own generator, so its output only depends on its seed, not on its batch.
+        our_task["seed"] = seed if seed is not None else random.randrange(2**32)
+        our_task["generator"] = torch.Generator("cpu").manual_seed(our_task["seed"])
 
-            missing_inputs = [k for k in self.input_names if k not in our_task]
+        if not all([k in our_task for k in input_names]):
+            logger.error(f"Missing inputs for task {our_task['task']}: {input_names}")
+
+            missing_inputs = [k for k in input_names if k not in our_task]
             our_task["done_event"].set()
 
-            return ValueError(f"Missing inputs for task {self.task}: {missing_inputs}")
+            return ValueError(f"Missing inputs for task {our_task['task']}: {missing_inputs}")
+
+        our_task["bucket"] = self.bucket_key(our_task)
+        # Identical seeded requests share one generation. An unseeded request asks for a new image, e.g. a re-roll.
+        our_task["key"] = (
+            self.cache_key(
+                model=our_task["model"],
+                task=our_task["task"],
+                prompt=prompt,
+                image=image,
+                seed=seed,
+                num_inference_steps=num_inference_steps,
+                guidance_scale=guidance_scale,
+                height=height,
+                width=width,
+                strength=strength,
+            )
+            if seed is not None
+            else None
+        )
+
+        # A cold model is loaded, or moved back to its devices, in the background while the other models keep
+        # serving. It stays resident until the request is done.
+        model = our_task["model"]
+        loading = self.registry.entries[model].state != "resident"
+        start = asyncio.get_event_loop().time()
+        await self.registry.acquire(model)
+        if trace is not None and loading:
+            trace.add_span("model_load", start, model=model)
+        try:
+            async with self.queue_lock:
+                shared_task = self.in_flight.get(our_task["key"]) if our_task["key"] is not None else None
+
+                if shared_task is not None and not shared_task.get("cancelled"):
+                    self.join(shared_task, our_task, deadline)
+                    our_task = shared_task
+                else:
+                    if self.admission is not None:
+                        our_task["deadline"] = self.admission.admit(
+                            len(self.queue), self.max_batch_size, self.max_wait, our_task["time"], deadline=deadline
+                        )
+
+                    if self.controller is not None:
+                        self.controller.record_arrival(our_task["time"])
+
+                    our_task["waiters"] = 1
+                    if our_task["key"] is not None:
+                        self.in_flight[our_task["key"]] = our_task
+                    self.queue.push(our_task)
+                    self.schedule_processing_if_needed()
+
+            try:
+                await our_task["done_event"].wait()
+            except asyncio.CancelledError:
+                await self.cancel(our_task, progress=progress)
+                raise
+            finally:
+                if our_task["done_event"].is_set() and self.in_flight.get(our_task["key"]) is our_task:
+                    del self.in_flight[our_task["key"]]
+        finally:
+            self.registry.release(model)
+
+        result = our_task["result"]
+        if isinstance(result, GeneratedImage):
+            result.info["seed"] = our_task["seed"]
+            if self.first_image_time is None:
+                self.first_image_time = time.perf_counter()
 
+        return result
+
+    def join(self, shared_task: dict, our_task: dict, deadline: Optional[float] = None) -> None:
+        """
+        Attach a request to an identical pending or running task, instead of queuing it again.
+
+        Args:
+            shared_task (dict): The task already in flight.
+            our_task (dict): The new, identical, request.
+            deadline (Optional[float]): The deadline of the new request, in seconds from now.
+        """
+        shared_task["waiters"] += 1
+        shared_task["progress"].extend(our_task["progress"])
+        shared_task["traces"].extend(our_task["traces"])
+        for trace in our_task["traces"]:
+            trace.root.attributes["coalesced"] = True
+        self.coalescing_stats["coalesced"] += 1
+
+        # The shared task must not be shed while one of its waiters is still willing to wait.
+        if shared_task.get("deadline") is not None:
+            deadline = deadline if deadline is not None else self.admission.default_deadline
+            shared_task["deadline"] = (
+                max(shared_task["deadline"], our_task["time"] + deadline) if deadline is not None else None
+            )
+
+        logger.debug(f"Coalesced a request of {our_task['author']} with a request of {shared_task['author']}")
+
+    async def cancel(self, task: dict, progress: Optional[asyncio.Queue] = None) -> None:
+        """
+        Cancel a task whose client gave up.
+
+        A task shared by coalesced requests is only cancelled once all of them gave up. A pending
+        task is removed from the queue. A running task is flagged, and is dropped from its batch at
+        the next denoising step boundary by the step callback (or by the continuous batching
+        engine), so the other members of the batch finish faster.
+
+        Args:
+            task (dict): The task to cancel.
+            progress (Optional[asyncio.Queue]): The progress queue of the request giving up, if any.
+        """
         async with self.queue_lock:
-            self.queue.append(our_task)
-            self.schedule_processing_if_needed()
+            if progress is not None and progress in task["progress"]:
+                task["progress"].remove(progress)
+
+            task["waiters"] -= 1
+            if task["waiters"] > 0:
+                return
+
+            if self.in_flight.get(task["key"]) is task:
+                del self.in_flight[task["key"]]
+
+            if self.queue.remove(task):
+                self.cancellation_stats["cancelled_queued"] += 1
+                self.cancellation_stats["gpu_seconds_saved"] += self.request_time or 0.0
+                logger.debug(f"Cancelled a queued request of {task.get('author')}")
+            elif not task["done_event"].is_set():
+                task["cancelled"] = True
+
+    def record_cancelled_steps(self, dropped: int, remaining_steps: int, step_time: float, batch_size: int) -> None:
+        """Account for requests dropped from a running batch."""
+        self.cancellation_stats["cancelled_running"] += dropped
+        self.cancellation_stats["gpu_seconds_saved"] += dropped * remaining_steps * step_time / batch_size
+        logger.debug(f"Dropped {dropped} cancelled requests from a running batch of {batch_size}")
+
+    @staticmethod
+    def slice_scheduler_state(scheduler, index: torch.Tensor, shape: torch.Size) -> None:
+        """
+        Slice the history of a multistep scheduler like the latents of the running batch.
+
+        The multistep schedulers keep the previous model outputs and samples of the batch (e.g. `ets` and
+        `cur_sample` for PNDM, `model_outputs` for DPM-Solver), which must keep the batch size of the latents.
+        Every tensor of the scheduler state with the shape of the latents, alone or in a list, is sliced.
+
+        Args:
+            scheduler: The scheduler of the running pipeline. Updated in place.
+            index (torch.Tensor): The indices of the kept rows.
+            shape (torch.Size): The shape of the latents before the drop.
+        """
+
+        def sliced(value):
+            if isinstance(value, torch.Tensor) and value.shape == shape:
+                return value[index.to(value.device)]
+            return value
+
+        for name, value in list(vars(scheduler).items()):
+            if isinstance(value, torch.Tensor):
+                setattr(scheduler, name, sliced(value))
+            elif isinstance(value, list) and any(isinstance(item, torch.Tensor) for item in value):
+                setattr(scheduler, name, [sliced(item) for item in value])
+
+    def drop_cancelled(
+        self,
+        input_batch: List[dict],
+        callback_kwargs: dict,
+        step: int,
+        step_time: float,
+        scheduler=None,
+        generators: Optional[List[torch.Generator]] = None,
+    ) -> dict:
+        """
+        Slice the latents and the prompt embeddings of the cancelled tasks out of the running batch.
+
+        `input_batch` is kept in sync, so it always lists the tasks still being generated,
+        in the order of the output images. So are the history of the scheduler and the generators
+        of the tasks, which the pipeline keeps using at the next steps.
+
+        Args:
+            input_batch (List[dict]): The tasks of the running batch. Updated in place.
+            callback_kwargs (dict): The tensors given to the diffusers `callback_on_step_end`.
+            step (int): The index of the finished step.
+            step_time (float): The duration of the finished step, in seconds.
+            scheduler: The scheduler of the running pipeline, whose history is sliced in place.
+            generators (Optional[List[torch.Generator]]): The generators given to the pipeline, one per task.
+                Updated in place.
+
+        Returns:
+            dict: The tensors the pipeline should continue with.
+        """
+        keep = [index for index, task in enumerate(input_batch) if not task.get("cancelled")]
+        if len(keep) == len(input_batch) or not keep:
+            return callback_kwargs
+
+        batch_size = len(input_batch)
+        index = torch.tensor(keep, device=callback_kwargs["latents"].device)
+        if scheduler is not None:
+            self.slice_scheduler_state(scheduler, index, callback_kwargs["latents"].shape)
+        if generators is not None and len(generators) == batch_size:
+            generators[:] = [generators[i] for i in keep]
+        callback_kwargs["latents"] = callback_kwargs["latents"][index]
+
+        prompt_embeds = callback_kwargs["prompt_embeds"]
+        if prompt_embeds.shape[0] == 2 * batch_size:
+            # Classifier-free guidance stacks the negative and the positive embeddings.
+            negative, positive = prompt_embeds.chunk(2)
+            callback_kwargs["prompt_embeds"] = torch.cat([negative[index], positive[index]])
+        else:
+            callback_kwargs["prompt_embeds"] = prompt_embeds[index]
+
+        dropped = [task for task in input_batch if task.get("cancelled")]
+        input_batch[:] = [input_batch[i] for i in keep]
+        for task in dropped:
+            task["result"] = None
+            task["done_event"].set()
+
+        total_steps = input_batch[0]["parameters"].get("num_inference_steps", self.n_steps)
+        self.record_cancelled_steps(len(dropped), max(0, total_steps - step - 1), step_time, batch_size)
+
+        return callback_kwargs
+
+    def step_callbacks(self, input_batch: List[dict], generators: Optional[List[torch.Generator]] = None) -> dict:
+        """
+        Build the step callback arguments of a pipeline call.
+
+        With `callback_on_step_end`, the callback drops the cancelled tasks from the running batch
+        (for the tasks of STEP_CALLBACK_TASKS) and reports the progress of the subscribed tasks.
+        Pipelines which only support the legacy `callback` just report the progress.
+
+        Args:
+            input_batch (List[dict]): The tasks of the batch. Updated in place when tasks are dropped.
+            generators (Optional[List[torch.Generator]]): The generators given to the pipeline, one per task.
+                Updated in place when tasks are dropped.
+
+        Returns:
+            dict: The callback arguments to give to the pipeline, empty if no callback is needed.
+        """
+        total_steps = input_batch[0]["parameters"].get("num_inference_steps", self.n_steps)
+        task_name = input_batch[0]["task"]
+        drop_supported = task_name in STEP_CALLBACK_TASKS
+        subscribed = any(task["progress"] for task in input_batch)
+        last_step = [time.perf_counter()]
+
+        def report_progress(step: int, latents: torch.Tensor) -> None:
+            for index, task in enumerate(input_batch):
+                self.progress.report(task, step, total_steps, latents[index : index + 1])
+
+        if task_name in self.step_end_callback_tasks and (drop_supported or subscribed):
+
+            def callback_on_step_end(pipeline, step: int, timestep, callback_kwargs: dict) -> dict:
+                now = time.perf_counter()
+                step_time, last_step[0] = now - last_step[0], now
 
-        await our_task["done_event"].wait()
+                if all(task.get("cancelled") for task in input_batch):
+                    # Nothing left worth generating, stop the denoising loop when the pipeline supports it.
+                    pipeline._interrupt = True
+                elif drop_supported:
+                    callback_kwargs = self.drop_cancelled(
+                        input_batch, callback_kwargs, step, step_time, getattr(pipeline, "scheduler", None), generators
+                    )
 
-        return our_task["result"]
+                report_progress(step, callback_kwargs["latents"])
+
+                return callback_kwargs
+
+            tensor_inputs = ["latents", "prompt_embeds"] if drop_supported else ["latents"]
+
+            return {"callback_on_step_end": callback_on_step_end, "callback_on_step_end_tensor_inputs": tensor_inputs}
+
+        if task_name in self.legacy_callback_tasks and subscribed:
+
+            def callback(step: int, timestep, latents: torch.Tensor) -> None:
+                report_progress(step, latents)
+
+            return {"callback": callback, "callback_steps": 1}
+
+        return {}
+
+    def shed_expired(self, tasks: List[dict], now: float) -> List[dict]:
+        """
+        Release the tasks whose deadline already passed instead of sending them to the pipeline.
+
+        Args:
+            tasks (List[dict]): The tasks about to be processed.
+            now (float): The current loop time.
+
+        Returns:
+            List[dict]: The tasks which are still worth processing.
+        """
+        kept = []
+        for task in tasks:
+            if task.get("deadline") is not None and task["deadline"] <= now:
+                task["result"] = DeadlineExceeded(f"The deadline passed after {now - task['time']:.1f}s in the queue.")
+                task["done_event"].set()
+                self.admission.shed += 1
+            else:
+                kept.append(task)
+
+        return kept
 
     async def runner(self):
         """Process the queue."""
         self.queue_lock = asyncio.Lock()
         self.needs_processing = asyncio.Event()
+        self.progress = ProgressReporter(asyncio.get_event_loop(), preview_every=self.preview_every)
+        if self.workers:
+            for replica in self.pool.replicas:
+                replica.start(asyncio.get_event_loop())
+                asyncio.ensure_future(replica.monitor())
+        if self.batching_mode == "continuous":
+            self.engine.progress = self.progress
+            await self.continuous_runner()
+
         while True:
             await self.needs_processing.wait()
             self.needs_processing.clear()
@@ -190,44 +927,223 @@ class DiffusionService:
                 self.needs_processing_timer.cancel()
                 self.needs_processing_timer = None
 
+            # While every replica is busy, the pending requests keep filling the next batches.
+            if not self.registry.available():
+                continue
+
             async with self.queue_lock:
+                now = asyncio.get_event_loop().time()
                 if self.queue:
-                    longest_wait = asyncio.get_event_loop().time() - self.queue[0]["time"]
+                    longest_wait = now - self.queue.oldest_time()
                     logger.debug(f"Processing batch of {len(self.queue)} requests, longest wait: {longest_wait}")
                 else:
                     longest_wait = None
-                input_batch = self.queue[: self.max_batch_size]
-                del self.queue[: self.max_batch_size]
+                input_batch = self.shed_expired(self.queue.pop_batch(self.max_batch_size, now=now), now)
                 self.schedule_processing_if_needed()
 
+            for task in input_batch:
+                QUEUE_WAIT.observe(now - task["time"])
+                for trace in task["traces"]:
+                    trace.add_span("queue", task["time"], now)
+
+            if not input_batch:
+                continue
+
+            if self.admission is not None:
+                self.admission.batch_started(now)
+
+            replica = self.registry.pool(input_batch[0]["model"]).acquire()
+            asyncio.ensure_future(self.process_batch(replica, input_batch))
+
+    async def process_batch(self, replica: PipelineReplica, input_batch: List[dict]) -> None:
+        """
+        Run a batch on a replica, then release the replica.
+
+        Args:
+            replica (PipelineReplica): The replica acquired for the batch.
+            input_batch (List[dict]): The tasks of the batch.
+        """
+        duration = None
+        try:
+            input_names = TASK_INPUT_MAPPING[input_batch[0]["task"]]
+            batch = {input_name: [inp[input_name] for inp in input_batch] for input_name in input_names}
+            # Every task of a batch comes from the same bucket, so they share the same task and parameters.
+            parameters = {**input_batch[0]["parameters"], "task": input_batch[0]["task"]}
+            if "image_hash" in input_batch[0]:
+                parameters["image_hashes"] = [task["image_hash"] for task in input_batch]
+            batch_size = len(input_batch)
+
+            start = time.perf_counter()
+            if isinstance(replica, WorkerReplica):
+                # Generators and callbacks don't cross the process boundary, the worker seeds its own generators.
+                images = await replica.submit(batch, parameters, seeds=[task["seed"] for task in input_batch])
+            else:
+                # The pipeline samples with the list itself, it is kept in sync with the tasks when some are dropped.
+                generators = [task["generator"] for task in input_batch]
+                parameters.update(self.step_callbacks(input_batch, generators))
+                parameters["generator"] = generators
+                images = await self.inference(replica, n_samples=1, **batch, **parameters)
+            duration = time.perf_counter() - start
+            replica.record(batch_size, duration)
+            self.request_time = duration / batch_size
+            self.batch_stats["batches"] += 1
+            self.batch_stats["images"] += batch_size
+            self.batch_stats["capacity"] += self.max_batch_size
+            BATCH_SIZE.labels(replica.model).observe(batch_size)
+            INFERENCE_TIME.labels(replica.model).observe(duration)
+            IMAGES.labels(replica.model).inc(batch_size)
+            end = asyncio.get_event_loop().time()
+            for task in input_batch:
+                for trace in task["traces"]:
+                    trace.add_span(
+                        "inference",
+                        end - duration,
+                        end,
+                        batch_size=batch_size,
+                        device=replica.device,
+                        model=replica.model,
+                    )
+            if self.controller is not None:
+                self.apply_batching_decision(*self.controller.record_batch(batch_size, duration))
+
+            for task, pixels in zip(input_batch, images):
+                task["result"] = GeneratedImage(pixels)
+                task["done_event"].set()
+            del batch, images
+
+        except Exception as e:
+            logger.error(e)
+            GENERATION_FAILURES.inc()
+            for task in input_batch:
+                if not task["done_event"].is_set():
+                    task["result"] = ValueError(f"Generation failed: {e}")
+                    task["done_event"].set()
+
+        finally:
+            if self.admission is not None:
+                # Every started batch ends, even a failed one, or its replica would look busy forever.
+                self.admission.batch_finished(duration)
+            self.registry.pool(input_batch[0]["model"]).release(replica)
+            async with self.queue_lock:
+                self.schedule_processing_if_needed()
+
+    async def continuous_runner(self):
+        """Process the queue with iteration-level batching: one denoising step of the running batch at a time."""
+        loop = asyncio.get_event_loop()
+        while True:
+            if not len(self.engine):
+                await self.needs_processing.wait()
+            self.needs_processing.clear()
+
+            async with self.queue_lock:
+                now = loop.time()
+                running = len(self.engine)
+                for request in [request for request in self.engine.running if request.task.get("cancelled")]:
+                    self.engine.remove(request.task)
+                    request.task["result"] = None
+                    request.task["done_event"].set()
+                    self.record_cancelled_steps(
+                        1, len(request.timesteps) - request.step_index, self.engine.step_time, running
+                    )
+
+                new_tasks = []
+                while len(self.queue) and len(self.engine) + len(new_tasks) < self.max_batch_size:
+                    new_tasks.extend(
+                        self.shed_expired(
+                            self.queue.pop_batch(self.max_batch_size - len(self.engine) - len(new_tasks), now=now),
+                            now,
+                        )
+                    )
+                for task in new_tasks:
+                    task["start"] = now
+                    QUEUE_WAIT.observe(now - task["time"])
+                    for trace in task["traces"]:
+                        trace.add_span("queue", task["time"], now)
+
+            if new_tasks:
+                logger.debug(f"{len(new_tasks)} requests joining a running batch of {len(self.engine)} requests")
+
             try:
-                batch = {input_name: [inp[input_name] for inp in input_batch] for input_name in self.input_names}
-                results = await asyncio.get_event_loop().run_in_executor(
-                    None, functools.partial(self.inference, n_samples=1, **batch)
-                )
+                finished = await loop.run_in_executor(None, functools.partial(self.engine.iterate, new_tasks))
+                if len(self.engine) or finished:
+                    self.request_time = self.engine.step_time / (len(self.engine) + len(finished)) * self.n_steps
 
-                for task, result in zip(input_batch, results.images):
-                    task["result"] = result
+                IMAGES.labels(self.model).inc(len(finished))
+                for task, pixels in finished:
+                    task["result"] = GeneratedImage(pixels)
                     task["done_event"].set()
-                del batch, results
+                    for trace in task["traces"]:
+                        trace.add_span(
+                            "inference", task["start"], loop.time(), device=self.devices[0], model=self.model
+                        )
+                    if self.admission is not None:
+                        # In continuous mode, the time spent in the running batch plays the role of the batch latency.
+                        self.admission.batch_finished(loop.time() - task["start"])
 
             except Exception as e:
                 logger.error(e)
+                GENERATION_FAILURES.inc()
+                # The running batch is in an unknown state, release every request it holds.
+                for task in new_tasks + [request.task for request in self.engine.running]:
+                    if not task["done_event"].is_set():
+                        task["result"] = ValueError(f"Generation failed: {e}")
+                        task["done_event"].set()
+                self.engine.running = []
+
+    async def run_stage(self, replica: PipelineReplica, stage: str, function, *args, **kwargs):
+        """Run a stage of a batch on its thread of the replica, and record its busy time."""
+
+        def timed():
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            return result, time.perf_counter() - start
 
-    def inference(self, n_samples: int = 1, **kwargs) -> Image.Image:
+        result, duration = await asyncio.get_event_loop().run_in_executor(replica.stage_executor(stage), timed)
+        replica.record_stage(stage, duration)
+        STAGE_BUSY.labels(replica.device, stage).inc(duration)
+
+        return result
+
+    async def inference(
+        self,
+        replica: PipelineReplica,
+        n_samples: int = 1,
+        num_inference_steps: Optional[int] = None,
+        image_hashes: Optional[List[str]] = None,
+        task: Optional[str] = None,
+        **kwargs,
+    ) -> np.ndarray:
         """
-        Inference on the given inputs.
+        Inference on the given inputs, through the stages of the replica.
+
+        Each stage runs on its own thread of the replica, so with pipelining the stages of the batches
+        running on the replica overlap. The pixels are built in the `finish` stage, off the event loop.
+        The PIL images are left to the encoder, see GeneratedImage.
 
         Args:
+            replica (PipelineReplica): The replica to run the inference on.
             n_samples (int): The number of samples to generate.
-            **kwargs: The inputs to the task. Must match the task input names. Can be a batch.
+            num_inference_steps (Optional[int]): The number of denoising steps. Defaults to n_steps.
+            image_hashes (Optional[List[str]]): The content hashes of the source images. When set, and the latents
+                cache is enabled, the cached latents are fed to the pipeline instead of the images.
+            task (Optional[str]): The task of the batch. Defaults to the task of the main pipeline.
+            **kwargs: The inputs and parameters of the task. The inputs must match the task input names
+                and can be a batch.
 
         Returns:
-            Image.Image: The generated image as a PIL image.
+            np.ndarray: The (B, H, W, 3) uint8 pixels of the generated images, post-processed for the whole batch
+                at once.
         """
-        with autocast("cuda"):
-            return self.pipeline(
-                **kwargs,
-                num_images_per_prompt=n_samples,
-                num_inference_steps=self.n_steps,
-            )
+        kwargs = await self.run_stage(
+            replica,
+            "prepare",
+            replica.prepare,
+            task=task,
+            image_hashes=image_hashes,
+            **kwargs,
+            num_images_per_prompt=n_samples,
+            num_inference_steps=num_inference_steps or self.n_steps,
+        )
+        images, latent = await self.run_stage(replica, "denoise", replica.denoise, task=task, **kwargs)
+
+        return await self.run_stage(replica, "finish", replica.finish, images, latent=latent, task=task)
@@ -0,0 +1,243 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import threading
+from typing import Any, Callable, List, Optional, Tuple, Union
+
+import torch
+from cache import MemoryCache, make_cache_key
+from diffusers.pipelines import DiffusionPipeline
+from diffusers.utils.torch_utils import randn_tensor
+from PIL import Image
+
+
+def tensor_size(tensor: torch.Tensor) -> int:
+    """Return the size of a tensor, in bytes."""
+    return tensor.element_size() * tensor.nelement()
+
+
+class EncoderCache:
+    """
+    LRU cache in front of an encoder, bounded by the size of the cached tensors.
+
+    Each item is identified by a string (a text, a content hash...) and cached under its model
+    and identifier. The items missing from the cache are encoded together, in a single call to
+    the encoder, then the cached and freshly encoded tensors are stacked in the order of the batch.
+    """
+
+    def __init__(
+        self,
+        encode: Callable[[List[Any]], torch.Tensor],
+        model: str,
+        max_bytes: int,
+        dtype: Optional[torch.dtype] = None,
+    ) -> None:
+        """
+        Initialize the cache.
+
+        Args:
+            encode (Callable[[List[Any]], torch.Tensor]): Encodes a list of items into a batch of tensors.
+            model (str): The name of the model, part of the cache keys.
+            max_bytes (int): The maximum total size of the cached tensors.
+            dtype (Optional[torch.dtype]): The dtype the tensors are stored in. Defaults to the encoder dtype.
+        """
+        self.encode = encode
+        self.model = model
+        self.dtype = dtype
+        self.cache = MemoryCache(max_bytes, sizeof=tensor_size)
+        self.hits = 0
+        self.misses = 0
+        # The cache is used from the inference threads
+        self.lock = threading.Lock()
+
+    def key(self, identifier: str) -> str:
+        return make_cache_key(model=self.model, identifier=identifier)
+
+    def lookup(self, items: List[Any], identifiers: List[str]) -> torch.Tensor:
+        """
+        Return the encoded items, encoding only the ones missing from the cache.
+
+        Args:
+            items (List[Any]): The items to encode.
+            identifiers (List[str]): The identifiers of the items. Items with the same identifier are
+                encoded once.
+
+        Returns:
+            torch.Tensor: The encoded items, stacked along the first dimension.
+        """
+        with self.lock:
+            encoded = {identifier: self.cache.get(self.key(identifier)) for identifier in identifiers}
+            missing = {identifier: item for item, identifier in zip(items, identifiers) if encoded[identifier] is None}
+            misses = sum(1 for identifier in identifiers if encoded[identifier] is None)
+            self.hits += len(identifiers) - misses
+            self.misses += misses
+
+            if missing:
+                # Without autograd, the cached tensors would keep the graph of the encoder alive
+                with torch.inference_mode():
+                    batch = self.encode(list(missing.values()))
+                for identifier, tensor in zip(missing, batch):
+                    # A copy, so the cached row doesn't keep the storage of the whole batch alive
+                    tensor = tensor.unsqueeze(0).to(dtype=self.dtype or tensor.dtype, copy=True)
+                    encoded[identifier] = tensor
+                    self.cache.put(self.key(identifier), tensor)
+
+            return torch.cat([encoded[identifier] for identifier in identifiers])
+
+    def clear(self) -> None:
+        """Drop every cached tensor, e.g. to free the device memory they take."""
+        with self.lock:
+            self.cache.clear()
+
+    def stats(self) -> dict:
+        """Export the cache statistics."""
+        lookups = self.hits + self.misses
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self.cache),
+            "bytes": self.cache.bytes,
+            "evictions": self.cache.evictions,
+        }
+
+
+class PromptEmbeddingCache(EncoderCache):
+    """
+    Cache of prompt embeddings in front of the text encoder.
+
+    The embeddings are keyed by model and text. Prompts and negative prompts are encoded the same
+    way, so the empty negative prompt shared by all the requests is stored only once. Repeated or
+    templated prompts skip the text encoder completely.
+    """
+
+    @classmethod
+    def from_pipeline(
+        cls, pipeline: DiffusionPipeline, model: str, max_bytes: int, device: str = "cuda:0"
+    ) -> "PromptEmbeddingCache":
+        """
+        Build the cache in front of the text encoder of a loaded pipeline.
+
+        Args:
+            pipeline (DiffusionPipeline): The pipeline whose text encoder is cached.
+            model (str): The name of the model, part of the cache keys.
+            max_bytes (int): The maximum total size of the cached embeddings.
+            device (str): The device the pipeline lives on.
+
+        Returns:
+            PromptEmbeddingCache: The cache, storing the embeddings in the pipeline dtype.
+        """
+
+        def encode(texts: List[str]) -> torch.Tensor:
+            if hasattr(pipeline, "encode_prompt"):
+                embeds, _ = pipeline.encode_prompt(texts, device, 1, False)
+            else:
+                embeds = pipeline._encode_prompt(texts, device, 1, False)
+
+            return embeds
+
+        return cls(encode, model, max_bytes, dtype=pipeline.text_encoder.dtype)
+
+    def __call__(
+        self, prompts: List[str], negative_prompts: Optional[List[str]] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Return the conditional and unconditional embeddings of a batch of prompts.
+
+        Args:
+            prompts (List[str]): The prompts of the batch.
+            negative_prompts (Optional[List[str]]): The negative prompts of the batch. Defaults to empty prompts.
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor]: The prompt and negative prompt embeddings.
+        """
+        negative_prompts = negative_prompts if negative_prompts is not None else [""] * len(prompts)
+        texts = list(prompts) + list(negative_prompts)
+        embeds = self.lookup(texts, texts)
+
+        return embeds[: len(prompts)], embeds[len(prompts) :]
+
+
+class LatentCache(EncoderCache):
+    """
+    Content-addressed cache of the VAE latents of source images, in front of the VAE encoder.
+
+    The latents are keyed by model and by the hash of the decoded pixels, so the same source image
+    reused with different prompts is preprocessed and encoded only once. The cache stores the mean
+    and standard deviation of the latent distribution, and the latents are sampled from them with the
+    generators of the requests, like the image to image pipeline does, so a seeded request gets the
+    same image with or without the cache. The sampled latents are scaled for the UNet, which the
+    pipeline accepts in place of the image.
+    """
+
+    def __init__(
+        self,
+        encode: Callable[[List[Any]], torch.Tensor],
+        model: str,
+        max_bytes: int,
+        dtype: Optional[torch.dtype] = None,
+        scaling_factor: float = 0.18215,
+    ) -> None:
+        """
+        Initialize the cache.
+
+        Args:
+            encode (Callable[[List[Any]], torch.Tensor]): Encodes a list of images into their latent distribution,
+                the mean and standard deviation concatenated along the channels.
+            model (str): The name of the model, part of the cache keys.
+            max_bytes (int): The maximum total size of the cached distributions.
+            dtype (Optional[torch.dtype]): The dtype the distributions are stored in. Defaults to the encoder dtype.
+            scaling_factor (float): The scaling factor of the VAE latents.
+        """
+        super().__init__(encode, model, max_bytes, dtype=dtype)
+        self.scaling_factor = scaling_factor
+
+    @classmethod
+    def from_pipeline(
+        cls, pipeline: DiffusionPipeline, model: str, max_bytes: int, device: str = "cuda:0"
+    ) -> "LatentCache":
+        """
+        Build the cache in front of the VAE encoder of a loaded pipeline.
+
+        Args:
+            pipeline (DiffusionPipeline): The pipeline whose VAE encoder is cached.
+            model (str): The name of the model, part of the cache keys.
+            max_bytes (int): The maximum total size of the cached distributions.
+            device (str): The device the pipeline lives on.
+
+        Returns:
+            LatentCache: The cache, storing the distributions in the pipeline dtype.
+        """
+
+        def encode(images: List[Image.Image]) -> torch.Tensor:
+            pixels = pipeline.image_processor.preprocess(images).to(device=device, dtype=pipeline.vae.dtype)
+            latent_dist = pipeline.vae.encode(pixels).latent_dist
+
+            return torch.cat([latent_dist.mean, latent_dist.std], dim=1)
+
+        scaling_factor = getattr(pipeline.vae.config, "scaling_factor", 0.18215)
+
+        return cls(encode, model, max_bytes, dtype=pipeline.vae.dtype, scaling_factor=scaling_factor)
+
+    def __call__(
+        self,
+        images: List[Image.Image],
+        image_hashes: List[str],
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
+    ) -> torch.Tensor:
+        """
+        Return the latents of a batch of source images.
+
+        Args:
+            images (List[Image.Image]): The source images of the batch.
+            image_hashes (List[str]): The content hashes of the images.
+            generator (Optional[Union[torch.Generator, List[torch.Generator]]]): The generator of the batch, or one
+                per image, the latents are sampled with. They draw the same noise as the VAE encoder of the pipeline.
+
+        Returns:
+            torch.Tensor: The latents of the images.
+        """
+        mean, std = self.lookup(images, image_hashes).chunk(2, dim=1)
+        noise = randn_tensor(mean.shape, generator=generator, device=mean.device, dtype=mean.dtype)
+
+        return (mean + std * noise) * self.scaling_factor
@@ -0,0 +1,143 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import asyncio
+import io
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple, Union
+
+from metrics import ENCODE_TIME, ENCODED_BYTES
+from PIL import Image
+from postprocessing import GeneratedImage
+
+
+# Output format -> (PIL format, media type, file extension)
+IMAGE_FORMATS = OrderedDict(
+    [
+        ("png", ("PNG", "image/png", "png")),
+        ("jpeg", ("JPEG", "image/jpeg", "jpg")),
+        ("webp", ("WEBP", "image/webp", "webp")),
+    ]
+)
+MEDIA_TYPES = {media_type: name for name, (_, media_type, _) in IMAGE_FORMATS.items()}
+
+
+def negotiate_format(requested: Optional[str], accept: Optional[str], default: str = "png") -> str:
+    """
+    Pick the output format of a request.
+
+    Args:
+        requested (Optional[str]): The format set in the request body, which wins when set.
+        accept (Optional[str]): The `Accept` header of the request, e.g. "image/webp,image/*;q=0.8".
+        default (str): The format used when the client accepts any image format.
+
+    Returns:
+        str: One of IMAGE_FORMATS.
+    """
+    if requested is not None:
+        return requested
+
+    if not accept:
+        return default
+
+    ranges = []
+    for position, item in enumerate(accept.split(",")):
+        media_type, *params = [part.strip() for part in item.split(";")]
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            # The most preferred first, then the first listed
+            ranges.append((-quality, position, media_type.lower()))
+
+    for _, _, media_type in sorted(ranges):
+        if media_type in MEDIA_TYPES:
+            return MEDIA_TYPES[media_type]
+        if media_type in ("image/*", "*/*"):
+            return default
+
+    return default
+
+
+class ImageEncoder:
+    """
+    Encodes the generated images on a pool of threads, away from the event loop.
+
+    Pillow releases the GIL while it compresses, so the images of a batch, whose requests all wake up
+    at once, are encoded in parallel and the event loop keeps serving meanwhile.
+    """
+
+    def __init__(self, max_workers: int = 4, quality: int = 90) -> None:
+        """
+        Initialize the encoder.
+
+        Args:
+            max_workers (int): The number of encoding threads.
+            quality (int): The default quality, from 1 to 100, of the lossy formats (JPEG and WebP).
+        """
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image-encoder")
+        self.quality = quality
+        self.stats_by_format: Dict[str, Dict[str, float]] = {
+            name: {"images": 0, "bytes": 0, "seconds": 0.0} for name in IMAGE_FORMATS
+        }
+
+    @staticmethod
+    def encode_sync(image: Union[Image.Image, GeneratedImage], image_format: str, quality: int) -> Tuple[bytes, float]:
+        """Encode an image, returning the bytes and the encoding time. Generated images are built here."""
+        start = time.perf_counter()
+        pil_format = IMAGE_FORMATS[image_format][0]
+        # Every supported format is written by Pillow, it needs the PIL image.
+        if isinstance(image, GeneratedImage):
+            image = image.to_image()
+        options = {} if pil_format == "PNG" else {"quality": quality}
+        if pil_format == "JPEG" and image.mode != "RGB":
+            image = image.convert("RGB")
+
+        with io.BytesIO() as buffer:
+            image.save(buffer, format=pil_format, **options)
+            return buffer.getvalue(), time.perf_counter() - start
+
+    async def encode(
+        self, image: Union[Image.Image, GeneratedImage], image_format: str = "png", quality: Optional[int] = None
+    ) -> bytes:
+        """
+        Encode an image on the encoding threads.
+
+        Args:
+            image (Union[Image.Image, GeneratedImage]): The image to encode. The PIL image of a generated image is
+                built on the encoding thread.
+            image_format (str): One of IMAGE_FORMATS.
+            quality (Optional[int]): The quality of the lossy formats. Defaults to the encoder quality.
+
+        Returns:
+            bytes: The encoded image.
+        """
+        img_bytes, duration = await asyncio.get_event_loop().run_in_executor(
+            self.executor, self.encode_sync, image, image_format, quality or self.quality
+        )
+
+        # Recorded back on the event loop, like every other metric
+        stats = self.stats_by_format[image_format]
+        stats["images"] += 1
+        stats["bytes"] += len(img_bytes)
+        stats["seconds"] += duration
+        ENCODE_TIME.labels(image_format).observe(duration)
+        ENCODED_BYTES.labels(image_format).observe(len(img_bytes))
+
+        return img_bytes
+
+    def stats(self) -> Dict[str, dict]:
+        """Export the number of images, mean size and mean encoding time of each format."""
+        return {
+            name: {
+                "images": stats["images"],
+                "bytes_per_image": stats["bytes"] / stats["images"] if stats["images"] else None,
+                "encode_seconds": stats["seconds"] / stats["images"] if stats["images"] else None,
+            }
+            for name, stats in self.stats_by_format.items()
+        }
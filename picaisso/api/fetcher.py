@@ -0,0 +1,211 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import asyncio
+import io
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+import aiohttp
+from metrics import DOWNLOAD_BYTES_SAVED, DOWNLOAD_TIME, DOWNLOADED_BYTES
+from PIL import Image
+
+
+# The content types accepted for a source image. Some storages serve any file as a binary stream.
+ACCEPTED_CONTENT_TYPES = ("image/", "application/octet-stream")
+CHUNK_SIZE = 64 * 1024
+
+
+class FetchError(Exception):
+    """Raised when a source image can't be downloaded, or isn't an image."""
+
+
+class ImageFetcher:
+    """
+    Downloads and decodes the source images of the requests.
+
+    The downloads share one connection pool, with a limit per host, so a request to a known host reuses a
+    kept-alive connection. The bodies are streamed and abandoned as soon as they exceed `max_bytes`.
+    The downloaded images are kept in an LRU cache by URL, with their ETag and Last-Modified headers: a
+    cached URL is revalidated with a conditional request, and a 304 answer costs no body at all.
+    The images are decoded on a pool of threads, away from the event loop.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 100,
+        max_connections_per_host: int = 8,
+        max_bytes: int = 20 * 1024 * 1024,
+        timeout: float = 10.0,
+        cache_bytes: int = 64 * 1024 * 1024,
+        decode_workers: int = 2,
+    ) -> None:
+        """
+        Initialize the fetcher. The connection pool is created on the first download, in the event loop.
+
+        Args:
+            max_connections (int): The maximum number of open connections.
+            max_connections_per_host (int): The maximum number of open connections to the same host.
+            max_bytes (int): The maximum size of a source image, in bytes.
+            timeout (float): The maximum time of a download, in seconds.
+            cache_bytes (int): The size of the URL cache. 0 disables the cache.
+            decode_workers (int): The number of decoding threads.
+        """
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.cache_bytes = cache_bytes
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.executor = ThreadPoolExecutor(max_workers=decode_workers, thread_name_prefix="image-decoder")
+
+        # URL -> (body, ETag, Last-Modified)
+        self.cache: "OrderedDict[str, Tuple[bytes, Optional[str], Optional[str]]]" = OrderedDict()
+        self.cached_bytes = 0
+        self.fetch_stats = {
+            "downloads": 0,
+            "revalidated": 0,
+            "failures": 0,
+            "bytes": 0,
+            "bytes_saved": 0,
+            "seconds": 0.0,
+        }
+
+    def get_session(self) -> aiohttp.ClientSession:
+        """Return the shared session, created on first use since it must belong to the running event loop."""
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.max_connections_per_host)
+            self.session = aiohttp.ClientSession(
+                connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+
+        return self.session
+
+    async def close(self) -> None:
+        """Close the connection pool."""
+        if self.session is not None:
+            await self.session.close()
+        self.executor.shutdown(wait=False)
+
+    def cache_put(self, url: str, body: bytes, etag: Optional[str], last_modified: Optional[str]) -> None:
+        """Cache a downloaded image, evicting the least recently used ones. Images without validators are skipped."""
+        if (etag is None and last_modified is None) or len(body) > self.cache_bytes:
+            return
+
+        if url in self.cache:
+            self.cached_bytes -= len(self.cache.pop(url)[0])
+        self.cache[url] = (body, etag, last_modified)
+        self.cached_bytes += len(body)
+
+        while self.cached_bytes > self.cache_bytes:
+            _, (evicted, _, _) = self.cache.popitem(last=False)
+            self.cached_bytes -= len(evicted)
+
+    async def read_body(self, response: aiohttp.ClientResponse) -> bytes:
+        """Stream the body of a response, abandoning it once it exceeds `max_bytes`."""
+        if response.content_length is not None and response.content_length > self.max_bytes:
+            raise FetchError(f"The image is larger than {self.max_bytes} bytes.")
+
+        body = bytearray()
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            body.extend(chunk)
+            if len(body) > self.max_bytes:
+                raise FetchError(f"The image is larger than {self.max_bytes} bytes.")
+
+        return bytes(body)
+
+    async def fetch(self, url: str) -> bytes:
+        """
+        Download an image, or revalidate its cached copy.
+
+        Args:
+            url (str): The image url.
+
+        Returns:
+            bytes: The image bytes.
+
+        Raises:
+            FetchError: If the download fails, times out, is too large or isn't an image.
+        """
+        start = time.perf_counter()
+        cached = self.cache.get(url) if self.cache_bytes else None
+        headers = {}
+        if cached is not None:
+            _, etag, last_modified = cached
+            if etag is not None:
+                headers["If-None-Match"] = etag
+            if last_modified is not None:
+                headers["If-Modified-Since"] = last_modified
+
+        try:
+            async with self.get_session().get(url, headers=headers) as response:
+                revalidated = response.status == 304 and cached is not None
+                if revalidated:
+                    self.cache.move_to_end(url)
+                    body, saved = cached[0], len(cached[0])
+                else:
+                    if response.status >= 400:
+                        raise FetchError(f"The image url answered with status {response.status}.")
+                    if not response.content_type.startswith(ACCEPTED_CONTENT_TYPES):
+                        raise FetchError(f"The image url returned {response.content_type}, not an image.")
+
+                    body, saved = await self.read_body(response), 0
+                    if self.cache_bytes and "no-store" not in response.headers.get("Cache-Control", ""):
+                        self.cache_put(url, body, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+
+        except FetchError:
+            self.fetch_stats["failures"] += 1
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            self.fetch_stats["failures"] += 1
+            raise FetchError(f"Could not download the image: {type(e).__name__}: {e}".rstrip(": ")) from e
+
+        duration = time.perf_counter() - start
+        self.fetch_stats["downloads"] += 1
+        self.fetch_stats["revalidated"] += revalidated
+        self.fetch_stats["bytes"] += len(body) - saved
+        self.fetch_stats["bytes_saved"] += saved
+        self.fetch_stats["seconds"] += duration
+        DOWNLOAD_TIME.observe(duration)
+        DOWNLOADED_BYTES.inc(len(body) - saved)
+        DOWNLOAD_BYTES_SAVED.inc(saved)
+
+        return body
+
+    @staticmethod
+    def decode_sync(img_bytes: bytes, size: Optional[Tuple[int, int]] = None) -> Image.Image:
+        """
+        Decode an image to RGB.
+
+        When the image is only needed at a small `size`, JPEG images are decoded at the smallest scale
+        (1/2, 1/4 or 1/8) still larger than it, which skips most of the decoding work. The image keeps
+        its aspect ratio, the caller resizes it.
+        """
+        try:
+            image = Image.open(io.BytesIO(img_bytes))
+            if size is not None:
+                image.draft("RGB", size)
+
+            return image.convert("RGB")
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            raise FetchError(f"Could not decode the image: {e}") from e
+
+    async def decode(self, img_bytes: bytes, size: Optional[Tuple[int, int]] = None) -> Image.Image:
+        """Decode an image on the decoding threads, see `decode_sync`."""
+        return await asyncio.get_event_loop().run_in_executor(self.executor, self.decode_sync, img_bytes, size)
+
+    def stats(self) -> Dict[str, float]:
+        """Export the download statistics and the state of the URL cache."""
+        downloads = self.fetch_stats["downloads"]
+
+        return {
+            "downloads": downloads,
+            "revalidated": self.fetch_stats["revalidated"],
+            "failures": self.fetch_stats["failures"],
+            "downloaded_bytes": self.fetch_stats["bytes"],
+            "bytes_saved": self.fetch_stats["bytes_saved"],
+            "download_seconds": self.fetch_stats["seconds"] / downloads if downloads else None,
+            "cached_images": len(self.cache),
+            "cached_bytes": self.cached_bytes,
+        }
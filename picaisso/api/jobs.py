@@ -0,0 +1,134 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import asyncio
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional
+
+
+class Job:
+    """A generation job submitted through the asynchronous job API."""
+
+    def __init__(self, author: str, webhook: Optional[str] = None) -> None:
+        self.job_id = uuid.uuid4().hex
+        self.author = author
+        self.webhook = webhook
+        self.status = "pending"
+        self.created_at = datetime.utcnow()
+        self.finished_at: Optional[datetime] = None
+        self.finished_time: Optional[float] = None
+        self.error: Optional[str] = None
+        self.result: Optional[bytes] = None
+        self.media_type: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def done(self) -> bool:
+        return self.status != "pending"
+
+    @property
+    def size(self) -> int:
+        return len(self.result) if self.result is not None else 0
+
+    def finish(self, status: str, result: Optional[bytes] = None, media_type: str = None, error: str = None) -> None:
+        """Mark the job as finished with the given status and result or error."""
+        self.status = status
+        self.result = result
+        self.media_type = media_type
+        self.error = error
+        self.finished_at = datetime.utcnow()
+        self.finished_time = time.monotonic()
+
+    def as_dict(self) -> dict:
+        """Export the job status as a dictionary."""
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "author": self.author,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+        }
+
+
+class JobStore:
+    """
+    Bounded in-memory store of the jobs and their results.
+
+    Finished jobs are kept for `ttl` seconds, then evicted. When the results take more than
+    `max_bytes`, or when more than `max_jobs` jobs are stored, the oldest finished jobs are
+    evicted first. Pending jobs are never evicted.
+    """
+
+    def __init__(self, ttl: float = 3600.0, max_bytes: int = 512 * 1024 * 1024, max_jobs: int = 1000) -> None:
+        """
+        Initialize the store.
+
+        Args:
+            ttl (float): How long, in seconds, a finished job is kept.
+            max_bytes (int): The maximum total size of the stored results.
+            max_jobs (int): The maximum number of stored jobs.
+        """
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_jobs = max_jobs
+
+        self.jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self.bytes = 0
+        self.evicted = 0
+
+    def __len__(self) -> int:
+        return len(self.jobs)
+
+    def add(self, job: Job) -> None:
+        """Store a new job."""
+        self.jobs[job.job_id] = job
+        self.evict()
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """Return a job from its id, or None if it is unknown or expired."""
+        self.evict()
+
+        return self.jobs.get(job_id)
+
+    def finished(self, job: Job) -> None:
+        """Account for the result of a finished job and enforce the bounds."""
+        # Finished jobs are evicted in the order they finished.
+        if job.job_id in self.jobs:
+            self.jobs.move_to_end(job.job_id)
+            self.bytes += job.size
+        self.evict()
+
+    def remove(self, job_id: str) -> None:
+        """Remove a job and its result from the store."""
+        job = self.jobs.pop(job_id, None)
+        if job is not None and job.done:
+            self.bytes -= job.size
+
+    def evict(self) -> None:
+        """Evict the expired jobs, then the oldest finished jobs until the store is within its bounds."""
+        now = time.monotonic()
+        for job in [job for job in self.jobs.values() if job.done and now - job.finished_time > self.ttl]:
+            self.remove(job.job_id)
+            self.evicted += 1
+
+        finished = (job for job in list(self.jobs.values()) if job.done)
+        while self.bytes > self.max_bytes or len(self.jobs) > self.max_jobs:
+            job = next(finished, None)
+            if job is None:
+                break
+            self.remove(job.job_id)
+            self.evicted += 1
+
+    def stats(self) -> dict:
+        """Export the store statistics."""
+        pending = sum(1 for job in self.jobs.values() if not job.done)
+
+        return {
+            "jobs": len(self.jobs),
+            "pending": pending,
+            "bytes": self.bytes,
+            "evicted": self.evicted,
+        }
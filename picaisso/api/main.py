@@ -1,22 +1,80 @@
 # Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
 
 import asyncio
-import io
+import base64
+import functools
+import json
+import math
+import time
+from typing import TYPE_CHECKING, List, Optional, Tuple
 
+from admission import AdmissionController, AdmissionRejected, DeadlineExceeded
+from batching import BucketBatcher
+from cache import ResultCache, make_cache_key
+from controller import AdaptiveBatchController
 from dependencies import authenticate_user, get_current_user
-from diffusion_service import DiffusionService
-from fastapi import BackgroundTasks, Depends, FastAPI, HTTPException
+from encoding import IMAGE_FORMATS, ImageEncoder, negotiate_format
+from fastapi import BackgroundTasks, Depends, FastAPI, HTTPException, Request
 from fastapi import status as http_status
-from fastapi.responses import HTMLResponse, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import (
+    HTMLResponse,
+    JSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
 from fastapi.security import OAuth2PasswordRequestForm
+from fetcher import FetchError, ImageFetcher
+from jobs import Job, JobStore
 from loguru import logger
-from models import ArtCreate, StatusTask, Token
+from metrics import (
+    DEVICE_MEMORY,
+    IMAGES_PER_SECOND,
+    QUEUE_DEPTH,
+    REGISTRY,
+    REQUESTS,
+    UPLOAD_LAG,
+    UPLOAD_PENDING,
+)
+from models import (
+    ArtCreate,
+    BatchingStats,
+    CacheStats,
+    EncodingStats,
+    FetcherStats,
+    HealthStatus,
+    JobCreate,
+    JobStatus,
+    ModelStats,
+    QueueStats,
+    ReplicaStats,
+    StatusTask,
+    Token,
+    UploadStats,
+)
 from PIL import Image
-from utils import download_image, upload_image
+from postprocessing import GeneratedImage
+from scheduler import get_scheduler
+from tasks import TASK_IMAGE_SIZE
+from tracing import Trace, Tracer, trace_span
+from uploads import UploadQueue
+from utils import (
+    ClientDisconnected,
+    cancel_on_disconnect,
+    notify_webhook,
+    upload_image,
+)
 
 from config import settings
 
 
+if TYPE_CHECKING:
+    from diffusion_service import DiffusionService
+
+# The startup timings are measured from the import of this module, the first thing the server process does.
+STARTED_AT = time.perf_counter()
+
 app = FastAPI(
     title=settings.project_name,
     version=settings.version,
@@ -24,20 +82,242 @@ app = FastAPI(
     debug=settings.debug,
 )
 
-service = DiffusionService(
-    model_name=settings.model_name,
-    task=settings.task,
-    dtype=settings.model_precision,
-    n_steps=settings.n_steps,
-    max_batch_size=settings.max_batch_size,
-    max_wait=settings.max_wait,
+
+def build_service() -> "DiffusionService":
+    """
+    Load the pipelines and build the diffusion service.
+
+    torch and diffusers are only imported here, so the server binds its port before paying for them.
+    """
+    from diffusion_service import DiffusionService
+
+    return DiffusionService(
+        model_name=settings.model_name,
+        task=settings.task,
+        dtype=settings.model_precision,
+        n_steps=settings.n_steps,
+        max_batch_size=settings.max_batch_size,
+        max_wait=settings.max_wait,
+        scheduler=BucketBatcher(
+            scheduler_factory=functools.partial(
+                get_scheduler, settings.scheduler, aging_interval=settings.scheduler_aging
+            ),
+            max_wait=settings.max_wait,
+        ),
+        batching_mode=settings.batching_mode,
+        pipelining=settings.pipelining,
+        controller=(
+            AdaptiveBatchController(
+                max_batch_size=settings.max_batch_size,
+                max_wait=settings.max_wait,
+                latency_target=settings.latency_target,
+            )
+            if settings.adaptive_batching
+            else None
+        ),
+        admission=AdmissionController(
+            max_queue_size=settings.max_queue_size,
+            default_deadline=settings.default_deadline,
+            parallelism=len(settings.devices),
+        ),
+        preview_every=settings.preview_every,
+        prompt_cache_bytes=settings.prompt_cache_bytes,
+        latent_cache_bytes=settings.latent_cache_bytes,
+        devices=settings.devices,
+        workers=settings.workers,
+        multi_task=settings.multi_task,
+        models=settings.models,
+        model_memory_bytes=settings.model_memory_bytes,
+        model_offload=settings.model_offload,
+        backend=settings.backend,
+        backend_options=(
+            {"step_time": settings.stub_step_time, "image_step_time": settings.stub_image_step_time}
+            if settings.backend == "stub"
+            else None
+        ),
+    )
+
+
+# Set by `load_service` once the pipelines are loaded and the runner started.
+service: Optional["DiffusionService"] = None
+startup = {"listening": None, "ready": None, "error": None}
+
+result_cache = ResultCache(
+    memory_bytes=settings.cache_memory_bytes,
+    disk_path=settings.cache_disk_path,
+    disk_bytes=settings.cache_disk_bytes,
+)
+
+job_store = JobStore(
+    ttl=settings.job_ttl,
+    max_bytes=settings.job_store_max_bytes,
+    max_jobs=settings.job_store_max_jobs,
 )
 
+encoder = ImageEncoder(max_workers=settings.encode_workers, quality=settings.image_quality)
+
+fetcher = ImageFetcher(
+    max_connections=settings.fetch_max_connections,
+    max_connections_per_host=settings.fetch_max_connections_per_host,
+    max_bytes=settings.fetch_max_bytes,
+    timeout=settings.fetch_timeout,
+    cache_bytes=settings.fetch_cache_bytes,
+)
+
+# The generated images are archived to S3 through a spooled upload queue, started with the server.
+uploads = (
+    UploadQueue(
+        bucket_name=settings.bucket_name,
+        region_name=settings.region_name,
+        access_key_id=settings.access_key_id,
+        secret_access_key=settings.secret_access_key,
+        spool_path=settings.upload_spool_path,
+        endpoint_url=settings.endpoint_url,
+        concurrency=settings.upload_concurrency,
+        max_retries=settings.upload_max_retries,
+    )
+    if settings.using_s3
+    else None
+)
+
+tracer = Tracer(
+    sample_rate=settings.trace_sample_rate,
+    export_path=settings.trace_export_path,
+    service_name=settings.project_name,
+)
+
+
+async def load_service() -> None:
+    """Load the pipelines in the background, then start serving them."""
+    global service
+
+    try:
+        loaded = await asyncio.get_event_loop().run_in_executor(None, build_service)
+    except Exception as e:
+        logger.exception(f"Could not load the diffusion service: {e}")
+        startup["error"] = f"{type(e).__name__}: {e}"
+        return
+
+    asyncio.create_task(loaded.runner())
+    # Let the runner set its queue lock up before the first request reaches the service.
+    await asyncio.sleep(0)
+    service = loaded
+
+    startup["ready"] = time.perf_counter() - STARTED_AT
+    logger.info(f"Ready to serve after {startup['ready']:.2f}s")
+
+
+def require_service() -> None:
+    """Reject the requests which need the pipelines while they are still loading."""
+    if service is None:
+        raise HTTPException(
+            status_code=http_status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="The model is still loading, please retry later." if startup["error"] is None else startup["error"],
+            headers={"Retry-After": "5"},
+        )
+
+
+def startup_timings() -> dict:
+    """Return the startup timings, in seconds since the process started."""
+    first_image = None
+    if service is not None and service.first_image_time is not None:
+        first_image = service.first_image_time - STARTED_AT
+
+    return {"listening": startup["listening"], "ready": startup["ready"], "first_image": first_image}
+
+
+def collect_metrics() -> None:
+    """Update the gauges read from the current state of the service, right before they are exported."""
+    if uploads is not None:
+        UPLOAD_PENDING.set(len(uploads.pending))
+        UPLOAD_LAG.set(uploads.oldest_pending() or 0.0)
+
+    if service is None:
+        return
+
+    QUEUE_DEPTH.set(len(service.queue))
+
+    IMAGES_PER_SECOND.clear()
+    for replica in service.registry.replicas():
+        IMAGES_PER_SECOND.labels(replica.model, replica.device).set(replica.throughput)
+
+    DEVICE_MEMORY.clear()
+    for device, memory in service.device_memory().items():
+        for kind, value in memory.items():
+            DEVICE_MEMORY.labels(device, kind).set(value)
+
+
+@app.middleware("http")
+async def count_requests(request: Request, call_next):
+    """Count the requests by route and response status."""
+    try:
+        response = await call_next(request)
+    except Exception:
+        status = 500
+        raise
+    else:
+        status = response.status_code
+    finally:
+        # The router stores the matched endpoint in the scope, its name keeps the label cardinality low.
+        route = getattr(request.scope.get("endpoint"), "__name__", "unmatched")
+        REQUESTS.labels(route, str(status)).inc()
+
+    return response
+
 
 @app.on_event("startup")
 async def startup_event():
     logger.debug("Starting up...")
-    asyncio.create_task(service.runner())
+    # The pipelines load after the port is bound, the liveness and readiness probes answer meanwhile.
+    asyncio.create_task(load_service())
+    if uploads is not None:
+        await uploads.start()
+    startup["listening"] = time.perf_counter() - STARTED_AT
+    logger.info(f"Listening after {startup['listening']:.2f}s, loading the pipelines in the background")
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await fetcher.close()
+    if uploads is not None:
+        await uploads.stop()
+
+
+@app.get(
+    "/health/live",
+    tags=["status"],
+    response_model=HealthStatus,
+    status_code=http_status.HTTP_200_OK,
+)
+async def liveness():
+    """Liveness probe: the server is up, whether the pipelines are loaded or not."""
+    return {"status": "alive", "timings": startup_timings()}
+
+
+@app.get(
+    "/health/ready",
+    tags=["status"],
+    response_model=HealthStatus,
+    status_code=http_status.HTTP_200_OK,
+    responses={http_status.HTTP_503_SERVICE_UNAVAILABLE: {"model": HealthStatus}},
+)
+async def readiness():
+    """Readiness probe: the pipelines are loaded and the requests can be served."""
+    if service is None:
+        status = "failed" if startup["error"] is not None else "loading"
+        content = {"status": status, "detail": startup["error"], "timings": startup_timings()}
+
+        return JSONResponse(status_code=http_status.HTTP_503_SERVICE_UNAVAILABLE, content=content)
+
+    return {"status": "ready", "timings": startup_timings()}
+
+
+@app.get("/metrics", tags=["status"], response_class=PlainTextResponse)
+async def metrics():
+    """Export the serving metrics in the Prometheus text format."""
+    collect_metrics()
+
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
 
 
 @app.get("/", tags=["status"])
@@ -74,54 +354,478 @@ async def health_check():
     tags=["status"],
     response_model=StatusTask,
     status_code=http_status.HTTP_200_OK,
+    dependencies=[Depends(require_service)],
 )
 async def get_task():
-    """Get the current task of the loaded pipeline."""
-    return {"task": service.task}
+    """Get the default task of the loaded pipeline, and every task it serves."""
+    return {"task": service.task, "tasks": service.tasks}
+
+
+@app.get(
+    f"{settings.api_prefix}/stats/queue",
+    tags=["status"],
+    response_model=QueueStats,
+    status_code=http_status.HTTP_200_OK,
+    dependencies=[Depends(require_service)],
+)
+async def get_queue_stats(current_user: str = Depends(get_current_user)):
+    """Get the per-tenant queue-wait statistics of the scheduler."""
+    return {
+        **service.queue.stats(),
+        "admission": service.admission.stats(),
+        "cancellation": service.cancellation_stats,
+        "coalescing": {**service.coalescing_stats, "in_flight": len(service.in_flight)},
+        "jobs": job_store.stats(),
+    }
+
+
+@app.get(
+    f"{settings.api_prefix}/stats/cache",
+    tags=["status"],
+    response_model=CacheStats,
+    status_code=http_status.HTTP_200_OK,
+    dependencies=[Depends(require_service)],
+)
+async def get_cache_stats(current_user: str = Depends(get_current_user)):
+    """Get the hit, miss and eviction statistics of the result, prompt embeddings and latents caches."""
+    return {
+        **result_cache.stats(),
+        "prompt_embeddings": service.registry.cache_stats("prompt_cache"),
+        "latents": service.registry.cache_stats("latent_cache"),
+    }
+
+
+@app.get(
+    f"{settings.api_prefix}/stats/batching",
+    tags=["status"],
+    response_model=BatchingStats,
+    status_code=http_status.HTTP_200_OK,
+    dependencies=[Depends(require_service)],
+)
+async def get_batching_stats(current_user: str = Depends(get_current_user)):
+    """Get the effective batching parameters and the latency model learned by the adaptive controller."""
+    if service.controller is None:
+        return {
+            "adaptive": False,
+            "max_batch_size": service.max_batch_size,
+            "max_wait": service.max_wait,
+            **service.fill_stats(),
+        }
+
+    return {"adaptive": True, **service.controller.state(), **service.fill_stats()}
+
+
+@app.get(
+    f"{settings.api_prefix}/stats/encoding",
+    tags=["status"],
+    response_model=EncodingStats,
+    status_code=http_status.HTTP_200_OK,
+)
+async def get_encoding_stats(current_user: str = Depends(get_current_user)):
+    """Get the number of images, mean size and mean encoding time of each output format."""
+    return {"default_format": settings.output_format, "quality": encoder.quality, "formats": encoder.stats()}
+
+
+@app.get(
+    f"{settings.api_prefix}/stats/fetcher",
+    tags=["status"],
+    response_model=FetcherStats,
+    status_code=http_status.HTTP_200_OK,
+)
+async def get_fetcher_stats(current_user: str = Depends(get_current_user)):
+    """Get the download latency of the source images, and the bytes saved by the URL cache."""
+    return fetcher.stats()
+
+
+@app.get(
+    f"{settings.api_prefix}/stats/uploads",
+    tags=["status"],
+    response_model=UploadStats,
+    status_code=http_status.HTTP_200_OK,
+)
+async def get_uploads_stats(current_user: str = Depends(get_current_user)):
+    """Get the pending, uploaded and failed S3 uploads, and the upload lag."""
+    if uploads is None:
+        raise HTTPException(status_code=http_status.HTTP_404_NOT_FOUND, detail="The S3 storage is not configured.")
+
+    return uploads.stats()
+
+
+@app.get(
+    f"{settings.api_prefix}/stats/replicas",
+    tags=["status"],
+    response_model=List[ReplicaStats],
+    status_code=http_status.HTTP_200_OK,
+    dependencies=[Depends(require_service)],
+)
+async def get_replicas_stats(current_user: str = Depends(get_current_user)):
+    """Get the load and throughput of every pipeline replica, for every loaded model."""
+    return [replica.stats() for replica in service.registry.replicas()]
+
+
+@app.get(
+    f"{settings.api_prefix}/stats/models",
+    tags=["status"],
+    response_model=List[ModelStats],
+    status_code=http_status.HTTP_200_OK,
+    dependencies=[Depends(require_service)],
+)
+async def get_models_stats(current_user: str = Depends(get_current_user)):
+    """Get the residency, load times and usage of every served model."""
+    return service.registry.stats()
+
+
+async def load_source_image(data: ArtCreate, trace: Optional[Trace] = None) -> Optional[Image.Image]:
+    """Download and decode the source image of a request, if any."""
+    if not data.image:
+        return None
+
+    try:
+        with trace_span(trace, "download"):
+            img_bytes = await fetcher.fetch(data.image)
+
+        # The images resized to a small size by their task are decoded at a reduced scale.
+        with trace_span(trace, "decode"):
+            return await fetcher.decode(img_bytes, TASK_IMAGE_SIZE.get(data.task or settings.task))
+    except FetchError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def process_input_kwargs(data: ArtCreate, image: Optional[Image.Image]) -> dict:
+    """Build the `DiffusionService.process_input` arguments of a request."""
+    if not data.prompt and image is None:
+        raise HTTPException(status_code=400, detail="Please provide a prompt or an image URL.")
+    if data.task is not None and data.task not in service.tasks:
+        raise HTTPException(status_code=400, detail=f"The task must be one of {service.tasks}.")
+    if data.model is not None and data.model not in service.registry:
+        raise HTTPException(status_code=400, detail=f"The model must be one of {service.registry.models}.")
+
+    return {
+        "prompt": data.prompt,
+        "image": image,
+        "author": data.author,
+        "priority": data.priority,
+        "num_inference_steps": data.n_steps,
+        "guidance_scale": data.guidance_scale,
+        "height": data.height,
+        "width": data.width,
+        "strength": data.strength,
+        "deadline": data.deadline,
+        "seed": data.seed,
+        "task": data.task,
+        "model": data.model,
+    }
+
+
+def output_format(data: ArtCreate, accept: Optional[str] = None) -> Tuple[str, Optional[int]]:
+    """Return the output format of a request, from its `output_format` or else its `Accept` header, and its quality."""
+    image_format = negotiate_format(data.output_format, accept, default=settings.output_format)
+    quality = None if image_format == "png" else data.quality or settings.image_quality
+
+    return image_format, quality
+
+
+def result_cache_key(data: ArtCreate, kwargs: dict, image_format: str, quality: Optional[int]) -> Optional[str]:
+    """Return the result cache key of a request, or None if its output isn't deterministic (no seed)."""
+    if data.seed is None:
+        return None
+
+    return make_cache_key(generation=service.cache_key(**kwargs), format=image_format, quality=quality)
+
+
+def end_trace(trace: Trace) -> None:
+    """End the root span of a trace and export it."""
+    trace.finish()
+    if tracer.export_path is not None:
+        tracer.export(trace)
+
+
+def finish_trace(trace: Optional[Trace], background_tasks: Optional[BackgroundTasks], headers: dict) -> dict:
+    """
+    Add the Server-Timing header of a request to its response headers, and end and export its trace.
+
+    The trace ends after the background tasks of the request, so its root span covers the upload of the image.
+    Without background tasks, e.g. when the request fails with an HTTPException, which drops them, the trace ends
+    right away and is exported in a thread.
+    """
+    if trace is None:
+        return headers
+
+    headers = {**headers, "Server-Timing": trace.server_timing()}
+    if background_tasks is not None:
+        background_tasks.add_task(end_trace, trace)
+    else:
+        trace.finish()
+        if tracer.export_path is not None:
+            asyncio.get_event_loop().run_in_executor(None, tracer.export, trace)
+
+    return headers
 
 
 @app.post(
     f"{settings.api_prefix}/generate",
     tags=["generate"],
     status_code=http_status.HTTP_200_OK,
+    dependencies=[Depends(require_service)],
 )
 async def generate(
     data: ArtCreate,
+    request: Request,
     background_tasks: BackgroundTasks,
     current_user: str = Depends(get_current_user),  # for authentication purposes
 ):
     """Generate an image from a prompt or an image url, or both."""
-    image = None
-    if data.image:
-        img_bytes = await download_image(data.image)
-        image = Image.open(io.BytesIO(img_bytes)).convert("RGB")
-
-    if data.prompt and image:
-        res = await service.process_input(prompt=data.prompt, image=image)
-    elif data.prompt:
-        res = await service.process_input(prompt=data.prompt)
-    elif image:
-        res = await service.process_input(image=image)
-    else:
-        raise HTTPException(status_code=400, detail="Please provide a prompt or an image URL.")
+    trace = tracer.start("generate", request.headers.get("traceparent"))
+    image = await load_source_image(data, trace)
+    kwargs = process_input_kwargs(data, image)
+    image_format, quality = output_format(data, request.headers.get("accept"))
+    media_type = IMAGE_FORMATS[image_format][1]
+
+    cache_key = result_cache_key(data, kwargs, image_format, quality)
+    if cache_key is not None:
+        with trace_span(trace, "cache"):
+            cached = await result_cache.get(cache_key)
+        if cached is not None:
+            headers = finish_trace(trace, background_tasks, {"X-Seed": str(data.seed), "Vary": "Accept"})
+            return Response(content=cached, media_type=media_type, headers=headers)
+
+    try:
+        # The generation is cancelled if the client gives up, so nobody pays for an image nobody collects.
+        res = await cancel_on_disconnect(request, service.process_input(**kwargs, trace=trace))
+    except ClientDisconnected:
+        logger.debug(f"The client of {data.author} disconnected, its generation was cancelled.")
+        # 499 Client Closed Request, nobody will read it anyway. The response may never be sent, nor its tasks run.
+        return Response(status_code=499, headers=finish_trace(trace, None, {}))
+    except AdmissionRejected as e:
+        headers = finish_trace(trace, None, {"Retry-After": str(max(1, math.ceil(e.retry_after)))})
+        raise HTTPException(status_code=http_status.HTTP_429_TOO_MANY_REQUESTS, detail=e.detail, headers=headers)
+
+    if isinstance(res, DeadlineExceeded):
+        headers = finish_trace(trace, None, {})
+        raise HTTPException(status_code=http_status.HTTP_504_GATEWAY_TIMEOUT, detail=str(res), headers=headers)
 
     if isinstance(res, ValueError):
-        return Response(content=res.args[0], media_type="text/plain")
+        headers = finish_trace(trace, background_tasks, {})
+        return Response(content=res.args[0], media_type="text/plain", headers=headers)
 
-    elif isinstance(res, Image.Image):
-        with io.BytesIO() as buffer:
-            res.save(buffer, format="PNG")
-            img_bytes = buffer.getvalue()
+    elif isinstance(res, GeneratedImage):
+        with trace_span(trace, "encode", format=image_format):
+            img_bytes = await encoder.encode(res, image_format, quality)
+        if cache_key is not None:
+            await result_cache.put(cache_key, img_bytes)
 
-        if settings.using_s3:
-            background_tasks.add_task(upload_image, img_bytes.getvalue())
+        if uploads is not None:
+            background_tasks.add_task(upload_image, uploads, img_bytes, data, image_format=image_format, trace=trace)
 
-        return Response(content=img_bytes, media_type="image/png")
+        headers = finish_trace(trace, background_tasks, {"X-Seed": str(res.info["seed"]), "Vary": "Accept"})
+        return Response(content=img_bytes, media_type=media_type, headers=headers)
 
     else:
         raise ValueError(f"Unknown type {type(res)}")
 
 
+def server_sent_event(event: dict) -> str:
+    """Format an event as a server-sent event."""
+    name = event.pop("event")
+
+    return f"event: {name}\ndata: {json.dumps(event)}\n\n"
+
+
+@app.post(
+    f"{settings.api_prefix}/generate/stream",
+    tags=["generate"],
+    status_code=http_status.HTTP_200_OK,
+    dependencies=[Depends(require_service)],
+)
+async def generate_stream(
+    data: ArtCreate,
+    current_user: str = Depends(get_current_user),  # for authentication purposes
+):
+    """
+    Generate an image and stream the progress as server-sent events.
+
+    A `progress` event is sent after each denoising step, a `preview` event with a low resolution
+    JPEG preview every few steps, then a final `result` event with the image, in its `output_format` (or an `error`
+    event).
+    """
+    image = await load_source_image(data)
+    kwargs = process_input_kwargs(data, image)
+    image_format, quality = output_format(data)
+    media_type = IMAGE_FORMATS[image_format][1]
+    cache_key = result_cache_key(data, kwargs, image_format, quality)
+    cached = await result_cache.get(cache_key) if cache_key is not None else None
+
+    progress = asyncio.Queue()
+    if cached is None:
+        process = asyncio.ensure_future(service.process_input(**kwargs, progress=progress))
+
+    async def events():
+        if cached is not None:
+            result = base64.b64encode(cached).decode()
+            yield server_sent_event(
+                {"event": "result", "seed": data.seed, "image": f"data:{media_type};base64,{result}"}
+            )
+            return
+
+        try:
+            while not process.done() or not progress.empty():
+                getter = asyncio.ensure_future(progress.get())
+                done, _ = await asyncio.wait({getter, process}, return_when=asyncio.FIRST_COMPLETED)
+                if getter in done:
+                    yield server_sent_event(getter.result())
+                else:
+                    getter.cancel()
+
+            try:
+                res = process.result()
+            except AdmissionRejected as e:
+                res = e
+
+            if isinstance(res, GeneratedImage):
+                img_bytes = await encoder.encode(res, image_format, quality)
+                if cache_key is not None:
+                    await result_cache.put(cache_key, img_bytes)
+
+                result = base64.b64encode(img_bytes).decode()
+                yield server_sent_event(
+                    {"event": "result", "seed": res.info["seed"], "image": f"data:{media_type};base64,{result}"}
+                )
+            else:
+                yield server_sent_event({"event": "error", "detail": str(res)})
+
+        finally:
+            # The client went away: cancel the generation nobody will collect.
+            if not process.done():
+                process.cancel()
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+def job_status(job: Job) -> dict:
+    """Build the status response of a job."""
+    result_url = f"{settings.api_prefix}/jobs/{job.job_id}/result" if job.status == "succeeded" else None
+
+    return {**job.as_dict(), "result_url": result_url}
+
+
+async def run_job(job: Job, data: JobCreate) -> None:
+    """Run a job through the same batching path as `/generate`, then store its result and call its webhook."""
+    trace = tracer.start("job")
+    try:
+        image = await load_source_image(data, trace)
+        kwargs = process_input_kwargs(data, image)
+        image_format, quality = output_format(data)
+        media_type = IMAGE_FORMATS[image_format][1]
+        cache_key = result_cache_key(data, kwargs, image_format, quality)
+        cached = await result_cache.get(cache_key) if cache_key is not None else None
+
+        if cached is not None:
+            job.finish("succeeded", result=cached, media_type=media_type)
+        else:
+            res = await service.process_input(**kwargs, trace=trace)
+
+            if isinstance(res, GeneratedImage):
+                with trace_span(trace, "encode", format=image_format):
+                    img_bytes = await encoder.encode(res, image_format, quality)
+                if cache_key is not None:
+                    await result_cache.put(cache_key, img_bytes)
+                job.finish("succeeded", result=img_bytes, media_type=media_type)
+            else:
+                job.finish("failed", error=str(res))
+
+    except asyncio.CancelledError:
+        job.finish("cancelled")
+    except AdmissionRejected as e:
+        job.finish("failed", error=e.detail)
+    except HTTPException as e:
+        job.finish("failed", error=e.detail)
+    except Exception as e:
+        logger.error(f"Job {job.job_id} failed: {e}")
+        job.finish("failed", error=str(e))
+
+    job_store.finished(job)
+
+    if trace is not None:
+        trace.finish()
+        trace.root.attributes.update({"job_id": job.job_id, "status": job.status})
+        if tracer.export_path is not None:
+            await asyncio.get_event_loop().run_in_executor(None, tracer.export, trace)
+
+    if job.webhook:
+        await notify_webhook(job.webhook, jsonable_encoder(job_status(job)))
+
+
+@app.post(
+    f"{settings.api_prefix}/jobs",
+    tags=["jobs"],
+    response_model=JobStatus,
+    status_code=http_status.HTTP_202_ACCEPTED,
+    dependencies=[Depends(require_service)],
+)
+async def submit_job(
+    data: JobCreate,
+    current_user: str = Depends(get_current_user),  # for authentication purposes
+):
+    """Submit a generation job. Returns at once with the job id, poll the job status to collect the image."""
+    job = Job(author=data.author, webhook=data.webhook)
+    job_store.add(job)
+    job.task = asyncio.create_task(run_job(job, data))
+
+    return job_status(job)
+
+
+@app.get(
+    f"{settings.api_prefix}/jobs/{{job_id}}",
+    tags=["jobs"],
+    response_model=JobStatus,
+    status_code=http_status.HTTP_200_OK,
+)
+async def get_job(job_id: str, current_user: str = Depends(get_current_user)):
+    """Get the status of a job."""
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=http_status.HTTP_404_NOT_FOUND, detail="Unknown or expired job.")
+
+    return job_status(job)
+
+
+@app.get(
+    f"{settings.api_prefix}/jobs/{{job_id}}/result",
+    tags=["jobs"],
+    status_code=http_status.HTTP_200_OK,
+)
+async def get_job_result(job_id: str, current_user: str = Depends(get_current_user)):
+    """Get the image generated by a job."""
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=http_status.HTTP_404_NOT_FOUND, detail="Unknown or expired job.")
+
+    if job.status != "succeeded":
+        raise HTTPException(status_code=http_status.HTTP_409_CONFLICT, detail=f"The job is {job.status}.")
+
+    return Response(content=job.result, media_type=job.media_type)
+
+
+@app.delete(
+    f"{settings.api_prefix}/jobs/{{job_id}}",
+    tags=["jobs"],
+    response_model=JobStatus,
+    status_code=http_status.HTTP_200_OK,
+)
+async def cancel_job(job_id: str, current_user: str = Depends(get_current_user)):
+    """Cancel a pending job, or delete the result of a finished one."""
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=http_status.HTTP_404_NOT_FOUND, detail="Unknown or expired job.")
+
+    if not job.done:
+        job.task.cancel()
+        await asyncio.gather(job.task, return_exceptions=True)
+    job_store.remove(job_id)
+
+    return job_status(job)
+
+
 @app.post(
     f"{settings.api_prefix}/auth",
     response_model=Token,
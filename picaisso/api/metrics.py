@@ -0,0 +1,245 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import bisect
+import math
+from typing import Dict, List, Optional, Sequence, Tuple
+
+
+# Latency buckets, in seconds, from a cache hit to a long generation
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+# Encoded image sizes, in bytes, from a small JPEG to a large PNG
+IMAGE_SIZE_BUCKETS = tuple(2**power for power in range(14, 25))
+
+
+def format_value(value: float) -> str:
+    """Format a sample value in the Prometheus text format."""
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+
+    return repr(float(value))
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    """Format the labels of a sample, e.g. `{device="cuda:0"}`."""
+    if not names:
+        return ""
+
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+class Metric:
+    """
+    Base class of the metrics, with their labelled children.
+
+    The metrics are updated from the event loop thread only, so a sample is a plain attribute update,
+    without lock. The child of a label set is created on its first use then reused, so recording a
+    sample allocates nothing.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()) -> None:
+        """
+        Initialize the metric.
+
+        Args:
+            name (str): The name of the metric, e.g. "picaisso_images_total".
+            documentation (str): The help text of the metric.
+            labels (Sequence[str]): The names of the labels. A metric with labels is sampled through `labels`.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.children: Dict[Tuple[str, ...], "Metric"] = {}
+
+    def labels(self, *values: str) -> "Metric":
+        """Return the child of a label set, in the order of the label names."""
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError(f"{self.name} expects the labels {list(self.label_names)}.")
+            child = self.children[values] = self.child()
+
+        return child
+
+    def child(self) -> "Metric":
+        raise NotImplementedError
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        """Return the (suffix, labels, value) samples of the metric itself."""
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        """Forget every labelled child, e.g. before setting a gauge of the current devices."""
+        self.children.clear()
+
+    def render(self) -> List[str]:
+        """Render the metric in the Prometheus text format."""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        series = self.children.items() if self.label_names else [((), self)]
+        for values, metric in series:
+            for suffix, extra, value in metric.samples():
+                labels = format_labels(self.label_names, values)
+                if extra:
+                    labels = f"{labels[:-1]},{extra}}}" if labels else f"{{{extra}}}"
+                lines.append(f"{self.name}{suffix}{labels} {format_value(value)}")
+
+        return lines
+
+
+class Counter(Metric):
+    """A value which only goes up, e.g. a number of requests."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labels)
+        self.value = 0.0
+
+    def child(self) -> "Counter":
+        return Counter(self.name, self.documentation)
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        return [("", "", self.value)]
+
+
+class Gauge(Metric):
+    """A value which goes up and down, e.g. a queue depth."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labels)
+        self.value = 0.0
+
+    def child(self) -> "Gauge":
+        return Gauge(self.name, self.documentation)
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        return [("", "", self.value)]
+
+
+class Histogram(Metric):
+    """The distribution of observed values in cumulative buckets, e.g. latencies."""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # One count per bucket, plus the +Inf one. They are made cumulative when rendered.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def child(self) -> "Histogram":
+        return Histogram(self.name, self.documentation, buckets=self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        samples, cumulative = [], 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            cumulative += count
+            samples.append(("_bucket", f'le="{format_value(bound)}"', cumulative))
+
+        return samples + [("_sum", "", self.sum), ("_count", "", cumulative)]
+
+
+class MetricsRegistry:
+    """The metrics exported by the `/metrics` endpoint."""
+
+    def __init__(self) -> None:
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"The metric {metric.name} is already registered.")
+        self.metrics[metric.name] = metric
+
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Optional[Sequence[float]] = None,
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets=buckets or LATENCY_BUCKETS))
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text exposition format."""
+        return "\n".join(line for metric in self.metrics.values() for line in metric.render()) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+# Serving path
+REQUESTS = REGISTRY.counter(
+    "picaisso_http_requests_total", "HTTP requests by route and response status.", labels=("route", "status")
+)
+QUEUE_DEPTH = REGISTRY.gauge("picaisso_queue_depth", "Requests waiting in the queue.")
+QUEUE_WAIT = REGISTRY.histogram("picaisso_queue_wait_seconds", "Time spent by the requests in the queue.")
+BATCH_SIZE = REGISTRY.histogram(
+    "picaisso_batch_size", "Number of requests of the batches.", labels=("model",), buckets=BATCH_SIZE_BUCKETS
+)
+INFERENCE_TIME = REGISTRY.histogram("picaisso_inference_seconds", "Inference time of the batches.", labels=("model",))
+IMAGES = REGISTRY.counter("picaisso_images_total", "Images generated.", labels=("model",))
+IMAGES_PER_SECOND = REGISTRY.gauge(
+    "picaisso_images_per_second", "Measured inference throughput of each replica.", labels=("model", "device")
+)
+GENERATION_FAILURES = REGISTRY.counter("picaisso_generation_failures_total", "Batches which failed.")
+STAGE_BUSY = REGISTRY.counter(
+    "picaisso_stage_busy_seconds_total",
+    "Busy time of the stages of the replicas, the busiest stage being the bottleneck.",
+    labels=("device", "stage"),
+)
+
+# Pre and post processing
+DOWNLOAD_TIME = REGISTRY.histogram("picaisso_download_seconds", "Download time of the source images.")
+DOWNLOADED_BYTES = REGISTRY.counter("picaisso_downloaded_bytes_total", "Bytes downloaded for the source images.")
+DOWNLOAD_BYTES_SAVED = REGISTRY.counter(
+    "picaisso_download_bytes_saved_total", "Bytes of the source images served by the URL cache after a revalidation."
+)
+ENCODE_TIME = REGISTRY.histogram(
+    "picaisso_encode_seconds", "Encoding time of the generated images, by format.", labels=("format",)
+)
+ENCODED_BYTES = REGISTRY.histogram(
+    "picaisso_encoded_bytes", "Size of the encoded images, by format.", labels=("format",), buckets=IMAGE_SIZE_BUCKETS
+)
+
+# Archiving
+UPLOADS = REGISTRY.counter("picaisso_uploads_total", "S3 upload attempts, by outcome.", labels=("status",))
+UPLOAD_PENDING = REGISTRY.gauge("picaisso_uploads_pending", "Images spooled and waiting for their S3 upload.")
+UPLOAD_LAG = REGISTRY.gauge(
+    "picaisso_upload_lag_seconds", "Age of the oldest image waiting for its S3 upload, 0 when none is waiting."
+)
+UPLOAD_TIME = REGISTRY.histogram("picaisso_upload_seconds", "Time from the generation of an image to its upload.")
+
+# Devices
+DEVICE_MEMORY = REGISTRY.gauge(
+    "picaisso_device_memory_bytes", "Memory of the accelerators, by kind.", labels=("device", "kind")
+)
@@ -1,8 +1,11 @@
 # Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
 
-from typing import Optional
+from datetime import datetime
+from typing import Dict, List, Optional, Union
 
-from pydantic import BaseModel
+from encoding import IMAGE_FORMATS
+from pydantic import BaseModel, validator
+from scheduler import PRIORITY_CLASSES
 
 
 class ArtCreate(BaseModel):
@@ -11,6 +14,67 @@ class ArtCreate(BaseModel):
     prompt: Optional[str] = None
     image: Optional[str] = None
     author: str
+    priority: str = "normal"
+    n_steps: Optional[int] = None
+    guidance_scale: Optional[float] = None
+    height: Optional[int] = None
+    width: Optional[int] = None
+    strength: Optional[float] = None
+    deadline: Optional[float] = None
+    seed: Optional[int] = None
+    task: Optional[str] = None
+    model: Optional[str] = None
+    output_format: Optional[str] = None
+    quality: Optional[int] = None
+
+    @validator("n_steps", "guidance_scale", "deadline")
+    def generation_parameters_must_be_positive(cls, value: Optional[Union[int, float]], field: str):
+        """Check that the generation parameters are positive."""
+        if value is not None and value <= 0:
+            raise ValueError(f"{field.name} must be positive.")
+        return value
+
+    @validator("height", "width")
+    def image_size_must_be_multiple_of_8(cls, value: Optional[int], field: str):
+        """Check that the image size is a positive multiple of 8."""
+        if value is not None and (value <= 0 or value % 8 != 0):
+            raise ValueError(f"{field.name} must be a positive multiple of 8.")
+        return value
+
+    @validator("strength")
+    def strength_must_be_between_0_and_1(cls, value: Optional[float]):
+        """Check that the strength is between 0 and 1."""
+        if value is not None and not 0 <= value <= 1:
+            raise ValueError("strength must be between 0 and 1.")
+        return value
+
+    @validator("seed")
+    def seed_must_be_valid(cls, value: Optional[int]):
+        """Check that the seed is a valid 32 bits unsigned integer."""
+        if value is not None and not 0 <= value < 2**32:
+            raise ValueError("seed must be between 0 and 2**32 - 1.")
+        return value
+
+    @validator("priority")
+    def priority_must_be_valid(cls, value: str):
+        """Check that the priority class is valid."""
+        if value not in PRIORITY_CLASSES.keys():
+            raise ValueError(f"priority must be one of {list(PRIORITY_CLASSES.keys())}.")
+        return value
+
+    @validator("output_format")
+    def output_format_must_be_valid(cls, value: Optional[str]):
+        """Check that the output format is supported."""
+        if value is not None and value not in IMAGE_FORMATS.keys():
+            raise ValueError(f"output_format must be one of {list(IMAGE_FORMATS.keys())}.")
+        return value
+
+    @validator("quality")
+    def quality_must_be_between_1_and_100(cls, value: Optional[int]):
+        """Check that the quality of the lossy formats is between 1 and 100."""
+        if value is not None and not 1 <= value <= 100:
+            raise ValueError("quality must be between 1 and 100.")
+        return value
 
     class Config:
         """ArtCreate model config"""
@@ -20,20 +84,77 @@ class ArtCreate(BaseModel):
                 "prompt": "A beautiful image of a cat",
                 "image": "https://cdn.pixabay.com/photo/2017/02/20/18/03/cat-2083492_1280.jpg",
                 "author": "Thomas Chaigneau",
+                "priority": "normal",
             }
         }
 
 
+class JobCreate(ArtCreate):
+    """JobCreate model"""
+
+    webhook: Optional[str] = None
+
+    class Config:
+        """JobCreate model config"""
+
+        schema_extra = {
+            "example": {
+                "prompt": "A beautiful image of a cat",
+                "author": "Thomas Chaigneau",
+                "webhook": "https://example.com/picaisso/webhook",
+            }
+        }
+
+
+class JobStatus(BaseModel):
+    """JobStatus model"""
+
+    job_id: str
+    status: str
+    author: str
+    created_at: datetime
+    finished_at: Optional[datetime] = None
+    error: Optional[str] = None
+    result_url: Optional[str] = None
+
+
 class Image(BaseModel):
     """Image model"""
 
     content: bytes
 
 
+class StartupTimings(BaseModel):
+    """StartupTimings model, in seconds since the process started"""
+
+    listening: Optional[float] = None
+    ready: Optional[float] = None
+    first_image: Optional[float] = None
+
+
+class HealthStatus(BaseModel):
+    """HealthStatus model"""
+
+    status: str
+    detail: Optional[str] = None
+    timings: StartupTimings
+
+    class Config:
+        """HealthStatus model config"""
+
+        schema_extra = {
+            "example": {
+                "status": "ready",
+                "timings": {"listening": 0.8, "ready": 14.2, "first_image": 21.5},
+            }
+        }
+
+
 class StatusTask(BaseModel):
     """StatusTask model"""
 
     task: str
+    tasks: List[str] = []
 
     class Config:
         """StatusTask model config"""
@@ -41,10 +162,188 @@ class StatusTask(BaseModel):
         schema_extra = {
             "example": {
                 "task": "text_to_image",
+                "tasks": ["text_to_image", "image_to_image"],
             }
         }
 
 
+class TenantQueueStats(BaseModel):
+    """TenantQueueStats model"""
+
+    pending: int
+    served: int
+    mean_wait: float
+    p50_wait: float
+    p95_wait: float
+    p99_wait: float
+    max_wait: float
+
+
+class AdmissionStats(BaseModel):
+    """AdmissionStats model"""
+
+    max_queue_size: int
+    batch_time: Optional[float] = None
+    rejected: int
+    shed: int
+
+
+class CancellationStats(BaseModel):
+    """CancellationStats model"""
+
+    cancelled_queued: int
+    cancelled_running: int
+    gpu_seconds_saved: float
+
+
+class CoalescingStats(BaseModel):
+    """CoalescingStats model"""
+
+    in_flight: int
+    coalesced: int
+
+
+class JobStoreStats(BaseModel):
+    """JobStoreStats model"""
+
+    jobs: int
+    pending: int
+    bytes: int
+    evicted: int
+
+
+class QueueStats(BaseModel):
+    """QueueStats model"""
+
+    scheduler: str
+    pending: int
+    buckets: Optional[int] = None
+    tenants: Dict[str, TenantQueueStats]
+    admission: Optional[AdmissionStats] = None
+    cancellation: Optional[CancellationStats] = None
+    coalescing: Optional[CoalescingStats] = None
+    jobs: Optional[JobStoreStats] = None
+
+
+class ReplicaStats(BaseModel):
+    """ReplicaStats model"""
+
+    model: Optional[str] = None
+    device: str
+    running: int
+    batches: int
+    images: int
+    busy_seconds: float
+    images_per_second: float
+    stages: Dict[str, float] = {}
+    ready: Optional[bool] = None
+    restarts: Optional[int] = None
+
+
+class ModelStats(BaseModel):
+    """ModelStats model"""
+
+    model: str
+    state: str
+    bytes: int
+    pending: int
+    requests: int
+    loads: int
+    load_seconds: float
+    last_load_seconds: float
+    evictions: int
+
+
+class BatchSizeModel(BaseModel):
+    """BatchSizeModel model"""
+
+    observations: int
+    mean_time: Optional[float] = None
+    p95_time: Optional[float] = None
+
+
+class BatchingStats(BaseModel):
+    """BatchingStats model"""
+
+    adaptive: bool
+    max_batch_size: int
+    max_wait: float
+    latency_target: Optional[float] = None
+    arrival_rate: Optional[float] = None
+    model: Dict[int, BatchSizeModel] = {}
+    batches: int = 0
+    images: int = 0
+    fill_ratio: Optional[float] = None
+
+
+class EncoderCacheStats(BaseModel):
+    """EncoderCacheStats model"""
+
+    hits: int
+    misses: int
+    hit_rate: float
+    entries: int
+    bytes: int
+    evictions: int
+
+
+class CacheStats(BaseModel):
+    """CacheStats model"""
+
+    memory_hits: int
+    disk_hits: int
+    misses: int
+    hit_rate: float
+    memory_entries: int
+    memory_bytes: int
+    memory_evictions: int
+    disk_entries: int
+    disk_bytes: int
+    disk_evictions: int
+    prompt_embeddings: Optional[EncoderCacheStats] = None
+    latents: Optional[EncoderCacheStats] = None
+
+
+class FormatEncodingStats(BaseModel):
+    """FormatEncodingStats model"""
+
+    images: int
+    bytes_per_image: Optional[float] = None
+    encode_seconds: Optional[float] = None
+
+
+class EncodingStats(BaseModel):
+    """EncodingStats model"""
+
+    default_format: str
+    quality: int
+    formats: Dict[str, FormatEncodingStats]
+
+
+class FetcherStats(BaseModel):
+    """FetcherStats model"""
+
+    downloads: int
+    revalidated: int
+    failures: int
+    downloaded_bytes: int
+    bytes_saved: int
+    download_seconds: Optional[float] = None
+    cached_images: int
+    cached_bytes: int
+
+
+class UploadStats(BaseModel):
+    """UploadStats model"""
+
+    pending: int
+    uploaded: int
+    retries: int
+    failed: int
+    lag_seconds: Optional[float] = None
+    oldest_pending_seconds: Optional[float] = None
+
+
 class Token(BaseModel):
     """Token model"""
 
@@ -0,0 +1,297 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import contextlib
+import inspect
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import ContextManager, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+from diffusers.pipelines import DiffusionPipeline
+from encoders import LatentCache, PromptEmbeddingCache
+from postprocessing import PipelineImages, to_pixels
+from tasks import DEFERRED_DECODE_TASKS
+
+
+# The stages of a batch on a replica, see PipelineReplica.infer
+STAGES = ("prepare", "denoise", "finish")
+
+
+class PipelineReplica:
+    """
+    A pipeline loaded on one device, with its encoder caches and its throughput statistics.
+
+    A batch goes through three stages: `prepare` encodes the prompts and source images through the
+    encoder caches, `denoise` runs the pipeline, and `finish` decodes the latents with the VAE and
+    converts them to 8 bits pixels. Each stage has its own thread, so when several batches run on the
+    replica at once, one batch is prepared while another denoises and a third one is decoded.
+    """
+
+    def __init__(
+        self,
+        pipeline: Optional[DiffusionPipeline],
+        device: str,
+        prompt_cache: Optional[PromptEmbeddingCache] = None,
+        latent_cache: Optional[LatentCache] = None,
+        pipelines: Optional[Dict[str, DiffusionPipeline]] = None,
+        model: Optional[str] = None,
+    ) -> None:
+        """
+        Initialize the replica.
+
+        Args:
+            pipeline (Optional[DiffusionPipeline]): The pipeline, already moved to the device. None when the
+                pipeline lives in another process.
+            device (str): The device the pipeline lives on, e.g. "cuda:1" or "cpu".
+            prompt_cache (Optional[PromptEmbeddingCache]): The prompt embeddings cache of the replica.
+            latent_cache (Optional[LatentCache]): The source image latents cache of the replica.
+            pipelines (Optional[Dict[str, DiffusionPipeline]]): The pipelines of each served task, sharing the
+                components of `pipeline`. Defaults to `pipeline` alone.
+            model (Optional[str]): The name of the model of the pipeline.
+        """
+        self.pipeline = pipeline
+        self.pipelines = pipelines or {}
+        self.device = device
+        self.model = model
+        self.prompt_cache = prompt_cache
+        self.latent_cache = latent_cache
+
+        self.running = 0
+        self.batches = 0
+        self.images = 0
+        self.busy_time = 0.0
+
+        self.stage_executors: Dict[str, ThreadPoolExecutor] = {}
+        self.stage_time = {stage: 0.0 for stage in STAGES}
+        self.created = time.perf_counter()
+
+    def autocast(self) -> ContextManager:
+        """Return the mixed precision context of the device. CPU replicas run in full precision."""
+        if self.device.startswith("cuda"):
+            return torch.autocast("cuda")
+
+        return contextlib.nullcontext()
+
+    @property
+    def throughput(self) -> float:
+        """The measured number of images per second of inference."""
+        return self.images / self.busy_time if self.busy_time else 0.0
+
+    def stage_executor(self, stage: str) -> ThreadPoolExecutor:
+        """Return the thread of a stage, one batch at a time."""
+        if stage not in self.stage_executors:
+            self.stage_executors[stage] = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix=f"{self.device}-{stage}"
+            )
+
+        return self.stage_executors[stage]
+
+    def record_stage(self, stage: str, duration: float) -> None:
+        """Record the time a stage spent on a batch."""
+        self.stage_time[stage] += duration
+
+    def defers_decode(self, task: Optional[str] = None) -> bool:
+        """
+        Whether the pipeline of a task returns its latents, for the `finish` stage to decode them.
+
+        Only the pipelines with the VAE image processor are concerned: their safety checker accepts the
+        decoded tensors, so the `finish` stage applies it exactly like the pipeline would.
+        """
+        # The main pipeline is the first one of the replica, see `load_replica`
+        task = task or next(iter(self.pipelines), None)
+        pipeline = self.pipelines.get(task, self.pipeline)
+
+        return (
+            task in DEFERRED_DECODE_TASKS
+            and hasattr(pipeline, "vae")
+            and hasattr(pipeline, "image_processor")
+            and hasattr(pipeline, "run_safety_checker")
+        )
+
+    def prepare(self, task: Optional[str] = None, image_hashes: Optional[List[str]] = None, **kwargs) -> dict:
+        """
+        Encode the prompts and source images of a batch through the encoder caches.
+
+        Args:
+            task (Optional[str]): The task of the batch. Defaults to the task of the main pipeline.
+            image_hashes (Optional[List[str]]): The content hashes of the source images. When set, and the latents
+                cache is enabled, latents sampled from the cached distributions with the generators of the batch are
+                fed to the pipeline instead of the images.
+            **kwargs: The inputs and parameters of the pipeline.
+
+        Returns:
+            dict: The inputs and parameters of the pipeline, with the encoded prompts and images.
+        """
+        with self.autocast():
+            if self.prompt_cache is not None and "prompt" in kwargs:
+                prompts = kwargs.pop("prompt")
+                prompts = [prompts] if isinstance(prompts, str) else prompts
+                kwargs["prompt_embeds"], kwargs["negative_prompt_embeds"] = self.prompt_cache(prompts)
+
+            if self.latent_cache is not None and image_hashes is not None:
+                kwargs["image"] = self.latent_cache(kwargs["image"], image_hashes, kwargs.get("generator"))
+
+        return kwargs
+
+    def denoise(self, task: Optional[str] = None, **kwargs) -> Tuple[PipelineImages, bool]:
+        """
+        Run the pipeline on a prepared batch.
+
+        Args:
+            task (Optional[str]): The task of the batch. Defaults to the task of the main pipeline.
+            **kwargs: The prepared inputs and parameters of the pipeline.
+
+        Returns:
+            Tuple[PipelineImages, bool]: The output images of the pipeline, and whether they are latents.
+        """
+        pipeline = self.pipelines.get(task, self.pipeline)
+        latent = self.defers_decode(task)
+        # The images are converted by `finish`, for the whole batch at once, instead of one by one by diffusers.
+        if "output_type" in inspect.signature(pipeline.__call__).parameters:
+            kwargs.setdefault("output_type", "latent" if latent else "pt")
+
+        with self.autocast():
+            return pipeline(**kwargs).images, latent
+
+    def finish(self, images: PipelineImages, latent: bool = False, task: Optional[str] = None) -> np.ndarray:
+        """
+        Decode the output of the pipeline into 8 bits pixels.
+
+        Args:
+            images (PipelineImages): The output images of `denoise`.
+            latent (bool): Whether the images are latents, decoded by the VAE and checked by the safety checker.
+            task (Optional[str]): The task of the batch. Defaults to the task of the main pipeline.
+
+        Returns:
+            np.ndarray: The (B, H, W, 3) uint8 pixels of the batch.
+        """
+        if not latent:
+            return to_pixels(images)
+
+        pipeline = self.pipelines.get(task, self.pipeline)
+        with self.autocast(), torch.inference_mode():
+            decoded = pipeline.vae.decode(images / pipeline.vae.config.scaling_factor, return_dict=False)[0]
+            decoded, nsfw = pipeline.run_safety_checker(decoded, self.device, decoded.dtype)
+
+        pixels = to_pixels(decoded, signed=True)
+        # The pipeline leaves the images blanked by the safety checker black, instead of denormalizing them.
+        if nsfw is not None:
+            pixels[np.asarray(nsfw, dtype=bool)] = 0
+
+        return pixels
+
+    def infer(self, task: Optional[str] = None, image_hashes: Optional[List[str]] = None, **kwargs) -> np.ndarray:
+        """
+        Run the three stages of a batch in a row.
+
+        Args:
+            task (Optional[str]): The task of the batch. Defaults to the task of the main pipeline.
+            image_hashes (Optional[List[str]]): The content hashes of the source images, see `prepare`.
+            **kwargs: The inputs and parameters of the pipeline.
+
+        Returns:
+            np.ndarray: The (B, H, W, 3) uint8 pixels of the batch.
+        """
+        images, latent = self.denoise(task=task, **self.prepare(task=task, image_hashes=image_hashes, **kwargs))
+
+        return self.finish(images, latent=latent, task=task)
+
+    def record(self, batch_size: int, duration: float) -> None:
+        """Record a finished batch."""
+        self.batches += 1
+        self.images += batch_size
+        self.busy_time += duration
+
+    def stage_utilization(self) -> Dict[str, float]:
+        """The fraction of the time each stage has been busy since the replica was loaded."""
+        elapsed = time.perf_counter() - self.created
+
+        return {stage: busy / elapsed if elapsed else 0.0 for stage, busy in self.stage_time.items()}
+
+    def stats(self) -> dict:
+        """Export the replica statistics."""
+        return {
+            "model": self.model,
+            "device": self.device,
+            "running": self.running,
+            "batches": self.batches,
+            "images": self.images,
+            "busy_seconds": self.busy_time,
+            "images_per_second": self.throughput,
+            "stages": self.stage_utilization(),
+        }
+
+
+class ReplicaPool:
+    """
+    Pool of pipeline replicas fed by the single queue of the DiffusionService.
+
+    A replica runs at most `max_running` batches at once. Each formed batch is dispatched to the
+    least loaded replica, i.e. the one with the fewest running batches, and among those the one
+    with the best measured throughput. While every replica is busy, no batch is formed, so the
+    pending requests keep filling larger batches. A batch acquiring a replica anyway, e.g. for a
+    model whose replicas are busy while the ones of another model are free, waits on the least
+    loaded replica.
+    """
+
+    def __init__(self, replicas: List[PipelineReplica], max_running: int = 1) -> None:
+        """
+        Initialize the pool.
+
+        Args:
+            replicas (List[PipelineReplica]): The replicas, at least one.
+            max_running (int): The maximum number of batches running at once on a replica.
+        """
+        if not replicas:
+            raise ValueError("The pool needs at least one replica.")
+
+        self.replicas = replicas
+        self.max_running = max_running
+
+    def __len__(self) -> int:
+        return len(self.replicas)
+
+    def available(self) -> bool:
+        """Whether a replica can take a new batch."""
+        return any(replica.running < self.max_running for replica in self.replicas)
+
+    def acquire(self) -> PipelineReplica:
+        """
+        Reserve the least loaded replica for a new batch.
+
+        Returns:
+            PipelineReplica: The replica the batch is dispatched to.
+        """
+        replica = min(self.replicas, key=lambda replica: (replica.running, -replica.throughput))
+        replica.running += 1
+
+        return replica
+
+    def release(self, replica: PipelineReplica) -> None:
+        """Release a replica once its batch is finished."""
+        replica.running -= 1
+
+    def cache_stats(self, name: str) -> Optional[dict]:
+        """
+        Sum the statistics of an encoder cache over the replicas.
+
+        Args:
+            name (str): The attribute name of the cache, "prompt_cache" or "latent_cache".
+
+        Returns:
+            Optional[dict]: The statistics of the cache, or None if the replicas have none.
+        """
+        stats = [getattr(replica, name).stats() for replica in self.replicas if getattr(replica, name) is not None]
+        if not stats:
+            return None
+
+        total = {key: sum(stat[key] for stat in stats) for key in ("hits", "misses", "entries", "bytes", "evictions")}
+        lookups = total["hits"] + total["misses"]
+        total["hit_rate"] = total["hits"] / lookups if lookups else 0.0
+
+        return total
+
+    def stats(self) -> List[dict]:
+        """Export the statistics of every replica."""
+        return [replica.stats() for replica in self.replicas]
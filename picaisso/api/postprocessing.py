@@ -0,0 +1,77 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+from PIL import Image
+
+
+PipelineImages = Union[torch.Tensor, np.ndarray, List[Image.Image]]
+
+
+def to_pixels(images: PipelineImages, signed: bool = False) -> np.ndarray:
+    """
+    Convert the images of a batch to 8 bits pixels, in one vectorized step.
+
+    The tensors returned by the pipelines with `output_type="pt"` are converted on their device, in place,
+    so only the 8 bits pixels are copied to the CPU, instead of the float32 pixels diffusers copies to
+    build its PIL images.
+
+    Args:
+        images (PipelineImages): The images of a batch: a (B, C, H, W) tensor, modified in place, a (B, H, W, C)
+            float array, both in [0, 1], or a list of PIL images of the same size.
+        signed (bool): Whether the tensor is in [-1, 1], like the raw VAE output, instead of [0, 1].
+
+    Returns:
+        np.ndarray: The (B, H, W, 3) uint8 pixels, contiguous.
+    """
+    if isinstance(images, torch.Tensor):
+        # The pipelines return inference tensors, which can only be modified in place in inference mode.
+        with torch.inference_mode():
+            if signed:
+                images = images.add_(1).div_(2)
+            pixels = images.mul_(255).round_().clamp_(0, 255).to(torch.uint8)
+
+            return pixels.permute(0, 2, 3, 1).contiguous().cpu().numpy()
+
+    if isinstance(images, np.ndarray):
+        pixels = (images + 1) * 127.5 if signed else images * 255
+        np.rint(pixels, out=pixels)
+        np.clip(pixels, 0, 255, out=pixels)
+
+        return pixels.astype(np.uint8)
+
+    return np.stack([np.asarray(image.convert("RGB")) for image in images])
+
+
+class GeneratedImage:
+    """
+    A generated image, kept as its 8 bits pixels until it is encoded.
+
+    The PIL image is only built by `to_image`, on the encoding threads, so neither the `finish` stage of the
+    replicas nor the event loop pay for it.
+    """
+
+    def __init__(self, pixels: np.ndarray, info: Optional[dict] = None) -> None:
+        """
+        Initialize the image.
+
+        Args:
+            pixels (np.ndarray): The (H, W, 3) uint8 pixels, e.g. a row of the pixels of a batch.
+            info (Optional[dict]): The metadata of the image, like the seed it was generated with.
+        """
+        self.pixels = pixels
+        self.info = info if info is not None else {}
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        """The (width, height) of the image, like a PIL image."""
+        return self.pixels.shape[1], self.pixels.shape[0]
+
+    def to_image(self) -> Image.Image:
+        """Build the PIL image, with a single copy of the pixels."""
+        image = Image.fromarray(self.pixels)
+        image.info.update(self.info)
+
+        return image
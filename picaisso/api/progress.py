@@ -0,0 +1,98 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import asyncio
+import base64
+import io
+import time
+
+import torch
+from PIL import Image
+
+
+# Linear approximation of the StableDiffusion VAE decoder, mapping the 4 latent channels to RGB.
+LATENT_RGB_FACTORS = torch.tensor(
+    [
+        [0.298, 0.207, 0.208],
+        [0.187, 0.286, 0.173],
+        [-0.158, 0.189, 0.264],
+        [-0.184, -0.271, -0.473],
+    ]
+)
+
+
+def latents_to_preview(latents: torch.Tensor) -> Image.Image:
+    """
+    Decode a single latent into a low resolution preview, without the VAE.
+
+    Args:
+        latents (torch.Tensor): The latents of one image, of shape (1, 4, H, W).
+
+    Returns:
+        Image.Image: The preview, at the latent resolution (1/8 of the image resolution).
+    """
+    factors = LATENT_RGB_FACTORS.to(device=latents.device, dtype=torch.float32)
+    rgb = torch.einsum("chw,cr->hwr", latents[0].float(), factors)
+    rgb = ((rgb + 1) / 2).clamp(0, 1).mul(255).to(torch.uint8).cpu().numpy()
+
+    return Image.fromarray(rgb)
+
+
+class ProgressReporter:
+    """
+    Reports the per-step progress of the tasks subscribed to it, with cheap latent previews.
+
+    A task subscribes by carrying a list of `progress` asyncio.Queue. The reporter is called from
+    the inference thread at every denoising step, and hands the events over to the event loop.
+    Tasks without a queue cost nothing. Previews are only computed every `preview_every` steps,
+    from the latents with a linear approximation instead of the full VAE decode, and are skipped
+    for a task when its previous preview is more recent than `min_interval` seconds.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, preview_every: int = 5, min_interval: float = 0.5) -> None:
+        """
+        Initialize the reporter.
+
+        Args:
+            loop (asyncio.AbstractEventLoop): The event loop the progress queues belong to.
+            preview_every (int): Send a preview every `preview_every` steps. 0 disables the previews.
+            min_interval (float): The minimum time, in seconds, between two previews of the same task.
+        """
+        self.loop = loop
+        self.preview_every = preview_every
+        self.min_interval = min_interval
+
+    def send(self, task: dict, event: dict) -> None:
+        """Hand an event over to the progress queues of a task, from any thread."""
+        for queue in list(task["progress"]):
+            self.loop.call_soon_threadsafe(queue.put_nowait, event)
+
+    def report(self, task: dict, step: int, total_steps: int, latents: torch.Tensor) -> None:
+        """
+        Report that a task finished a denoising step.
+
+        Args:
+            task (dict): The task. Nothing is reported if it has no `progress` queue.
+            step (int): The index of the finished step, starting at 0.
+            total_steps (int): The total number of steps of the task.
+            latents (torch.Tensor): The latents of the task after the step, of shape (1, C, H, W).
+        """
+        if not task.get("progress"):
+            return
+
+        self.send(task, {"event": "progress", "step": step + 1, "total": total_steps})
+
+        if not self.preview_every or (step + 1) % self.preview_every or step + 1 >= total_steps:
+            return
+        if latents.shape[1] != LATENT_RGB_FACTORS.shape[0]:
+            return
+
+        now = time.monotonic()
+        if now - task.get("last_preview", 0.0) < self.min_interval:
+            return
+        task["last_preview"] = now
+
+        with io.BytesIO() as buffer:
+            latents_to_preview(latents).save(buffer, format="JPEG", quality=70)
+            preview = base64.b64encode(buffer.getvalue()).decode()
+
+        self.send(task, {"event": "preview", "step": step + 1, "image": f"data:image/jpeg;base64,{preview}"})
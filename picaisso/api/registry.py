@@ -0,0 +1,295 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import asyncio
+import gc
+import itertools
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+import torch
+from diffusers.pipelines import DiffusionPipeline
+from encoders import tensor_size
+from loguru import logger
+from pool import PipelineReplica, ReplicaPool
+from tasks import OFFLOAD_POLICIES
+
+
+def pipeline_bytes(pipeline: Optional[DiffusionPipeline]) -> int:
+    """Return the size of the weights of a pipeline, in bytes. Tensors shared by several components count once."""
+    if pipeline is None:
+        return 0
+
+    tensors = {}
+    for component in pipeline.components.values():
+        if isinstance(component, torch.nn.Module):
+            for tensor in itertools.chain(component.parameters(), component.buffers()):
+                tensors[id(tensor)] = tensor
+
+    return sum(tensor_size(tensor) for tensor in tensors.values())
+
+
+class ModelEntry:
+    """A model known to the registry, with its replicas when loaded and its residency statistics."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.pool: Optional[ReplicaPool] = None
+        # unloaded -> loading -> resident -> evicting -> offloaded, or back to unloaded when released
+        self.state = "unloaded"
+        self.bytes = 0
+        self.pending = 0
+        # The load or eviction in progress, awaited by the requests of the model
+        self.transition: Optional[asyncio.Future] = None
+
+        self.requests = 0
+        self.loads = 0
+        self.load_seconds = 0.0
+        self.last_load_seconds = 0.0
+        self.evictions = 0
+
+    @property
+    def running(self) -> bool:
+        """Whether a batch of the model is running on one of its replicas."""
+        return self.pool is not None and any(replica.running for replica in self.pool.replicas)
+
+    def stats(self) -> dict:
+        """Export the model statistics."""
+        return {
+            "model": self.name,
+            "state": self.state,
+            "bytes": self.bytes,
+            "pending": self.pending,
+            "requests": self.requests,
+            "loads": self.loads,
+            "load_seconds": self.load_seconds,
+            "last_load_seconds": self.last_load_seconds,
+            "evictions": self.evictions,
+        }
+
+
+class ModelRegistry:
+    """
+    The models served by the DiffusionService, loaded on demand and kept resident on the devices by LRU.
+
+    A request names its model and waits until the model is resident. A cold model is loaded, or moved
+    back from CPU memory, by a dedicated loader thread, so the resident models keep serving meanwhile.
+    When the resident models take more than `max_bytes` on each device, the least recently used ones
+    are evicted: moved to CPU memory with the "cpu" policy, or released with the "release" policy.
+    Models with pending requests or running batches are never evicted, the budget may then be exceeded
+    until they are idle.
+    """
+
+    def __init__(
+        self,
+        models: List[str],
+        load_pool: Callable[[str], ReplicaPool],
+        max_bytes: int = 0,
+        offload: str = "cpu",
+    ) -> None:
+        """
+        Initialize the registry.
+
+        Args:
+            models (List[str]): The names of the models requests can use.
+            load_pool (Callable[[str], ReplicaPool]): Loads the replicas of a model on the devices.
+                It runs in the loader thread.
+            max_bytes (int): The memory budget of the resident models, on each device. 0 means no budget.
+            offload (str): What to do with evicted models, one of OFFLOAD_POLICIES.
+        """
+        if offload not in OFFLOAD_POLICIES:
+            raise ValueError(f"Offload policy {offload} is not supported. Must be one of {list(OFFLOAD_POLICIES)}.")
+
+        self.load_pool = load_pool
+        self.max_bytes = max_bytes
+        self.offload = offload
+        # Ordered from the least to the most recently used
+        self.entries: "OrderedDict[str, ModelEntry]" = OrderedDict((name, ModelEntry(name)) for name in models)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model-loader")
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.entries
+
+    @property
+    def models(self) -> List[str]:
+        return list(self.entries)
+
+    def add(self, name: str, pool: ReplicaPool) -> None:
+        """Register the replicas of a model loaded at startup."""
+        entry = self.entries.setdefault(name, ModelEntry(name))
+        entry.pool = pool
+        entry.state = "resident"
+        entry.bytes = pipeline_bytes(pool.replicas[0].pipeline)
+        entry.loads += 1
+
+    def pool(self, name: str) -> ReplicaPool:
+        """Return the replicas of a resident model."""
+        return self.entries[name].pool
+
+    def replicas(self) -> List[PipelineReplica]:
+        """Return the replicas of every loaded model, resident or offloaded."""
+        return [
+            replica for entry in self.entries.values() if entry.pool is not None for replica in entry.pool.replicas
+        ]
+
+    def cache_stats(self, name: str) -> Optional[dict]:
+        """Sum the statistics of an encoder cache over the replicas of every loaded model, see ReplicaPool."""
+        replicas = self.replicas()
+
+        return ReplicaPool(replicas).cache_stats(name) if replicas else None
+
+    def available(self) -> bool:
+        """Whether a replica of a resident model can take a new batch."""
+        return any(entry.pool.available() for entry in self.entries.values() if entry.state == "resident")
+
+    def resident_bytes(self) -> int:
+        """The size of the resident models, on each device."""
+        return sum(entry.bytes for entry in self.entries.values() if entry.state in ("loading", "resident"))
+
+    async def acquire(self, name: str) -> ReplicaPool:
+        """
+        Wait until a model is resident, loading it if needed, and keep it resident until `release`.
+
+        Args:
+            name (str): The name of the model.
+
+        Returns:
+            ReplicaPool: The replicas of the model.
+
+        Raises:
+            Exception: Whatever the loading of the model raised.
+        """
+        entry = self.entries[name]
+        entry.pending += 1
+        entry.requests += 1
+        self.entries.move_to_end(name)
+
+        try:
+            while entry.state != "resident":
+                if entry.transition is None:
+                    entry.transition = asyncio.ensure_future(self.load(entry))
+                # A waiter giving up doesn't cancel the load, the other waiters still need it.
+                await asyncio.shield(entry.transition)
+        except BaseException:
+            entry.pending -= 1
+            raise
+
+        return entry.pool
+
+    def release(self, name: str) -> None:
+        """Let a model be evicted again, once a request acquired with `acquire` is done."""
+        self.entries[name].pending -= 1
+
+        # The budget was exceeded while the models were busy, evict the ones which became idle.
+        if self.max_bytes and self.resident_bytes() > self.max_bytes:
+            asyncio.ensure_future(self.fit())
+
+    async def load(self, entry: ModelEntry) -> None:
+        """Make a model resident, either from CPU memory or from scratch, then enforce the memory budget."""
+        loop = asyncio.get_event_loop()
+        previous_state = entry.state
+        start = time.perf_counter()
+
+        try:
+            # The size of a model is only known once it was loaded, the budget is enforced again after.
+            await self.fit(keep=entry, incoming=entry.bytes)
+            entry.state = "loading"
+
+            if previous_state == "offloaded":
+                logger.info(f"Moving the model {entry.name} back to its devices")
+                await loop.run_in_executor(self.executor, self.move, entry.pool, None)
+            else:
+                logger.info(f"Loading the model {entry.name}")
+                entry.pool = await loop.run_in_executor(self.executor, self.load_pool, entry.name)
+                entry.bytes = pipeline_bytes(entry.pool.replicas[0].pipeline)
+
+        except BaseException:
+            entry.state = previous_state
+            raise
+
+        else:
+            entry.state = "resident"
+            entry.loads += 1
+            entry.last_load_seconds = time.perf_counter() - start
+            entry.load_seconds += entry.last_load_seconds
+            logger.info(f"The model {entry.name} is resident, loaded in {entry.last_load_seconds:.2f}s")
+            await self.fit(keep=entry)
+
+        finally:
+            entry.transition = None
+
+    async def fit(self, keep: Optional[ModelEntry] = None, incoming: int = 0) -> None:
+        """
+        Evict the least recently used idle models until the resident ones fit in the memory budget.
+
+        Args:
+            keep (Optional[ModelEntry]): The model being loaded, never evicted.
+            incoming (int): The size of the model about to be loaded, if it isn't resident yet.
+        """
+        if not self.max_bytes:
+            return
+
+        for entry in list(self.entries.values()):
+            if self.resident_bytes() + incoming <= self.max_bytes:
+                return
+            if entry is keep or entry.state != "resident" or entry.pending or entry.running:
+                continue
+
+            # Not resident anymore from now on, so no new request picks its replicas up.
+            entry.state = "evicting"
+            entry.transition = asyncio.ensure_future(self.evict(entry))
+            await asyncio.shield(entry.transition)
+
+        if self.resident_bytes() + incoming > self.max_bytes:
+            logger.warning(f"The resident models exceed the memory budget of {self.max_bytes} bytes, they are busy")
+
+    async def evict(self, entry: ModelEntry) -> None:
+        """Move a model to CPU memory, or release it, according to the offload policy."""
+        loop = asyncio.get_event_loop()
+
+        try:
+            if self.offload == "cpu":
+                logger.info(f"Moving the model {entry.name} to CPU memory")
+                await loop.run_in_executor(self.executor, self.move, entry.pool, "cpu")
+                entry.state = "offloaded"
+            else:
+                logger.info(f"Releasing the model {entry.name}")
+                entry.pool = None
+                await loop.run_in_executor(self.executor, self.free_memory)
+                entry.state = "unloaded"
+            entry.evictions += 1
+
+        except BaseException:
+            entry.state = "resident" if entry.pool is not None else "unloaded"
+            raise
+
+        finally:
+            entry.transition = None
+
+    @staticmethod
+    def move(pool: ReplicaPool, device: Optional[str]) -> None:
+        """
+        Move the pipelines of a pool to a device, or back to their own devices when `device` is None.
+
+        The encoder caches of the replicas are cleared when offloading: their tensors live on the devices
+        of the replicas, where they would keep taking the memory the eviction is meant to free.
+        """
+        for replica in pool.replicas:
+            replica.pipeline.to(device or replica.device)
+            if device is not None:
+                for cache in (replica.prompt_cache, replica.latent_cache):
+                    if cache is not None:
+                        cache.clear()
+        ModelRegistry.free_memory()
+
+    @staticmethod
+    def free_memory() -> None:
+        """Give the memory of the released tensors back to the devices."""
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def stats(self) -> List[Dict]:
+        """Export the statistics of every model."""
+        return [entry.stats() for entry in self.entries.values()]
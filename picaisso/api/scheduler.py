@@ -0,0 +1,339 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional
+
+
+PRIORITY_CLASSES = OrderedDict(
+    [
+        ("high", 0),
+        ("normal", 1),
+        ("low", 2),
+    ]
+)
+
+
+class TenantStats:
+    """Rolling queue-wait statistics for a single tenant."""
+
+    def __init__(self, window: int = 1000) -> None:
+        """
+        Initialize the statistics.
+
+        Args:
+            window (int): The number of most recent waits to keep for the percentiles.
+        """
+        self.waits: Deque[float] = deque(maxlen=window)
+        self.served = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait: float) -> None:
+        """Record the queue wait of a served request."""
+        self.waits.append(wait)
+        self.served += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def percentile(self, q: float) -> float:
+        """Return the q-th percentile (0-100) of the recent waits."""
+        if not self.waits:
+            return 0.0
+
+        ordered = sorted(self.waits)
+        index = min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))
+
+        return ordered[index]
+
+    def as_dict(self, pending: int = 0) -> dict:
+        """Export the statistics as a dictionary."""
+        return {
+            "pending": pending,
+            "served": self.served,
+            "mean_wait": self.total_wait / self.served if self.served else 0.0,
+            "p50_wait": self.percentile(50),
+            "p95_wait": self.percentile(95),
+            "p99_wait": self.percentile(99),
+            "max_wait": self.max_wait,
+        }
+
+
+class BaseScheduler:
+    """
+    Base class for the request schedulers used by the DiffusionService.
+
+    A scheduler stores the pending tasks and decides which ones form the next batch.
+    Each task is a dictionary with at least a `time` key (the loop time at which it was queued),
+    and optionally an `author` and a `priority` key.
+    """
+
+    def __init__(self, stats_window: int = 1000) -> None:
+        """
+        Initialize the scheduler.
+
+        Args:
+            stats_window (int): The number of most recent waits kept per tenant for the statistics.
+        """
+        self.stats_window = stats_window
+        self.tenant_stats: Dict[str, TenantStats] = {}
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def push(self, task: dict) -> None:
+        """Add a task to the scheduler."""
+        raise NotImplementedError
+
+    def pop_batch(self, max_size: int, now: Optional[float] = None) -> List[dict]:
+        """Remove and return up to `max_size` tasks forming the next batch."""
+        raise NotImplementedError
+
+    def remove(self, task: dict) -> bool:
+        """Remove a pending task, e.g. when its client gave up. Returns True if the task was pending."""
+        raise NotImplementedError
+
+    def has_full_batch(self, max_size: int) -> bool:
+        """Return True if enough tasks are pending to form a full batch."""
+        return len(self) >= max_size
+
+    def oldest_time(self) -> Optional[float]:
+        """Return the queue time of the oldest pending task, or None if the scheduler is empty."""
+        raise NotImplementedError
+
+    def pending_by_tenant(self) -> Dict[str, int]:
+        """Return the number of pending tasks per tenant."""
+        raise NotImplementedError
+
+    def record_wait(self, task: dict, now: float) -> None:
+        """Record the queue wait of a task leaving the scheduler."""
+        author = task.get("author", "anonymous")
+        if author not in self.tenant_stats:
+            self.tenant_stats[author] = TenantStats(window=self.stats_window)
+
+        self.tenant_stats[author].record(now - task["time"])
+
+    def stats(self) -> dict:
+        """Export the queue-wait statistics of every known tenant."""
+        pending = self.pending_by_tenant()
+        tenants = set(pending) | set(self.tenant_stats)
+
+        return {
+            "scheduler": type(self).__name__,
+            "pending": len(self),
+            "tenants": {
+                tenant: self.tenant_stats.get(tenant, TenantStats(window=1)).as_dict(pending.get(tenant, 0))
+                for tenant in sorted(tenants)
+            },
+        }
+
+
+class FifoScheduler(BaseScheduler):
+    """First in, first out scheduler. Batches are formed from the oldest pending tasks."""
+
+    def __init__(self, stats_window: int = 1000) -> None:
+        super().__init__(stats_window=stats_window)
+        self.queue: Deque[dict] = deque()
+
+    def __len__(self) -> int:
+        return len(self.queue)
+
+    def push(self, task: dict) -> None:
+        self.queue.append(task)
+
+    def pop_batch(self, max_size: int, now: Optional[float] = None) -> List[dict]:
+        now = time.monotonic() if now is None else now
+        batch = []
+        while self.queue and len(batch) < max_size:
+            task = self.queue.popleft()
+            self.record_wait(task, now)
+            batch.append(task)
+
+        return batch
+
+    def remove(self, task: dict) -> bool:
+        for index, pending in enumerate(self.queue):
+            if pending is task:
+                del self.queue[index]
+                return True
+
+        return False
+
+    def oldest_time(self) -> Optional[float]:
+        return self.queue[0]["time"] if self.queue else None
+
+    def pending_by_tenant(self) -> Dict[str, int]:
+        pending: Dict[str, int] = {}
+        for task in self.queue:
+            author = task.get("author", "anonymous")
+            pending[author] = pending.get(author, 0) + 1
+
+        return pending
+
+
+class FairScheduler(BaseScheduler):
+    """
+    Per-tenant fair scheduler with priority classes and aging.
+
+    Each author gets its own FIFO queue. Among the authors whose head task has the best
+    effective priority class, the next task is chosen by deficit round robin (DRR): every
+    author earns `quantum * weight` credits per round and spends `cost` credits per task,
+    so a single heavy author can't starve the others. A batch is filled by repeating this
+    selection, so it is naturally formed from several tenants' queues.
+
+    Aging promotes a waiting task by one priority class every `aging_interval` seconds,
+    so low priority work is never starved by a steady stream of high priority requests.
+    """
+
+    def __init__(
+        self,
+        quantum: float = 1.0,
+        aging_interval: float = 120.0,
+        weights: Optional[Dict[str, float]] = None,
+        stats_window: int = 1000,
+    ) -> None:
+        """
+        Initialize the fair scheduler.
+
+        Args:
+            quantum (float): The credits given to each author per round.
+            aging_interval (float): Seconds of waiting needed to promote a task by one priority class.
+            weights (Optional[Dict[str, float]]): Optional per-author weights, defaults to 1 for everyone.
+            stats_window (int): The number of most recent waits kept per tenant for the statistics.
+
+        Raises:
+            ValueError: If the quantum or a weight is not positive, the author would never earn enough credits.
+        """
+        if quantum <= 0:
+            raise ValueError(f"The quantum must be positive, got {quantum}.")
+        for author, weight in (weights or {}).items():
+            if weight <= 0:
+                raise ValueError(f"The weight of {author} must be positive, got {weight}.")
+
+        super().__init__(stats_window=stats_window)
+        self.quantum = quantum
+        self.aging_interval = aging_interval
+        self.weights = weights or {}
+
+        self.queues: Dict[str, Deque[dict]] = {}
+        self.deficits: Dict[str, float] = {}
+        self.active: Deque[str] = deque()
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def push(self, task: dict) -> None:
+        author = task.get("author", "anonymous")
+        if author not in self.queues:
+            self.queues[author] = deque()
+
+        if not self.queues[author]:
+            self.active.append(author)
+            self.deficits[author] = 0.0
+
+        self.queues[author].append(task)
+        self.size += 1
+
+    def effective_priority(self, task: dict, now: float) -> int:
+        """Return the priority class of a task once aging is applied (lower is better)."""
+        priority = PRIORITY_CLASSES.get(task.get("priority", "normal"), PRIORITY_CLASSES["normal"])
+        if self.aging_interval > 0:
+            priority -= int((now - task["time"]) // self.aging_interval)
+
+        return max(0, priority)
+
+    def _next_author(self, now: float) -> str:
+        """Select the author to serve next with deficit round robin inside the best priority class."""
+        best = min(self.effective_priority(self.queues[author][0], now) for author in self.active)
+
+        while True:
+            author = self.active[0]
+            task = self.queues[author][0]
+
+            if self.effective_priority(task, now) != best:
+                self.active.rotate(-1)
+                continue
+
+            if self.deficits[author] >= task.get("cost", 1):
+                return author
+
+            self.deficits[author] += self.quantum * self.weights.get(author, 1.0)
+            self.active.rotate(-1)
+
+    def pop_batch(self, max_size: int, now: Optional[float] = None) -> List[dict]:
+        now = time.monotonic() if now is None else now
+        batch = []
+        while self.size and len(batch) < max_size:
+            author = self._next_author(now)
+            task = self.queues[author].popleft()
+            self.deficits[author] -= task.get("cost", 1)
+            self.size -= 1
+
+            if not self.queues[author]:
+                # An idle author loses its remaining credits, as in classic DRR.
+                self.active.popleft()
+                self.deficits[author] = 0.0
+            elif self.deficits[author] < self.queues[author][0].get("cost", 1):
+                self.active.rotate(-1)
+
+            self.record_wait(task, now)
+            batch.append(task)
+
+        return batch
+
+    def remove(self, task: dict) -> bool:
+        author = task.get("author", "anonymous")
+        queue = self.queues.get(author)
+        if not queue:
+            return False
+
+        for index, pending in enumerate(queue):
+            if pending is task:
+                del queue[index]
+                self.size -= 1
+                if not queue:
+                    self.active.remove(author)
+                    self.deficits[author] = 0.0
+                return True
+
+        return False
+
+    def oldest_time(self) -> Optional[float]:
+        heads = [self.queues[author][0]["time"] for author in self.active]
+
+        return min(heads) if heads else None
+
+    def pending_by_tenant(self) -> Dict[str, int]:
+        return {author: len(queue) for author, queue in self.queues.items() if queue}
+
+
+SCHEDULER_MAPPING = OrderedDict(
+    [
+        ("fair", FairScheduler),
+        ("fifo", FifoScheduler),
+    ]
+)
+
+
+def get_scheduler(name: str, aging_interval: float = 120.0) -> BaseScheduler:
+    """
+    Build a scheduler from its name.
+
+    Args:
+        name (str): The scheduler name. Must be one of the keys of SCHEDULER_MAPPING.
+        aging_interval (float): Seconds of waiting needed to promote a task by one priority class (fair only).
+
+    Returns:
+        BaseScheduler: The scheduler instance.
+
+    Raises:
+        ValueError: If the scheduler is not supported.
+    """
+    if name not in SCHEDULER_MAPPING:
+        raise ValueError(f"Scheduler {name} is not supported. Must be one of {list(SCHEDULER_MAPPING.keys())}.")
+
+    if name == "fair":
+        return FairScheduler(aging_interval=aging_interval)
+
+    return SCHEDULER_MAPPING[name]()
@@ -0,0 +1,64 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+# The metadata of the tasks and of the serving options. It is kept free of torch and diffusers imports,
+# so the configuration can be validated without loading them.
+
+from collections import OrderedDict
+
+
+TASK_MAPPING = OrderedDict(
+    [
+        ("image_to_image", "StableDiffusionImg2ImgPipeline"),
+        ("image_variation", "StableDiffusionImageVariationPipeline"),
+        ("super_resolution", "StableDiffusionUpscalePipeline"),
+        ("text_to_image", "StableDiffusionPipeline"),
+    ]
+)
+
+TASK_INPUT_MAPPING = OrderedDict(
+    [
+        ("image_to_image", ("image", "prompt")),
+        ("image_variation", ("image",)),
+        ("super_resolution", ("image", "prompt")),
+        ("text_to_image", ("prompt",)),
+    ]
+)
+TASK_PARAMETER_MAPPING = OrderedDict(
+    [
+        ("image_to_image", ("num_inference_steps", "guidance_scale", "strength")),
+        ("image_variation", ("num_inference_steps", "guidance_scale", "height", "width")),
+        ("super_resolution", ("num_inference_steps", "guidance_scale")),
+        ("text_to_image", ("num_inference_steps", "guidance_scale", "height", "width")),
+    ]
+)
+# Tasks whose pipeline exposes the latents and prompt embeddings to the step callback,
+# so cancelled requests can be dropped from the batch at the next step boundary.
+STEP_CALLBACK_TASKS = ("image_to_image", "text_to_image")
+# Groups of tasks whose pipelines can be built from the same components. The image variation UNet is
+# conditioned on CLIP image embeddings and the upscaler UNet on the low resolution pixels, so even with
+# components of the same names and classes, their weights only serve their own task.
+SHARED_COMPONENT_TASKS = (("image_to_image", "text_to_image"),)
+# Tasks which can be served by the iteration-level (continuous) batching engine
+CONTINUOUS_BATCHING_TASKS = ("text_to_image",)
+BATCHING_MODES = ("static", "continuous")
+# Tasks whose pipeline encodes the source image with the VAE, and accepts its latents instead.
+# The upscaler conditions on the pixels of the low resolution image, so it has no latents to cache.
+LATENT_CACHE_TASKS = ("image_to_image",)
+# The size the source image of a task is resized to, when the pipeline expects a fixed one.
+# The source images of these tasks are decoded at a reduced scale, see fetcher.ImageFetcher.decode_sync.
+TASK_IMAGE_SIZE = {"super_resolution": (128, 128)}
+# Tasks whose pipeline can return its latents, so the VAE decode runs in its own pipelining stage.
+# The upscaler decodes with its own VAE scaling, it keeps decoding in the pipeline call.
+DEFERRED_DECODE_TASKS = ("image_to_image", "text_to_image")
+TASK_DEFAULT_MODEL = OrderedDict(
+    [
+        ("image_to_image", "stabilityai/stable-diffusion-2-1-base"),
+        ("image_variation", "lambdalabs/sd-image-variations-diffusers"),
+        ("super_resolution", "stabilityai/stable-diffusion-x4-upscaler"),
+        ("text_to_image", "stabilityai/stable-diffusion-2-1-base"),
+    ]
+)
+# The inference backends building the pipelines, see backends.BACKEND_MAPPING
+BACKENDS = ("diffusers", "tiny", "stub")
+# What to do with the models evicted from the devices by the model registry
+OFFLOAD_POLICIES = ("cpu", "release")
@@ -0,0 +1,199 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import contextlib
+import json
+import random
+import re
+import secrets
+import threading
+import time
+from typing import ContextManager, List, Optional
+
+from loguru import logger
+
+
+# W3C trace context: version-trace_id-parent_id-flags
+TRACEPARENT_PATTERN = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+
+class Span:
+    """One stage of a request, timed with the monotonic clock of the event loop."""
+
+    def __init__(
+        self, name: str, start: float, end: Optional[float] = None, parent_id: Optional[str] = None, **attributes
+    ) -> None:
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.start = start
+        self.end = end
+        self.attributes = attributes
+
+    @property
+    def duration(self) -> float:
+        """The duration of the span, in seconds."""
+        return (self.end if self.end is not None else time.monotonic()) - self.start
+
+
+class Trace:
+    """
+    The stages of a request: a root span covering the whole request, and one child span per stage.
+
+    The spans are timed with `time.monotonic`, the clock of the event loop, so the queue times of the
+    DiffusionService can be recorded as spans as is. They are converted to unix time when exported.
+    """
+
+    def __init__(self, name: str, trace_id: Optional[str] = None, parent_id: Optional[str] = None) -> None:
+        """
+        Initialize the trace and start its root span.
+
+        Args:
+            name (str): The name of the root span, e.g. the endpoint.
+            trace_id (Optional[str]): The id of the trace, when it continues the trace of the client.
+            parent_id (Optional[str]): The id of the client span the root span belongs to.
+        """
+        self.trace_id = trace_id or secrets.token_hex(16)
+        self.root = Span(name, time.monotonic(), parent_id=parent_id)
+        self.spans: List[Span] = [self.root]
+        # The offset between the monotonic clock and the unix time, for the export
+        self.epoch_offset = time.time() - time.monotonic()
+
+    def add_span(self, name: str, start: float, end: Optional[float] = None, **attributes) -> Span:
+        """Record a stage timed elsewhere, e.g. the queue wait of a request, with monotonic times."""
+        span = Span(name, start, end if end is not None else time.monotonic(), self.root.span_id, **attributes)
+        self.spans.append(span)
+
+        return span
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes):
+        """Time a stage of the request."""
+        span = Span(name, time.monotonic(), parent_id=self.root.span_id, **attributes)
+        self.spans.append(span)
+        try:
+            yield span
+        finally:
+            span.end = time.monotonic()
+
+    def finish(self) -> None:
+        """End the root span, once the response is ready."""
+        if self.root.end is None:
+            self.root.end = time.monotonic()
+
+    def server_timing(self) -> str:
+        """Format the finished stages as a `Server-Timing` header, in milliseconds."""
+        stages = [span for span in self.spans[1:] if span.end is not None]
+        metrics = [f"{span.name};dur={span.duration * 1000:.1f}" for span in stages]
+
+        return ", ".join(metrics + [f"total;dur={self.root.duration * 1000:.1f}"])
+
+    def to_otlp(self, service_name: str) -> dict:
+        """Export the trace in the OTLP JSON format, readable by the OpenTelemetry collector file receiver."""
+
+        def unix_nano(timestamp: float) -> str:
+            return str(int((timestamp + self.epoch_offset) * 1e9))
+
+        def attribute(key: str, value) -> dict:
+            if isinstance(value, bool):
+                return {"key": key, "value": {"boolValue": value}}
+            if isinstance(value, int):
+                return {"key": key, "value": {"intValue": str(value)}}
+            if isinstance(value, float):
+                return {"key": key, "value": {"doubleValue": value}}
+            return {"key": key, "value": {"stringValue": str(value)}}
+
+        spans = [
+            {
+                "traceId": self.trace_id,
+                "spanId": span.span_id,
+                **({"parentSpanId": span.parent_id} if span.parent_id else {}),
+                "name": span.name,
+                # SPAN_KIND_SERVER for the request, SPAN_KIND_INTERNAL for its stages
+                "kind": 2 if span is self.root else 1,
+                "startTimeUnixNano": unix_nano(span.start),
+                "endTimeUnixNano": unix_nano(span.end if span.end is not None else time.monotonic()),
+                "attributes": [attribute(key, value) for key, value in span.attributes.items() if value is not None],
+            }
+            for span in self.spans
+        ]
+
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {"attributes": [attribute("service.name", service_name)]},
+                    "scopeSpans": [{"scope": {"name": "picaisso"}, "spans": spans}],
+                }
+            ]
+        }
+
+
+def trace_span(trace: Optional[Trace], name: str, **attributes) -> ContextManager:
+    """Time a stage of a request if it is traced, do nothing otherwise."""
+    if trace is None:
+        return contextlib.nullcontext()
+
+    return trace.span(name, **attributes)
+
+
+class Tracer:
+    """
+    Starts the traces of the sampled requests and exports them.
+
+    A request is traced with a probability of `sample_rate`, unless its client sent a W3C `traceparent`
+    header: the trace then continues the one of the client, and follows its sampling decision. The
+    requests which aren't sampled get no trace at all, so they pay nothing.
+    """
+
+    def __init__(self, sample_rate: float = 1.0, export_path: Optional[str] = None, service_name: str = "picaisso"):
+        """
+        Initialize the tracer.
+
+        Args:
+            sample_rate (float): The fraction of the requests traced, between 0 and 1.
+            export_path (Optional[str]): The file the traces are appended to, one OTLP JSON document per line.
+                Defaults to no export, the traces are only returned in the `Server-Timing` header.
+            service_name (str): The service name of the exported spans.
+        """
+        self.sample_rate = sample_rate
+        self.export_path = export_path
+        self.service_name = service_name
+        self.exported = 0
+        # The traces are exported from the background tasks threads
+        self.lock = threading.Lock()
+
+    def start(self, name: str, traceparent: Optional[str] = None) -> Optional[Trace]:
+        """
+        Start the trace of a request, if it is sampled.
+
+        Args:
+            name (str): The name of the root span.
+            traceparent (Optional[str]): The `traceparent` header of the request, if any.
+
+        Returns:
+            Optional[Trace]: The trace, or None if the request isn't sampled.
+        """
+        match = TRACEPARENT_PATTERN.match(traceparent.strip().lower()) if traceparent else None
+        if match is not None:
+            trace_id, parent_id, flags = match.groups()
+            if not int(flags, 16) & 1:
+                return None
+
+            return Trace(name, trace_id=trace_id, parent_id=parent_id)
+
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+
+        return Trace(name)
+
+    def export(self, trace: Trace) -> None:
+        """Append a finished trace to the export file. Failures are logged, not raised."""
+        if self.export_path is None:
+            return
+
+        line = json.dumps(trace.to_otlp(self.service_name))
+        try:
+            with self.lock, open(self.export_path, "a") as file:
+                file.write(line + "\n")
+            self.exported += 1
+        except OSError as e:
+            logger.warning(f"Could not export the trace {trace.trace_id}: {e}")
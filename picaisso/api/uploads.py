@@ -0,0 +1,253 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import asyncio
+import contextlib
+import json
+import os
+import random
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from aiobotocore.config import AioConfig
+from aiobotocore.session import get_session
+from loguru import logger
+from metrics import UPLOAD_TIME, UPLOADS
+
+
+class UploadQueue:
+    """
+    Uploads the generated images to S3 in the background, through a spool directory.
+
+    An image is written to the spool directory before it is queued, and removed once uploaded, so the
+    pending uploads survive a restart: they are queued again by `start`. The uploads share one S3 client,
+    with one connection per concurrent upload, and at most `concurrency` of them run at once. A failed
+    upload is retried with an exponential backoff, then moved to the `failed` subdirectory of the spool,
+    where it can be inspected and moved back by hand.
+
+    Only the concurrency is bounded. The queue of the pending uploads isn't: while the storage is slow or down,
+    every generated image is still accepted, and the spool directory grows on disk, with one id per image queued
+    in memory. The backlog is reported by `stats`, as the number of pending uploads and the age of the oldest one.
+    """
+
+    def __init__(
+        self,
+        bucket_name: str,
+        region_name: str,
+        access_key_id: str,
+        secret_access_key: str,
+        spool_path: str = "uploads",
+        endpoint_url: Optional[str] = None,
+        concurrency: int = 4,
+        max_retries: int = 5,
+        backoff: float = 1.0,
+        max_backoff: float = 60.0,
+    ) -> None:
+        """
+        Initialize the queue. The S3 client and the upload tasks are started by `start`.
+
+        Args:
+            bucket_name (str): The bucket the images are uploaded to.
+            region_name (str): The region of the bucket.
+            access_key_id (str): The access key id of the bucket.
+            secret_access_key (str): The secret access key of the bucket.
+            spool_path (str): The directory the pending uploads are written to.
+            endpoint_url (Optional[str]): The S3 endpoint, e.g. a local MinIO or moto server. Defaults to AWS.
+            concurrency (int): The maximum number of uploads running at once.
+            max_retries (int): The number of retries of a failed upload before it is given up.
+            backoff (float): The delay before the first retry, in seconds, doubled at each retry.
+            max_backoff (float): The maximum delay between two retries, in seconds.
+        """
+        self.bucket_name = bucket_name
+        self.client_options = {
+            "region_name": region_name,
+            "aws_access_key_id": access_key_id,
+            "aws_secret_access_key": secret_access_key,
+            "endpoint_url": endpoint_url,
+        }
+        self.spool_path = spool_path
+        self.failed_path = os.path.join(spool_path, "failed")
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.client = None
+        self.exit_stack: Optional[contextlib.AsyncExitStack] = None
+        self.queue: Optional[asyncio.Queue] = None
+        self.tasks: List[asyncio.Task] = []
+        # Upload id -> time it was spooled, for the upload lag
+        self.pending: Dict[str, float] = {}
+        self.upload_stats = {"uploaded": 0, "retries": 0, "failed": 0, "lag_seconds": 0.0}
+
+    def spool_files(self, upload_id: str, directory: Optional[str] = None):
+        """Return the data and metadata files of an upload."""
+        base = os.path.join(directory or self.spool_path, upload_id)
+
+        return f"{base}.data", f"{base}.json"
+
+    def write_spool(self, upload_id: str, body: bytes, metadata: dict) -> None:
+        """Write an upload to the spool directory. The metadata file is written last, it marks a complete upload."""
+        data_file, metadata_file = self.spool_files(upload_id)
+        for path, content in ((data_file, body), (metadata_file, json.dumps(metadata).encode())):
+            with open(f"{path}.tmp", "wb") as file:
+                file.write(content)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(f"{path}.tmp", path)
+
+    def read_spool(self, upload_id: str):
+        """Read the data and metadata of a spooled upload."""
+        data_file, metadata_file = self.spool_files(upload_id)
+        with open(metadata_file) as file:
+            metadata = json.load(file)
+        with open(data_file, "rb") as file:
+            return file.read(), metadata
+
+    def recover_spool(self) -> List[Tuple[float, str]]:
+        """Return the complete uploads left in the spool directory, as (time spooled, id), oldest first."""
+        os.makedirs(self.failed_path, exist_ok=True)
+
+        uploads, names = [], set(os.listdir(self.spool_path))
+        for name in names:
+            path = os.path.join(self.spool_path, name)
+            upload_id, extension = os.path.splitext(name)
+            if extension == ".json":
+                with open(path) as file:
+                    uploads.append((json.load(file)["created"], upload_id))
+            elif extension == ".tmp" or (extension == ".data" and f"{upload_id}.json" not in names):
+                # Interrupted while being spooled, the request never got its upload queued
+                os.remove(path)
+
+        return sorted(uploads)
+
+    async def start(self) -> None:
+        """Open the S3 client, queue the uploads left by the previous run and start the upload tasks."""
+        loop = asyncio.get_event_loop()
+        self.exit_stack = contextlib.AsyncExitStack()
+        self.client = await self.exit_stack.enter_async_context(
+            get_session().create_client(
+                "s3", config=AioConfig(max_pool_connections=self.concurrency), **self.client_options
+            )
+        )
+
+        # Unbounded, the images are spooled on disk and only their ids are queued
+        self.queue = asyncio.Queue()
+        recovered = await loop.run_in_executor(None, self.recover_spool)
+        for created, upload_id in recovered:
+            self.pending[upload_id] = created
+            self.queue.put_nowait(upload_id)
+        if recovered:
+            logger.info(f"Resuming {len(recovered)} pending uploads")
+
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.concurrency)]
+
+    async def stop(self) -> None:
+        """Stop the upload tasks and close the S3 client. The pending uploads stay in the spool directory."""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+        if self.exit_stack is not None:
+            await self.exit_stack.aclose()
+            self.client = self.exit_stack = None
+
+    async def enqueue(self, body: bytes, key: str, content_type: str) -> str:
+        """
+        Spool an image and queue its upload.
+
+        Args:
+            body (bytes): The image bytes.
+            key (str): The key of the image in the bucket.
+            content_type (str): The media type of the image.
+
+        Returns:
+            str: The id of the upload.
+        """
+        upload_id = uuid.uuid4().hex
+        metadata = {"key": key, "content_type": content_type, "created": time.time(), "attempts": 0}
+        await asyncio.get_event_loop().run_in_executor(None, self.write_spool, upload_id, body, metadata)
+
+        self.pending[upload_id] = metadata["created"]
+        self.queue.put_nowait(upload_id)
+
+        return upload_id
+
+    async def worker(self) -> None:
+        """Upload the queued images, one at a time."""
+        while True:
+            upload_id = await self.queue.get()
+            try:
+                await self.upload(upload_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # The spool files are unreadable, the upload can't be retried.
+                self.pending.pop(upload_id, None)
+                logger.error(f"Upload {upload_id} failed: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def upload(self, upload_id: str) -> None:
+        """Upload a spooled image, then remove it from the spool, or schedule its retry."""
+        loop = asyncio.get_event_loop()
+        body, metadata = await loop.run_in_executor(None, self.read_spool, upload_id)
+
+        try:
+            await self.client.put_object(
+                Bucket=self.bucket_name, Key=metadata["key"], Body=body, ContentType=metadata["content_type"]
+            )
+        except Exception as e:
+            metadata["attempts"] += 1
+            if metadata["attempts"] > self.max_retries:
+                await loop.run_in_executor(None, self.give_up, upload_id)
+                self.pending.pop(upload_id, None)
+                self.upload_stats["failed"] += 1
+                UPLOADS.labels("failed").inc()
+                logger.error(f"Giving up the upload of {metadata['key']} after {self.max_retries} retries: {e}")
+                return
+
+            await loop.run_in_executor(None, self.write_spool, upload_id, body, metadata)
+            delay = min(self.backoff * 2 ** (metadata["attempts"] - 1), self.max_backoff)
+            # Full jitter, so the retries of an outage don't all hit the storage at once
+            loop.call_later(random.uniform(0, delay), self.queue.put_nowait, upload_id)
+            self.upload_stats["retries"] += 1
+            UPLOADS.labels("retried").inc()
+            logger.warning(f"Upload of {metadata['key']} failed, retry {metadata['attempts']} in up to {delay:.0f}s")
+            return
+
+        await loop.run_in_executor(None, self.remove_spool, upload_id)
+        lag = time.time() - self.pending.pop(upload_id, metadata["created"])
+        self.upload_stats["uploaded"] += 1
+        self.upload_stats["lag_seconds"] += lag
+        UPLOADS.labels("uploaded").inc()
+        UPLOAD_TIME.observe(lag)
+
+    def remove_spool(self, upload_id: str) -> None:
+        """Remove an uploaded image from the spool."""
+        for path in self.spool_files(upload_id):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+    def give_up(self, upload_id: str) -> None:
+        """Move an upload which kept failing to the `failed` subdirectory of the spool."""
+        for path, failed in zip(self.spool_files(upload_id), self.spool_files(upload_id, self.failed_path)):
+            os.replace(path, failed)
+
+    def oldest_pending(self) -> Optional[float]:
+        """The age of the oldest pending upload, in seconds, the current upload lag."""
+        return time.time() - min(self.pending.values()) if self.pending else None
+
+    def stats(self) -> dict:
+        """Export the number of pending, uploaded and failed uploads, and the upload lag."""
+        uploaded = self.upload_stats["uploaded"]
+
+        return {
+            "pending": len(self.pending),
+            "uploaded": uploaded,
+            "retries": self.upload_stats["retries"],
+            "failed": self.upload_stats["failed"],
+            "lag_seconds": self.upload_stats["lag_seconds"] / uploaded if uploaded else None,
+            "oldest_pending_seconds": self.oldest_pending(),
+        }
@@ -1,43 +1,98 @@
 # Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
 
+import asyncio
+import re
 import uuid
+from typing import Awaitable, Optional, TypeVar
 
 import aiohttp
-from aiobotocore.session import get_session
+from encoding import IMAGE_FORMATS
+from fastapi import Request
+from loguru import logger
 from models import ArtCreate
+from tracing import Trace, trace_span
+from uploads import UploadQueue
 
-from config import settings
 
+T = TypeVar("T")
 
-async def upload_image(img_bytes: bytes, data: ArtCreate):
-    session = get_session()
-    async with session.create_client(
-        "s3",
-        region_name=settings.region_name,
-        aws_access_key_id=settings.access_key_id,
-        aws_secret_access_key=settings.secret_access_key,
-    ) as client:
-        img_key = f"{data.author}/{uuid.uuid4()}_{data.prompt}.jpg"
-        await client.put_object(
-            Bucket=settings.bucket_name,
-            Key=img_key,
-            Body=img_bytes,
-            ContentType="image/jpeg",
-        )
 
+class ClientDisconnected(Exception):
+    """Raised when the client disconnected before its request was processed."""
 
-async def download_image(url: str) -> bytes:
+
+def slugify(text: Optional[str], max_length: int = 64) -> str:
+    """Reduce a free text to lowercase letters, digits and dashes, at most `max_length` characters long."""
+    return re.sub(r"[^a-z0-9]+", "-", (text or "").lower()).strip("-")[:max_length].rstrip("-")
+
+
+def image_key(data: ArtCreate, extension: str) -> str:
+    """
+    Return the S3 key of a generated image: `<author>/<uuid>_<prompt>.<extension>`.
+
+    The author and prompt are slugged and truncated, so they can't add prefixes nor exceed the 1024 bytes of a key.
+    The prompt is left out of the images generated from an image only.
+    """
+    name, prompt = str(uuid.uuid4()), slugify(data.prompt)
+    if prompt:
+        name = f"{name}_{prompt}"
+
+    return f"{slugify(data.author) or 'anonymous'}/{name}.{extension}"
+
+
+async def upload_image(
+    uploads: UploadQueue,
+    img_bytes: bytes,
+    data: ArtCreate,
+    image_format: str = "png",
+    trace: Optional[Trace] = None,
+) -> None:
+    """Spool a generated image for its upload to S3, see `uploads.UploadQueue`."""
+    _, media_type, extension = IMAGE_FORMATS[image_format]
+    with trace_span(trace, "upload"):
+        await uploads.enqueue(img_bytes, image_key(data, extension), media_type)
+
+
+async def cancel_on_disconnect(request: Request, awaitable: Awaitable[T], poll_interval: float = 0.5) -> T:
     """
-    Download image from url.
+    Await the given awaitable, cancelling it if the client disconnects in the meantime.
 
     Args:
-        url (str): image url
+        request (Request): The request of the client to watch.
+        awaitable (Awaitable[T]): The work done for the client.
+        poll_interval (float): How often, in seconds, the connection is checked.
 
     Returns:
-        bytes: image bytes
+        T: The result of the awaitable.
+
+    Raises:
+        ClientDisconnected: If the client disconnected before the work was done.
     """
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            image_data = await response.read()
+    task = asyncio.ensure_future(awaitable)
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=poll_interval)
+        if done:
+            return task.result()
+
+        if await request.is_disconnected():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            raise ClientDisconnected("The client disconnected.")
+
 
-    return image_data
+async def notify_webhook(url: str, payload: dict, timeout: float = 10.0) -> None:
+    """
+    Post a JSON payload to a webhook. Failures are logged, not raised.
+
+    Args:
+        url (str): The webhook url.
+        payload (dict): The JSON payload to post.
+        timeout (float): The request timeout, in seconds.
+    """
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+            async with session.post(url, json=payload) as response:
+                if response.status >= 400:
+                    logger.warning(f"Webhook {url} answered with status {response.status}")
+    except Exception as e:
+        logger.warning(f"Webhook {url} failed: {e}")
@@ -0,0 +1,284 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import asyncio
+import itertools
+import multiprocessing
+import queue
+import threading
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import torch
+from loguru import logger
+from PIL import Image
+from pool import PipelineReplica
+
+
+class WorkerCrashed(Exception):
+    """Raised for the batches of an inference worker which died before returning them."""
+
+
+def pixels_to_shared_memory(pixels: np.ndarray) -> dict:
+    """
+    Copy 8 bits pixels, of one image or of a whole batch, into a new shared memory block.
+
+    Args:
+        pixels (np.ndarray): The uint8 pixels to share.
+
+    Returns:
+        dict: The descriptor of the block. The receiving side reads it with `image_from_shared_memory` or
+            `pixels_from_shared_memory`.
+    """
+    block = SharedMemory(create=True, size=max(1, pixels.nbytes))
+    np.ndarray(pixels.shape, dtype=np.uint8, buffer=block.buf)[:] = pixels
+    block.close()
+
+    return {"name": block.name, "shape": pixels.shape}
+
+
+def image_to_shared_memory(image: Image.Image) -> dict:
+    """Copy the pixels of an image into a new shared memory block, see `pixels_to_shared_memory`."""
+    return pixels_to_shared_memory(np.asarray(image.convert("RGB")))
+
+
+def image_from_shared_memory(descriptor: dict, unlink: bool = True) -> Image.Image:
+    """
+    Read an image from a shared memory block.
+
+    Args:
+        descriptor (dict): The descriptor returned by `image_to_shared_memory`.
+        unlink (bool): Free the block once read. The side which frees a block owns it.
+
+    Returns:
+        Image.Image: A copy of the shared image.
+    """
+    block = SharedMemory(name=descriptor["name"])
+    try:
+        array = np.ndarray(descriptor["shape"], dtype=np.uint8, buffer=block.buf).copy()
+    finally:
+        block.close()
+        if unlink:
+            block.unlink()
+
+    return Image.fromarray(array)
+
+
+def pixels_from_shared_memory(descriptor: dict) -> np.ndarray:
+    """
+    Read the pixels of a batch from a shared memory block, then free the block.
+
+    The pixels are copied out of the block once, for the whole batch. The PIL images are left to the encoder.
+
+    Args:
+        descriptor (dict): The descriptor of the (B, H, W, 3) pixels returned by `pixels_to_shared_memory`.
+
+    Returns:
+        np.ndarray: The (B, H, W, 3) uint8 pixels of the batch.
+    """
+    block = SharedMemory(name=descriptor["name"])
+    try:
+        pixels = np.ndarray(descriptor["shape"], dtype=np.uint8, buffer=block.buf).copy()
+    finally:
+        block.close()
+        block.unlink()
+
+    return pixels
+
+
+def release_shared_memory(descriptor: dict) -> None:
+    """Free a shared memory block, if it still exists."""
+    try:
+        block = SharedMemory(name=descriptor["name"])
+    except FileNotFoundError:
+        return
+
+    block.close()
+    block.unlink()
+
+
+def worker_main(load_replica: Callable[[], PipelineReplica], requests, responses) -> None:
+    """
+    Entry point of an inference worker process.
+
+    The worker loads its replica, then runs the batches it receives one at a time. The source images
+    are read from the shared memory blocks of the API process, the pixels of the generated batch are
+    written to a single new block, which the API process frees once read. Only the descriptors of the
+    blocks are pickled.
+
+    Args:
+        load_replica (Callable[[], PipelineReplica]): Loads the pipeline replica of the worker.
+        requests (multiprocessing.Queue): The batches to run, None to stop the worker.
+        responses (multiprocessing.Queue): The results of the batches.
+    """
+    replica = load_replica()
+    responses.put(("ready", None, None))
+
+    while True:
+        message = requests.get()
+        if message is None:
+            break
+
+        batch_id, inputs, parameters, seeds = message
+        try:
+            if "image" in inputs:
+                inputs["image"] = [
+                    image_from_shared_memory(descriptor, unlink=False) for descriptor in inputs["image"]
+                ]
+            generators = [torch.Generator("cpu").manual_seed(seed) for seed in seeds]
+
+            pixels = replica.infer(**inputs, **parameters, generator=generators, num_images_per_prompt=1)
+            responses.put((batch_id, pixels_to_shared_memory(pixels), None))
+
+        except Exception as e:
+            responses.put((batch_id, None, f"{type(e).__name__}: {e}"))
+
+
+class WorkerReplica(PipelineReplica):
+    """
+    Pipeline replica living in a dedicated inference worker process.
+
+    The API process keeps the batching and HTTP work, away from the GIL contention of the pipeline
+    code. Inputs and outputs images move through shared memory blocks, and the results are read
+    back by a listener thread. The worker is watched by `monitor`: when it dies, its pending
+    batches fail with WorkerCrashed and a new worker is started.
+    """
+
+    def __init__(
+        self,
+        device: str,
+        load_replica: Callable[[], PipelineReplica],
+        check_interval: float = 1.0,
+        model: Optional[str] = None,
+    ) -> None:
+        """
+        Initialize the replica. The worker process is started by `start`.
+
+        Args:
+            device (str): The device the worker loads its pipeline on.
+            load_replica (Callable[[], PipelineReplica]): Loads the pipeline replica, in the worker process.
+                It must be picklable, e.g. a functools.partial of a module level function.
+            check_interval (float): The interval, in seconds, between two health checks of the worker.
+            model (Optional[str]): The name of the model loaded by the worker.
+        """
+        super().__init__(pipeline=None, device=device, model=model)
+        self.load_replica = load_replica
+        self.check_interval = check_interval
+        self.context = multiprocessing.get_context("spawn")
+
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.process = None
+        self.requests = None
+        self.generation = 0
+        self.ready = False
+        self.restarts = 0
+        self.batch_ids = itertools.count()
+        self.pending: Dict[int, asyncio.Future] = {}
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Start the worker process and its listener thread."""
+        self.loop = loop
+        self.generation += 1
+        self.ready = False
+        self.requests = self.context.Queue()
+        responses = self.context.Queue()
+
+        self.process = self.context.Process(
+            target=worker_main,
+            args=(self.load_replica, self.requests, responses),
+            name=f"inference-worker-{self.device}",
+            daemon=True,
+        )
+        self.process.start()
+        threading.Thread(target=self.listen, args=(self.generation, responses), daemon=True).start()
+        logger.info(f"Started the inference worker {self.process.pid} on {self.device}")
+
+    def listen(self, generation: int, responses) -> None:
+        """Read the results of the worker, until it is replaced by a new one."""
+        while generation == self.generation:
+            try:
+                batch_id, outputs, error = responses.get(timeout=self.check_interval)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                break
+
+            if batch_id == "ready":
+                self.ready = True
+                logger.info(f"The inference worker on {self.device} is ready")
+                continue
+
+            if error is not None:
+                result = RuntimeError(error)
+            else:
+                # Copying the pixels out of shared memory happens here, off the event loop.
+                try:
+                    result = pixels_from_shared_memory(outputs)
+                except Exception as e:
+                    result = e
+            self.loop.call_soon_threadsafe(self.resolve, batch_id, result)
+
+    def resolve(self, batch_id: int, result) -> None:
+        """Hand the result of a batch over to its waiter."""
+        future = self.pending.pop(batch_id, None)
+        if future is None or future.done():
+            return
+
+        if isinstance(result, Exception):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+    async def submit(self, inputs: dict, parameters: dict, seeds: List[int]) -> np.ndarray:
+        """
+        Run a batch on the worker.
+
+        Args:
+            inputs (dict): The batched inputs of the task.
+            parameters (dict): The parameters of the pipeline.
+            seeds (List[int]): The seed of each request of the batch.
+
+        Returns:
+            np.ndarray: The (B, H, W, 3) uint8 pixels of the generated images.
+
+        Raises:
+            WorkerCrashed: If the worker died while running the batch.
+            RuntimeError: If the pipeline failed.
+        """
+        inputs = dict(inputs)
+        shared = []
+        if "image" in inputs:
+            shared = [image_to_shared_memory(image) for image in inputs["image"]]
+            inputs["image"] = shared
+
+        batch_id = next(self.batch_ids)
+        future = self.loop.create_future()
+        self.pending[batch_id] = future
+        try:
+            self.requests.put((batch_id, inputs, parameters, seeds))
+            return await future
+        finally:
+            self.pending.pop(batch_id, None)
+            for descriptor in shared:
+                release_shared_memory(descriptor)
+
+    async def monitor(self) -> None:
+        """Restart the worker whenever it dies, failing the batches it was running."""
+        while True:
+            await asyncio.sleep(self.check_interval)
+            if self.process.is_alive():
+                continue
+
+            logger.error(
+                f"The inference worker on {self.device} died with exit code {self.process.exitcode}, restarting it"
+            )
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(WorkerCrashed(f"The inference worker on {self.device} died."))
+            self.pending.clear()
+            self.restarts += 1
+            self.start(self.loop)
+
+    def stats(self) -> dict:
+        """Export the replica statistics."""
+        return {**super().stats(), "ready": self.ready, "restarts": self.restarts}
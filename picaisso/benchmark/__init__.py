@@ -0,0 +1 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
@@ -0,0 +1,353 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import argparse
+import asyncio
+import csv
+import itertools
+import json
+import os
+import random
+import secrets
+import socket
+import subprocess
+import sys
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import aiohttp
+from loguru import logger
+
+
+API_DIR = Path(__file__).resolve().parents[1] / "api"
+# The author of every benchmark request, so the queue wait statistics of the server cover all of them.
+AUTHOR = "benchmark"
+
+
+@dataclass
+class RequestRecord:
+    """The outcome of one request of a trace."""
+
+    sent: float
+    latency: float
+    status: int
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Return the q-th percentile (0-100) of some values, None if there are none."""
+    if not values:
+        return None
+
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))
+
+    return ordered[index]
+
+
+def load_trace(path: str) -> List[dict]:
+    """
+    Load a request trace, one JSON object per line.
+
+    Each line holds the arrival time of the request, in seconds from the start of the trace, under
+    `time`, and optionally its `prompt`, `n_steps`, `height` and `width`.
+    """
+    with open(path) as file:
+        trace = [json.loads(line) for line in file if line.strip()]
+
+    return sorted(trace, key=lambda request: request["time"])
+
+
+def poisson_trace(rate: float, duration: float, rng: random.Random) -> List[dict]:
+    """Generate an open-loop trace with Poisson arrivals at `rate` requests per second."""
+    trace, now = [], rng.expovariate(rate)
+    while now < duration:
+        trace.append({"time": now})
+        now += rng.expovariate(rate)
+
+    return trace
+
+
+class Client:
+    """Sends the benchmark requests to the `/generate` endpoint of a running API."""
+
+    def __init__(self, session: aiohttp.ClientSession, url: str, api_prefix: str, steps: Optional[int]) -> None:
+        self.session = session
+        self.url = url.rstrip("/")
+        self.api_prefix = api_prefix
+        self.steps = steps
+        self.headers: Dict[str, str] = {}
+        self.counter = itertools.count()
+
+    async def authenticate(self, username: str, password: str) -> None:
+        """Get an access token for the requests."""
+        async with self.session.post(
+            f"{self.url}{self.api_prefix}/auth", data={"username": username, "password": password}
+        ) as response:
+            response.raise_for_status()
+            token = await response.json()
+
+        self.headers = {"Authorization": f"Bearer {token['access_token']}"}
+
+    async def get(self, path: str) -> dict:
+        """Get a statistics endpoint of the API."""
+        async with self.session.get(f"{self.url}{self.api_prefix}{path}", headers=self.headers) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def generate(self, request: Optional[dict] = None) -> RequestRecord:
+        """
+        Send one generation request and wait for the whole image.
+
+        Every prompt is unique, so the requests are neither coalesced nor served from the result cache.
+        """
+        request = request or {}
+        payload = {
+            "prompt": request.get("prompt", "a benchmark painting") + f" #{next(self.counter)}",
+            "author": AUTHOR,
+            "n_steps": request.get("n_steps", self.steps),
+            "height": request.get("height"),
+            "width": request.get("width"),
+        }
+        payload = {key: value for key, value in payload.items() if value is not None}
+
+        sent = time.perf_counter()
+        try:
+            async with self.session.post(
+                f"{self.url}{self.api_prefix}/generate", json=payload, headers=self.headers
+            ) as response:
+                await response.read()
+                status = response.status
+        except aiohttp.ClientError as e:
+            logger.warning(f"Request failed: {e}")
+            status = 0
+
+        return RequestRecord(sent=sent, latency=time.perf_counter() - sent, status=status)
+
+
+async def run_open_loop(client: Client, trace: List[dict]) -> List[RequestRecord]:
+    """Send the requests of a trace at their arrival times, whether the previous ones finished or not."""
+    start = time.perf_counter()
+
+    async def send_at(request: dict) -> RequestRecord:
+        await asyncio.sleep(max(0.0, start + request["time"] - time.perf_counter()))
+        return await client.generate(request)
+
+    return await asyncio.gather(*[send_at(request) for request in trace])
+
+
+async def run_closed_loop(client: Client, users: int, duration: float, think_time: float) -> List[RequestRecord]:
+    """Let `users` clients send a request, wait for its result and think, again and again for `duration` seconds."""
+    end = time.perf_counter() + duration
+
+    async def user() -> List[RequestRecord]:
+        records = []
+        while time.perf_counter() < end:
+            records.append(await client.generate())
+            await asyncio.sleep(think_time)
+        return records
+
+    return [record for records in await asyncio.gather(*[user() for _ in range(users)]) for record in records]
+
+
+def summarize(records: List[RequestRecord], batching: dict, queue: dict) -> dict:
+    """Compute the metrics of a run from the client records and the server statistics."""
+    succeeded = [record for record in records if record.status == 200]
+    latencies = [record.latency for record in succeeded]
+    wall_time = (
+        max(record.sent + record.latency for record in records) - min(record.sent for record in records)
+        if records
+        else 0.0
+    )
+    waits = queue.get("tenants", {}).get(AUTHOR, {})
+
+    return {
+        "requests": len(records),
+        "succeeded": len(succeeded),
+        "rejected": sum(1 for record in records if record.status == 429),
+        "failed": sum(1 for record in records if record.status not in (200, 429)),
+        "wall_time": wall_time,
+        "throughput": len(succeeded) / wall_time if wall_time else 0.0,
+        "latency_mean": sum(latencies) / len(latencies) if latencies else None,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "batches": batching.get("batches"),
+        "batch_fill_ratio": batching.get("fill_ratio"),
+        "queue_wait_mean": waits.get("mean_wait"),
+        "queue_wait_p50": waits.get("p50_wait"),
+        "queue_wait_p95": waits.get("p95_wait"),
+        "queue_wait_p99": waits.get("p99_wait"),
+    }
+
+
+async def run_benchmark(args: argparse.Namespace, url: str, username: str, password: str) -> dict:
+    """Replay the trace of the benchmark against a running API, and summarize the run."""
+    timeout = aiohttp.ClientTimeout(total=None)
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        client = Client(session, url, args.api_prefix, args.steps)
+        await client.authenticate(username, password)
+
+        if args.mode == "closed":
+            records = await run_closed_loop(client, args.users, args.duration, args.think_time)
+        else:
+            trace = (
+                load_trace(args.trace)
+                if args.trace
+                else poisson_trace(args.rate, args.duration, random.Random(args.seed))
+            )
+            records = await run_open_loop(client, trace)
+
+        batching = await client.get("/stats/batching")
+        queue = await client.get("/stats/queue")
+
+    return summarize(records, batching, queue)
+
+
+def free_port() -> int:
+    """Return a free TCP port of the loopback interface."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_until_ready(url: str, process: subprocess.Popen, timeout: float) -> None:
+    """Poll the readiness probe of a spawned API until its pipelines are loaded."""
+    deadline = time.perf_counter() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.perf_counter() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"The API exited with code {process.returncode} before being ready.")
+            try:
+                async with session.get(f"{url}/health/ready") as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.5)
+
+    raise TimeoutError(f"The API was not ready after {timeout} seconds.")
+
+
+async def run_sweep_point(args: argparse.Namespace, max_batch_size: int, max_wait: float) -> dict:
+    """Start an API with the given batching parameters, benchmark it, then stop it."""
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    username, password = "benchmark", secrets.token_hex(16)
+
+    env = {
+        **os.environ,
+        "USERNAME": username,
+        "PASSWORD": password,
+        "OPENSSL_KEY": secrets.token_hex(32),
+        "API_PREFIX": args.api_prefix,
+        "DEBUG": "false",
+        "BACKEND": args.backend,
+        "DEVICES": args.devices,
+        "MAX_BATCH_SIZE": str(max_batch_size),
+        "MAX_WAIT": str(max_wait),
+        **dict(variable.split("=", 1) for variable in args.env),
+    }
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "main:app",
+            "--host",
+            "127.0.0.1",
+            "--port",
+            str(port),
+            "--log-level",
+            "warning",
+        ],
+        cwd=API_DIR,
+        env=env,
+    )
+
+    try:
+        await wait_until_ready(url, process, args.startup_timeout)
+        return await run_benchmark(args, url, username, password)
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def save_results(results: List[dict], output: str) -> None:
+    """Save the results as JSON, with the benchmark parameters, and as CSV, one row per sweep point."""
+    path = Path(output)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(path.with_suffix(".json"), "w") as file:
+        json.dump(results, file, indent=2)
+
+    with open(path.with_suffix(".csv"), "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=list(results[0]))
+        writer.writeheader()
+        writer.writerows(results)
+
+    logger.info(f"Saved the results to {path.with_suffix('.json')} and {path.with_suffix('.csv')}")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Load test the /generate endpoint. By default, an API is started with the stub backend for each "
+            "combination of --max-batch-sizes and --max-waits. With --url, a running API is benchmarked as is."
+        )
+    )
+    parser.add_argument("--url", help="Benchmark a running API instead of starting one per sweep point.")
+    parser.add_argument("--username", default=os.getenv("USERNAME"), help="The API username, with --url.")
+    parser.add_argument("--password", default=os.getenv("PASSWORD"), help="The API password, with --url.")
+    parser.add_argument("--api-prefix", default="/api/v1")
+    parser.add_argument("--mode", choices=("open", "closed"), default="open", help="The load generation loop.")
+    parser.add_argument("--trace", help="Replay a JSON lines trace of arrival times (open loop).")
+    parser.add_argument("--rate", type=float, default=2.0, help="Poisson arrival rate, in requests per second.")
+    parser.add_argument("--users", type=int, default=8, help="The number of concurrent clients (closed loop).")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Pause between two requests of a client.")
+    parser.add_argument("--duration", type=float, default=30.0, help="The duration of the load, in seconds.")
+    parser.add_argument("--steps", type=int, default=None, help="The number of denoising steps of the requests.")
+    parser.add_argument("--seed", type=int, default=0, help="The seed of the generated traces.")
+    parser.add_argument("--max-batch-sizes", default="1,2,4,8", help="The MAX_BATCH_SIZE values to sweep.")
+    parser.add_argument("--max-waits", default="0.1,0.5", help="The MAX_WAIT values to sweep.")
+    parser.add_argument("--backend", default="stub", help="The inference backend of the started APIs.")
+    parser.add_argument("--devices", default="cpu", help="The devices of the started APIs.")
+    parser.add_argument("--env", action="append", default=[], help="Extra KEY=VALUE settings of the started APIs.")
+    parser.add_argument("--startup-timeout", type=float, default=600.0, help="How long to wait for an API to load.")
+    parser.add_argument(
+        "--output", default="benchmark-results/results", help="The path of the results, without suffix."
+    )
+
+    return parser.parse_args()
+
+
+async def main() -> None:
+    args = parse_args()
+    load = {"mode": args.mode, "rate": args.rate, "users": args.users, "duration": args.duration, "trace": args.trace}
+
+    results = []
+    if args.url:
+        logger.info(f"Benchmarking {args.url}")
+        metrics = await run_benchmark(args, args.url, args.username, args.password)
+        results.append({"url": args.url, **load, **metrics})
+    else:
+        for max_batch_size, max_wait in itertools.product(
+            [int(value) for value in args.max_batch_sizes.split(",")],
+            [float(value) for value in args.max_waits.split(",")],
+        ):
+            logger.info(f"Benchmarking max_batch_size={max_batch_size} max_wait={max_wait}")
+            metrics = await run_sweep_point(args, max_batch_size, max_wait)
+            results.append(
+                {"backend": args.backend, "max_batch_size": max_batch_size, "max_wait": max_wait, **load, **metrics}
+            )
+            logger.info(json.dumps(results[-1]))
+
+    save_results(results, args.output)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
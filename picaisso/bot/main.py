@@ -111,7 +111,7 @@ class OpenjourneyBot(discord.Client):
             async with self.web_client.post(
                 f"{os.getenv('API_URL')}/generate",
                 headers=self.web_client.headers,
-                data=json.dumps({"prompt": prompt, "author": f"discord_{interaction.user}"}),
+                data=json.dumps({"prompt": prompt, "author": f"discord_{interaction.user}", "output_format": "jpeg"}),
             ) as response:
                 # Handle response status
                 if response.status == 200:
@@ -127,9 +127,16 @@ class OpenjourneyBot(discord.Client):
                     await self._authenticate()
                     await self.generate_art(interaction, prompt)
 
+                elif response.status == 429:
+                    retry_after = response.headers.get("Retry-After", "a few")
+                    raise Exception(f"The API is busy, please retry in {retry_after} seconds")
+
                 elif response.status == 500:
                     raise Exception("Internal server error")
 
+                elif response.status == 504:
+                    raise Exception("The API took too long to generate the art, please retry later")
+
         except Exception as e:
             await interaction.edit_original_response(content=f"Something went wrong while generating art: {e}")
 
@@ -0,0 +1,8 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import sys
+from pathlib import Path
+
+
+# The API modules import each other as top level modules, like when the API is started from its directory.
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "picaisso" / "api"))
@@ -0,0 +1,83 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from admission import AdmissionController, AdmissionRejected
+
+
+def test_no_estimate_before_the_first_batch():
+    admission = AdmissionController(max_queue_size=2)
+
+    assert admission.estimate(depth=0, max_batch_size=4, max_wait=0.5, now=0.0) is None
+    assert admission.admit(depth=1, max_batch_size=4, max_wait=0.5, now=0.0, deadline=0.1) == 0.1
+    with pytest.raises(AdmissionRejected):
+        admission.admit(depth=2, max_batch_size=4, max_wait=0.5, now=0.0)
+    assert admission.rejected == 1
+
+
+def test_estimate_counts_the_batches_ahead_on_each_replica():
+    admission = AdmissionController(max_queue_size=100, parallelism=2)
+    admission.batch_finished(2.0)
+    admission.batch_started(now=0.0)
+
+    # The second replica is free: a full batch runs right away.
+    assert admission.estimate(depth=3, max_batch_size=4, max_wait=0.5, now=1.0) == 2.0
+    # The second batch takes the busy replica, free 1s from now, and the third one follows the first.
+    assert admission.estimate(depth=7, max_batch_size=4, max_wait=0.5, now=1.0) == 3.0
+    assert admission.estimate(depth=11, max_batch_size=4, max_wait=0.5, now=1.0) == 4.0
+    # A batch which won't be full waits for the window too.
+    assert admission.estimate(depth=0, max_batch_size=4, max_wait=0.5, now=1.0) == 2.5
+
+
+def test_deadline_rejection():
+    admission = AdmissionController(max_queue_size=100, default_deadline=1.0)
+    admission.batch_finished(2.0)
+
+    with pytest.raises(AdmissionRejected) as error:
+        admission.admit(depth=0, max_batch_size=1, max_wait=0.0, now=0.0)
+    assert error.value.retry_after == 1.0
+    assert admission.admit(depth=0, max_batch_size=1, max_wait=0.0, now=0.0, deadline=5.0) == 5.0
+
+
+def test_failed_batches_free_their_replica():
+    """A failed batch ends without a latency, and doesn't leave its replica busy in the estimate."""
+    pytest.importorskip("torch")
+    from diffusion_service import DiffusionService
+
+    admission = AdmissionController(max_queue_size=100)
+    admission.batch_finished(2.0)
+    pool = SimpleNamespace(release=lambda replica: None)
+
+    async def failing_inference(*args, **kwargs):
+        raise RuntimeError("CUDA error")
+
+    service = DiffusionService.__new__(DiffusionService)
+    service.admission = admission
+    service.registry = SimpleNamespace(pool=lambda model: pool)
+    service.queue_lock = asyncio.Lock()
+    service.schedule_processing_if_needed = lambda: None
+    service.step_callbacks = lambda *args: {}
+    service.inference = failing_inference
+
+    async def run_failing_batches():
+        for _ in range(3):
+            task = {
+                "task": "text_to_image",
+                "model": "model",
+                "prompt": "a cat",
+                "parameters": {},
+                "generator": None,
+                "done_event": asyncio.Event(),
+                "traces": [],
+            }
+            admission.batch_started(now=0.0)
+            await service.process_batch(SimpleNamespace(), [task])
+            assert isinstance(task["result"], ValueError)
+
+    asyncio.run(run_failing_batches())
+
+    assert admission.busy_until == []
+    assert admission.batch_time == 2.0
+    assert admission.estimate(depth=0, max_batch_size=1, max_wait=0.0, now=0.0) == 2.0
@@ -0,0 +1,59 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import itertools
+from types import SimpleNamespace
+
+import pytest
+
+
+pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+
+from backends import derive_pipeline, shares_components  # noqa: E402
+from diffusion_service import DiffusionService  # noqa: E402
+from tasks import TASK_MAPPING  # noqa: E402
+
+
+def test_only_the_compatible_tasks_share_their_components():
+    assert shares_components("text_to_image", "image_to_image")
+    assert shares_components("image_to_image", "text_to_image")
+
+    # Their components have the same names, but the upscaler and the image variation UNets are trained for
+    # their own conditioning: none of these pairs can share.
+    sharing = {("image_to_image", "text_to_image"), ("text_to_image", "image_to_image")}
+    for task, other_task in itertools.permutations(TASK_MAPPING, 2):
+        if (task, other_task) not in sharing:
+            assert not shares_components(task, other_task), (task, other_task)
+
+
+def test_a_pipeline_is_never_derived_without_its_components():
+    text_to_image = SimpleNamespace(
+        components={
+            "vae": object(),
+            "text_encoder": object(),
+            "tokenizer": object(),
+            "unet": object(),
+            "scheduler": object(),
+            "safety_checker": None,
+            "feature_extractor": None,
+            "image_encoder": None,
+        }
+    )
+
+    with pytest.raises(ValueError, match="image_encoder"):
+        derive_pipeline(text_to_image, "image_variation")
+
+
+def test_step_callbacks_follow_the_pipeline_of_the_task():
+    service = DiffusionService.__new__(DiffusionService)
+    service.n_steps = 2
+    service.step_end_callback_tasks = {"text_to_image"}
+    service.legacy_callback_tasks = {"super_resolution"}
+
+    def callbacks(task, progress=None):
+        return service.step_callbacks([{"task": task, "parameters": {}, "progress": progress}])
+
+    assert "callback_on_step_end" in callbacks("text_to_image")
+    # The derived pipeline of another task doesn't take the callbacks of the main one.
+    assert callbacks("image_to_image", progress=object()) == {}
+    assert set(callbacks("super_resolution", progress=object())) == {"callback", "callback_steps"}
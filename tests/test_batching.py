@@ -0,0 +1,78 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import pytest
+from batching import BucketBatcher
+from scheduler import FairScheduler
+
+
+def task(bucket, time=0.0, author="alice"):
+    return {"bucket": bucket, "time": time, "author": author}
+
+
+def test_incompatible_requests_never_share_a_batch():
+    batcher = BucketBatcher(max_wait=1.0)
+    for index in range(3):
+        batcher.push(task(("steps", 50), time=index))
+        batcher.push(task(("steps", 20), time=index))
+
+    first = batcher.pop_batch(4, now=2.0)
+    second = batcher.pop_batch(4, now=2.0)
+
+    assert len({t["bucket"] for t in first}) == 1
+    assert len({t["bucket"] for t in second}) == 1
+    assert {first[0]["bucket"], second[0]["bucket"]} == {("steps", 50), ("steps", 20)}
+    assert len(batcher) == 0 and batcher.buckets == {}
+
+
+def test_full_bucket_is_flushed_first():
+    batcher = BucketBatcher(max_wait=10.0)
+    batcher.push(task("old", time=0.0))
+    for index in range(4):
+        batcher.push(task("full", time=1.0 + index))
+
+    assert batcher.has_full_batch(4)
+    assert [t["bucket"] for t in batcher.pop_batch(4, now=5.0)] == ["full"] * 4
+
+
+def test_overdue_bucket_beats_a_fuller_one():
+    """A request alone in its bucket isn't blocked behind a busier, incompatible bucket."""
+    batcher = BucketBatcher(max_wait=1.0)
+    batcher.push(task("lonely", time=0.0))
+    for index in range(3):
+        batcher.push(task("busy", time=1.5 + index * 0.1))
+
+    assert not batcher.has_full_batch(4)
+    assert batcher.oldest_time() == 0.0
+    assert [t["bucket"] for t in batcher.pop_batch(4, now=2.0)] == ["lonely"]
+
+
+def test_remove_and_shared_stats():
+    batcher = BucketBatcher(scheduler_factory=FairScheduler, max_wait=1.0)
+    pending = task("a", author="alice")
+    batcher.push(pending)
+    batcher.push(task("b", author="bob", time=1.0))
+
+    assert batcher.pending_by_tenant() == {"alice": 1, "bob": 1}
+    assert batcher.remove(pending)
+    assert not batcher.remove(pending)
+    assert "a" not in batcher.buckets
+
+    batcher.pop_batch(4, now=3.0)
+    stats = batcher.stats()
+
+    assert stats["scheduler"] == "FairScheduler"
+    assert stats["tenants"]["bob"]["served"] == 1
+
+
+def test_bucket_key_separates_the_batch_parameters():
+    pytest.importorskip("torch")
+    from diffusion_service import DiffusionService
+
+    service = DiffusionService.__new__(DiffusionService)
+
+    def key(**parameters):
+        return service.bucket_key({"model": "sd", "task": "text_to_image", "parameters": parameters})
+
+    assert key(num_inference_steps=50, height=512) == key(height=512, num_inference_steps=50)
+    assert key(num_inference_steps=50, height=512) != key(num_inference_steps=20, height=512)
+    assert key(guidance_scale=7.5) != key(guidance_scale=9.0)
@@ -0,0 +1,104 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import asyncio
+import threading
+from types import SimpleNamespace
+
+import pytest
+from cache import DiskCache, MemoryCache, ResultCache
+
+
+def test_memory_cache_evicts_the_least_recently_used():
+    cache = MemoryCache(max_bytes=10)
+    cache.put("a", b"12345")
+    cache.put("b", b"12345")
+    cache.get("a")
+    cache.put("c", b"12345")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == b"12345" and cache.get("c") == b"12345"
+    assert (cache.bytes, cache.evictions) == (10, 1)
+
+
+def test_disk_cache_survives_a_restart(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=10)
+    cache.put("a", b"12345")
+    cache.put("b", b"12345")
+    cache.put("c", b"12345")
+
+    restarted = DiskCache(str(tmp_path), max_bytes=10)
+
+    assert restarted.get("a") is None
+    assert restarted.get("c") == b"12345"
+    assert len(restarted) == 2 and restarted.bytes == 10
+
+
+def test_result_cache_reads_and_writes_the_disk_off_the_event_loop(tmp_path):
+    cache = ResultCache(memory_bytes=100, disk_path=str(tmp_path), disk_bytes=100)
+    threads = []
+    for name in ("get", "put"):
+        method = getattr(cache.disk, name)
+
+        def recorded(*args, method=method):
+            threads.append(threading.current_thread().name)
+            return method(*args)
+
+        setattr(cache.disk, name, recorded)
+
+    async def scenario():
+        assert await cache.get("key") is None
+        await cache.put("key", b"image")
+        cache.memory = MemoryCache(max_bytes=100)
+        assert await cache.get("key") == b"image"
+        assert await cache.get("key") == b"image"
+
+    asyncio.run(scenario())
+
+    assert threads and all(name.startswith("result-cache") for name in threads)
+    stats = cache.stats()
+    assert (stats["misses"], stats["disk_hits"], stats["memory_hits"]) == (1, 1, 1)
+
+
+def test_cache_key_covers_the_sampler():
+    pytest.importorskip("torch")
+    from diffusion_service import DiffusionService
+
+    service = DiffusionService.__new__(DiffusionService)
+    service.task, service.model, service.dtype, service.n_steps = "text_to_image", "model", "float16", 50
+    service.backend, service.backend_options, service.batching_mode = "diffusers", None, "static"
+    service.samplers = {"model": {"text_to_image": {"class": "PNDMScheduler", "config": {"steps_offset": 1}}}}
+
+    def key(**kwargs):
+        return service.cache_key(prompt="a cat", seed=1, task="text_to_image", **kwargs)
+
+    reference = key()
+    assert key(num_inference_steps=50) == reference
+    assert key(guidance_scale=9.0) != reference
+
+    service.samplers["model"]["text_to_image"] = {"class": "DDIMScheduler", "config": {"steps_offset": 1}}
+    assert key() != reference
+    service.samplers["model"]["text_to_image"]["class"] = "PNDMScheduler"
+    assert key() == reference
+
+    service.backend = "tiny"
+    assert key() != reference
+    service.backend, service.batching_mode = "diffusers", "continuous"
+    assert key() != reference
+
+
+def test_samplers_are_described_from_the_loaded_pipelines():
+    pytest.importorskip("torch")
+    from diffusers import PNDMScheduler
+    from diffusion_service import DiffusionService
+
+    service = DiffusionService.__new__(DiffusionService)
+    service.task = "text_to_image"
+    replica = SimpleNamespace(pipelines={}, pipeline=SimpleNamespace(scheduler=PNDMScheduler(steps_offset=1)))
+    worker = SimpleNamespace(pipelines={}, pipeline=None)
+
+    sampler = service.describe_samplers(SimpleNamespace(replicas=[replica]))["text_to_image"]
+
+    assert sampler["class"] == "PNDMScheduler"
+    assert sampler["config"]["steps_offset"] == 1
+    assert not any(key.startswith("_") for key in sampler["config"])
+    assert service.describe_samplers(SimpleNamespace(replicas=[worker])) == {"text_to_image": None}
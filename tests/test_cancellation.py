@@ -0,0 +1,70 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import asyncio
+
+import pytest
+
+
+torch = pytest.importorskip("torch")
+schedulers = pytest.importorskip("diffusers.schedulers")
+
+from diffusion_service import DiffusionService  # noqa: E402
+
+
+N_STEPS = 10
+
+
+def make_service() -> DiffusionService:
+    """A service without pipelines, enough to drop tasks from a running batch."""
+    service = DiffusionService.__new__(DiffusionService)
+    service.n_steps = N_STEPS
+    service.cancellation_stats = {"cancelled_queued": 0, "cancelled_running": 0, "gpu_seconds_saved": 0.0}
+
+    return service
+
+
+def denoise(scheduler_class, cancel_at=None):
+    """
+    Run a batch of 3 latents through a real scheduler, with a model output computed row by row.
+
+    When `cancel_at` is set, the second task is cancelled and dropped after this step.
+    """
+    scheduler = scheduler_class()
+    scheduler.set_timesteps(N_STEPS)
+    service = make_service()
+    tasks = [
+        {"parameters": {"num_inference_steps": N_STEPS}, "done_event": asyncio.Event(), "seed": seed}
+        for seed in range(3)
+    ]
+    generators = [torch.Generator().manual_seed(task["seed"]) for task in tasks]
+    latents = torch.randn(3, 4, 8, 8, generator=torch.Generator().manual_seed(0))
+    prompt_embeds = torch.randn(6, 7, 16, generator=torch.Generator().manual_seed(1))
+
+    for step, timestep in enumerate(scheduler.timesteps):
+        model_output = torch.tanh(latents) * 0.5
+        latents = scheduler.step(model_output, timestep, latents).prev_sample
+
+        if step == cancel_at:
+            tasks[1]["cancelled"] = True
+            callback_kwargs = service.drop_cancelled(
+                tasks, {"latents": latents, "prompt_embeds": prompt_embeds}, step, 0.1, scheduler, generators
+            )
+            latents, prompt_embeds = callback_kwargs["latents"], callback_kwargs["prompt_embeds"]
+
+    return latents, prompt_embeds, tasks, generators, service
+
+
+@pytest.mark.parametrize(
+    "scheduler_class",
+    [schedulers.PNDMScheduler, schedulers.DPMSolverMultistepScheduler, schedulers.DDIMScheduler],
+)
+def test_drop_cancelled_with_a_multistep_scheduler(scheduler_class):
+    reference, *_ = denoise(scheduler_class)
+    latents, prompt_embeds, tasks, generators, service = denoise(scheduler_class, cancel_at=3)
+
+    assert latents.shape[0] == 2
+    assert torch.allclose(latents, reference[[0, 2]], atol=1e-5)
+    assert prompt_embeds.shape[0] == 4
+    assert [task["seed"] for task in tasks] == [0, 2]
+    assert [generator.initial_seed() for generator in generators] == [0, 2]
+    assert service.cancellation_stats["cancelled_running"] == 1
@@ -0,0 +1,78 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import asyncio
+
+import pytest
+
+
+pytest.importorskip("torch")
+
+from diffusion_service import DiffusionService  # noqa: E402
+
+
+async def serve(scenario):
+    """Run a scenario against a service on the latency model stub, with its runner started."""
+    service = DiffusionService(
+        "model",
+        "text_to_image",
+        "fp32",
+        n_steps=4,
+        max_batch_size=4,
+        max_wait=0.05,
+        devices=["cpu"],
+        backend="stub",
+        backend_options={"step_time": 0.01, "image_step_time": 0.0},
+    )
+    runner = asyncio.ensure_future(service.runner())
+    await asyncio.sleep(0)
+    try:
+        return service, await scenario(service)
+    finally:
+        runner.cancel()
+
+
+def generate(service, prompt, **kwargs):
+    return asyncio.ensure_future(service.process_input(prompt=prompt, width=64, height=64, **kwargs))
+
+
+def test_identical_seeded_requests_share_one_generation():
+    async def scenario(service):
+        return await asyncio.gather(
+            generate(service, "a cat", seed=1),
+            generate(service, "  A   cat ", seed=1),
+            generate(service, "a cat", seed=2),
+        )
+
+    service, (first, second, other) = asyncio.run(serve(scenario))
+
+    assert first is second
+    assert other is not first
+    assert service.coalescing_stats["coalesced"] == 1
+    assert service.in_flight == {}
+
+
+def test_unseeded_requests_are_never_coalesced():
+    """Sending the same prompt again without a seed is a re-roll, it must give a new image."""
+
+    async def scenario(service):
+        return await asyncio.gather(generate(service, "a cat"), generate(service, "a cat"))
+
+    service, (first, second) = asyncio.run(serve(scenario))
+
+    assert first is not second
+    assert first.info["seed"] != second.info["seed"]
+    assert service.coalescing_stats["coalesced"] == 0
+
+
+def test_a_waiter_giving_up_doesnt_cancel_the_shared_work():
+    async def scenario(service):
+        first, second = generate(service, "a cat", seed=1), generate(service, "a cat", seed=1)
+        await asyncio.sleep(0.01)
+        first.cancel()
+
+        return await second
+
+    service, image = asyncio.run(serve(scenario))
+
+    assert image is not None and image.info["seed"] == 1
+    assert service.cancellation_stats["cancelled_queued"] == 0
@@ -0,0 +1,85 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import numpy as np
+import pytest
+
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+
+from continuous import ContinuousBatchingEngine  # noqa: E402
+from diffusers import AutoencoderKL, DDIMScheduler, UNet2DConditionModel  # noqa: E402
+
+
+def make_engine() -> ContinuousBatchingEngine:
+    """An engine around a tiny random-weights CPU UNet and VAE."""
+    torch.manual_seed(0)
+    unet = UNet2DConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        sample_size=8,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        cross_attention_dim=16,
+    ).eval()
+    vae = AutoencoderKL(
+        block_out_channels=(8, 8),
+        down_block_types=("DownEncoderBlock2D",) * 2,
+        up_block_types=("UpDecoderBlock2D",) * 2,
+        norm_num_groups=8,
+        latent_channels=4,
+    ).eval()
+
+    def encode_prompt(prompts):
+        embeds = torch.stack([torch.full((4, 16), float(len(prompt))) for prompt in prompts]) / 10
+
+        return embeds, torch.zeros_like(embeds)
+
+    return ContinuousBatchingEngine(unet, vae, DDIMScheduler(), encode_prompt, device="cpu")
+
+
+def make_task(prompt, steps, seed=0, **parameters):
+    return {
+        "prompt": prompt,
+        "parameters": {"num_inference_steps": steps, **parameters},
+        "generator": torch.Generator().manual_seed(seed),
+    }
+
+
+def run(engine, arrivals):
+    """Iterate until the engine is empty. `arrivals` maps an iteration to the tasks joining at it."""
+    finished, iteration = {}, 0
+    while len(engine) or iteration <= max(arrivals):
+        for task, image in engine.iterate(arrivals.get(iteration)):
+            finished[task["prompt"]] = (iteration, np.asarray(image, dtype=np.int16))
+        iteration += 1
+
+    return finished
+
+
+def test_requests_join_and_leave_at_step_boundaries():
+    """A late request doesn't wait for the running batch, and leaves as soon as its own steps are done."""
+    finished = run(make_engine(), {0: [make_task("long", 4)], 2: [make_task("short", 1)]})
+
+    assert finished["short"][0] == 2
+    assert finished["long"][0] == 3
+    assert finished["long"][1].shape == (16, 16, 3)
+
+
+def test_output_does_not_depend_on_the_batch():
+    alone = run(make_engine(), {0: [make_task("long", 4)]})
+    shared = run(make_engine(), {0: [make_task("long", 4)], 1: [make_task("other prompt", 3, seed=1)]})
+
+    assert np.abs(alone["long"][1] - shared["long"][1]).max() <= 1
+
+
+def test_resolutions_are_denoised_side_by_side():
+    engine = make_engine()
+    finished = run(engine, {0: [make_task("small", 2), make_task("large", 2, seed=1, height=32, width=32)]})
+
+    assert finished["small"][1].shape == (16, 16, 3)
+    assert finished["large"][1].shape == (32, 32, 3)
+    assert finished["small"][0] == finished["large"][0] == 1
+    assert len(engine) == 0
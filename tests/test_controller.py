@@ -0,0 +1,63 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import pytest
+from controller import AdaptiveBatchController, LatencyEstimate
+
+
+def train(controller, batch_time, interarrival=None, arrivals=50, sizes=(1, 2, 4, 8)):
+    """Feed the controller with regular arrivals and batches taking `batch_time(size)` seconds."""
+    if interarrival is not None:
+        for index in range(arrivals):
+            controller.record_arrival(index * interarrival)
+
+    for _ in range(3):
+        for size in sizes:
+            decision = controller.record_batch(size, batch_time(size))
+
+    return decision
+
+
+def test_latency_estimate():
+    estimate = LatencyEstimate(alpha=0.5)
+    for value in (1.0, 1.0, 1.0):
+        estimate.update(value)
+    assert (estimate.mean, estimate.p95) == (1.0, 1.0)
+
+    estimate.update(3.0)
+    assert estimate.mean == 2.0
+    assert estimate.p95 > estimate.mean
+
+
+def test_quiet_traffic_runs_small_batches_without_waiting():
+    controller = AdaptiveBatchController(max_batch_size=8, max_wait=0.5, latency_target=2.0)
+
+    assert train(controller, lambda size: 0.1 + 0.02 * size) == (1, 0.0)
+
+
+def test_busy_traffic_grows_the_batches():
+    controller = AdaptiveBatchController(max_batch_size=8, max_wait=0.5, latency_target=2.0)
+    batch_size, max_wait = train(controller, lambda size: 0.1 + 0.02 * size, interarrival=0.01)
+
+    assert batch_size == 8
+    assert max_wait == pytest.approx(0.07, abs=1e-6)
+
+
+def test_latency_target_caps_the_batch_size():
+    controller = AdaptiveBatchController(max_batch_size=8, max_wait=0.5, latency_target=1.0)
+    batch_size, max_wait = train(controller, lambda size: 0.1 + 0.2 * size, interarrival=0.01)
+
+    assert batch_size == 4
+    assert max_wait + controller.predict(batch_size)[1] <= 1.0
+
+
+def test_unobserved_sizes_are_interpolated():
+    controller = AdaptiveBatchController(max_batch_size=8, max_wait=0.5, latency_target=2.0)
+    train(controller, lambda size: 0.1 + 0.02 * size, sizes=(1, 8))
+
+    mean, _ = controller.predict(4)
+    state = controller.state()
+
+    assert mean == pytest.approx(0.18)
+    assert state["model"][4]["observations"] == 0
+    assert state["model"][8]["observations"] == 3
+    assert state["max_batch_size"] == controller.batch_size
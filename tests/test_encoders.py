@@ -0,0 +1,67 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+from types import SimpleNamespace
+
+import pytest
+from PIL import Image
+
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+
+from diffusers.image_processor import VaeImageProcessor  # noqa: E402
+from diffusers.models import AutoencoderKL  # noqa: E402
+from encoders import EncoderCache, LatentCache  # noqa: E402
+
+
+def generators(*seeds):
+    return [torch.Generator().manual_seed(seed) for seed in seeds]
+
+
+def test_cached_tensors_have_no_graph():
+    """The cached tensors are detached from the encoder, and don't share the storage of the encoded batch."""
+    layer = torch.nn.Linear(4, 4)
+
+    def encode(items):
+        return layer(torch.stack([torch.full((4,), float(item)) for item in items]))
+
+    cache = EncoderCache(encode, "model", max_bytes=1024 * 1024)
+    encoded = cache.lookup([1, 2, 1], ["a", "b", "a"])
+
+    assert encoded.shape == (3, 4)
+    assert not encoded.requires_grad
+    for identifier in ("a", "b"):
+        tensor = cache.cache.get(cache.key(identifier))
+        assert tensor.grad_fn is None
+        assert tensor.untyped_storage().nbytes() == tensor.element_size() * tensor.nelement()
+
+    torch.testing.assert_close(encoded[0], encoded[2])
+    assert (cache.hits, cache.misses) == (0, 3)
+
+
+def test_latents_are_sampled_with_the_request_generators():
+    """The latents are the ones the image to image pipeline samples from the VAE, with or without a cache hit."""
+    torch.manual_seed(0)
+    vae = AutoencoderKL(block_out_channels=(8,), norm_num_groups=8, latent_channels=4)
+    processor = VaeImageProcessor(vae_scale_factor=1)
+    cache = LatentCache.from_pipeline(
+        SimpleNamespace(vae=vae, image_processor=processor), "model", max_bytes=1024 * 1024, device="cpu"
+    )
+    images = [Image.new("RGB", (16, 16), color) for color in ("red", "blue")]
+
+    latents = cache(images, ["red", "blue"], generators(1, 2))
+    cached = cache(images, ["red", "blue"], generators(1, 2))
+    reseeded = cache(images, ["red", "blue"], generators(3, 4))
+
+    with torch.no_grad():
+        expected = torch.cat(
+            [
+                vae.encode(processor.preprocess(image)).latent_dist.sample(generator)
+                for image, generator in zip(images, generators(1, 2))
+            ]
+        )
+
+    torch.testing.assert_close(latents, expected * vae.config.scaling_factor)
+    torch.testing.assert_close(cached, latents)
+    assert not torch.allclose(reseeded, latents)
+    assert (cache.hits, cache.misses) == (4, 2)
@@ -0,0 +1,60 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+from jobs import Job, JobStore
+
+
+def finished_job(store, size, age=0.0):
+    job = Job("alice")
+    store.add(job)
+    job.finish("succeeded", result=b"x" * size, media_type="image/png")
+    job.finished_time -= age
+    store.finished(job)
+
+    return job
+
+
+def test_job_lifecycle():
+    store = JobStore()
+    job = Job("alice", webhook="http://localhost/hook")
+    store.add(job)
+
+    assert store.get(job.job_id) is job
+    assert not job.done and job.as_dict()["status"] == "pending"
+
+    job.finish("failed", error="Generation failed")
+    store.finished(job)
+
+    assert job.done and job.as_dict()["error"] == "Generation failed"
+    assert store.get("unknown") is None
+    assert store.stats() == {"jobs": 1, "pending": 0, "bytes": 0, "evicted": 0}
+
+
+def test_finished_jobs_expire():
+    store = JobStore(ttl=60.0)
+    expired, kept = finished_job(store, 10, age=61.0), finished_job(store, 10, age=30.0)
+
+    assert store.get(expired.job_id) is None
+    assert store.get(kept.job_id) is kept
+    assert store.stats()["bytes"] == 10 and store.evicted == 1
+
+
+def test_oldest_results_are_evicted_first():
+    store = JobStore(max_bytes=25)
+    first, second = finished_job(store, 10), finished_job(store, 10)
+    third = finished_job(store, 10)
+
+    assert store.get(first.job_id) is None
+    assert store.get(second.job_id) is second and store.get(third.job_id) is third
+    assert store.bytes == 20
+
+
+def test_pending_jobs_are_never_evicted():
+    store = JobStore(max_jobs=2)
+    pending = [Job("alice") for _ in range(3)]
+    for job in pending:
+        store.add(job)
+    done = finished_job(store, 10)
+
+    assert len(store) == 3
+    assert store.get(done.job_id) is None
+    assert all(store.get(job.job_id) is job for job in pending)
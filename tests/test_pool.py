@@ -0,0 +1,70 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import asyncio
+
+import pytest
+
+
+pytest.importorskip("torch")
+
+from diffusion_service import DiffusionService  # noqa: E402
+from pool import PipelineReplica, ReplicaPool  # noqa: E402
+
+
+def test_batches_go_to_the_least_loaded_replica():
+    first, second = PipelineReplica(None, "cpu"), PipelineReplica(None, "cpu")
+    pool = ReplicaPool([first, second], max_running=2)
+
+    assert pool.acquire() is first
+    assert pool.acquire() is second
+    assert pool.acquire() is first and pool.available()
+    assert pool.acquire() is second and not pool.available()
+
+    pool.release(second)
+    assert pool.available() and pool.acquire() is second
+
+
+def test_ties_go_to_the_fastest_replica():
+    slow, fast = PipelineReplica(None, "cpu"), PipelineReplica(None, "cpu")
+    slow.record(batch_size=2, duration=2.0)
+    fast.record(batch_size=4, duration=1.0)
+
+    assert (slow.throughput, fast.throughput) == (1.0, 4.0)
+    assert ReplicaPool([slow, fast]).acquire() is fast
+
+
+def test_a_pool_needs_a_replica():
+    with pytest.raises(ValueError):
+        ReplicaPool([])
+
+
+def test_requests_are_spread_over_the_cpu_replicas():
+    service = DiffusionService(
+        "model",
+        "text_to_image",
+        "fp32",
+        n_steps=4,
+        max_batch_size=1,
+        max_wait=0.0,
+        devices=["cpu", "cpu"],
+        backend="stub",
+        backend_options={"step_time": 0.01, "image_step_time": 0.0},
+    )
+
+    async def scenario():
+        runner = asyncio.ensure_future(service.runner())
+        await asyncio.sleep(0)
+        try:
+            return await asyncio.gather(
+                *(service.process_input(prompt="a cat", width=64, height=64, seed=seed) for seed in range(4))
+            )
+        finally:
+            runner.cancel()
+
+    images = asyncio.run(scenario())
+
+    assert len(images) == 4
+    stats = service.pool.stats()
+    assert sum(replica["images"] for replica in stats) == 4
+    assert all(replica["batches"] > 0 for replica in stats)
+    assert all(replica["running"] == 0 and replica["images_per_second"] > 0 for replica in stats)
@@ -0,0 +1,66 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import asyncio
+import io
+import threading
+
+import numpy as np
+import pytest
+from PIL import Image
+
+
+torch = pytest.importorskip("torch")
+
+from diffusion_service import DiffusionService  # noqa: E402
+from encoding import ImageEncoder  # noqa: E402
+from postprocessing import GeneratedImage, to_pixels  # noqa: E402
+
+
+def test_batch_tensors_become_8_bits_pixels():
+    images = torch.tensor([[[[0.0, 0.5]], [[1.0, 1.2]], [[-0.1, 0.25]]]])
+
+    pixels = to_pixels(images)
+
+    assert pixels.dtype == np.uint8 and pixels.shape == (1, 1, 2, 3)
+    assert pixels[0, 0].tolist() == [[0, 255, 0], [128, 255, 64]]
+    assert to_pixels(torch.full((1, 3, 1, 1), -1.0), signed=True).tolist() == [[[[0, 0, 0]]]]
+
+
+def test_generated_images_stay_pixels_until_they_are_encoded(monkeypatch):
+    service = DiffusionService(
+        "model",
+        "text_to_image",
+        "fp32",
+        n_steps=2,
+        max_batch_size=2,
+        max_wait=0.0,
+        devices=["cpu"],
+        backend="stub",
+        backend_options={"step_time": 0.0, "image_step_time": 0.0},
+    )
+    encoder = ImageEncoder(max_workers=1)
+    built_on = []
+    to_image = GeneratedImage.to_image
+
+    def recorded(image):
+        built_on.append(threading.current_thread().name)
+        return to_image(image)
+
+    monkeypatch.setattr(GeneratedImage, "to_image", recorded)
+
+    async def scenario():
+        runner = asyncio.ensure_future(service.runner())
+        await asyncio.sleep(0)
+        try:
+            result = await service.process_input(prompt="a cat", width=16, height=8, seed=1)
+            return result, await encoder.encode(result, "png")
+        finally:
+            runner.cancel()
+
+    result, png = asyncio.run(scenario())
+
+    assert isinstance(result, GeneratedImage) and result.info["seed"] == 1
+    assert result.pixels.dtype == np.uint8 and result.size == (16, 8)
+    # The PIL image is only built by the encoder, on its own thread.
+    assert len(built_on) == 1 and built_on[0].startswith("image-encoder")
+    assert np.array_equal(np.asarray(Image.open(io.BytesIO(png))), result.pixels)
@@ -0,0 +1,91 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import asyncio
+
+import pytest
+
+
+torch = pytest.importorskip("torch")
+
+from encoders import EncoderCache  # noqa: E402
+from pool import PipelineReplica, ReplicaPool  # noqa: E402
+from registry import ModelRegistry  # noqa: E402
+
+
+class FakePipeline:
+    """A pipeline of 100 float32 weights, recording the devices it is moved to."""
+
+    def __init__(self) -> None:
+        self.components = {"unet": torch.nn.Linear(10, 10, bias=False)}
+        self.devices = []
+
+    def to(self, device: str) -> "FakePipeline":
+        self.devices.append(device)
+        return self
+
+
+def load_pool(name: str) -> ReplicaPool:
+    prompt_cache = EncoderCache(lambda prompts: torch.zeros(len(prompts), 4), name, max_bytes=1024)
+    prompt_cache.lookup(["a cat"], ["a cat"])
+
+    return ReplicaPool([PipelineReplica(FakePipeline(), "cuda:0", prompt_cache=prompt_cache, model=name)])
+
+
+def run(registry, *names):
+    """Acquire then release the models one after the other, like requests would."""
+
+    async def scenario():
+        for name in names:
+            await registry.acquire(name)
+            registry.release(name)
+        # Let the evictions scheduled by the last release run.
+        await asyncio.sleep(0.05)
+
+    asyncio.run(scenario())
+
+
+def test_models_are_loaded_on_demand():
+    registry = ModelRegistry(["a", "b"], load_pool)
+    run(registry, "b")
+
+    assert [entry["state"] for entry in registry.stats()] == ["unloaded", "resident"]
+    assert registry.resident_bytes() == 400
+
+
+def test_offloading_moves_the_least_recently_used_model_to_cpu_and_clears_its_caches():
+    registry = ModelRegistry(["a", "b"], load_pool, max_bytes=400, offload="cpu")
+    run(registry, "a", "b")
+
+    offloaded = registry.entries["a"]
+    replica = offloaded.pool.replicas[0]
+    assert offloaded.state == "offloaded" and registry.entries["b"].state == "resident"
+    assert replica.pipeline.devices == ["cpu"]
+    # The cached embeddings would otherwise keep their device memory, and be mixed with the tensors of the device.
+    assert len(replica.prompt_cache.cache) == 0 and replica.prompt_cache.cache.bytes == 0
+
+    run(registry, "a")
+
+    assert replica.pipeline.devices == ["cpu", "cuda:0"]
+    assert (registry.entries["a"].state, registry.entries["b"].state) == ("resident", "offloaded")
+    assert registry.entries["a"].loads == 2
+
+
+def test_released_models_are_loaded_again():
+    registry = ModelRegistry(["a", "b"], load_pool, max_bytes=400, offload="release")
+    run(registry, "a", "b", "a")
+
+    assert registry.entries["b"].state == "unloaded" and registry.entries["b"].pool is None
+    assert registry.entries["a"].evictions == 1 and registry.entries["a"].loads == 2
+
+
+def test_busy_models_are_never_evicted():
+    registry = ModelRegistry(["a", "b"], load_pool, max_bytes=400)
+
+    async def scenario():
+        await registry.acquire("a")
+        await registry.acquire("b")
+
+    asyncio.run(scenario())
+
+    assert [entry["state"] for entry in registry.stats()] == ["resident", "resident"]
+    assert registry.resident_bytes() == 800
@@ -0,0 +1,78 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import pytest
+from scheduler import FairScheduler, FifoScheduler, get_scheduler
+
+
+def task(author, time=0.0, priority="normal"):
+    return {"author": author, "time": time, "priority": priority}
+
+
+def test_fair_scheduler_serves_every_author_in_turn():
+    """A heavy author can't push the others to the back of the queue."""
+    scheduler = FairScheduler()
+    for index in range(10):
+        scheduler.push(task("spammer", time=index))
+    scheduler.push(task("alice", time=10))
+    scheduler.push(task("bob", time=11))
+
+    batch = scheduler.pop_batch(4, now=20)
+
+    assert sorted(t["author"] for t in batch) == ["alice", "bob", "spammer", "spammer"]
+    assert len(scheduler) == 8
+    assert scheduler.pending_by_tenant() == {"spammer": 8}
+
+
+def test_fair_scheduler_weights():
+    scheduler = FairScheduler(weights={"premium": 3.0})
+    for index in range(8):
+        scheduler.push(task("premium", time=index))
+        scheduler.push(task("free", time=index))
+
+    authors = [t["author"] for t in scheduler.pop_batch(8, now=10)]
+
+    assert authors.count("premium") == 6
+    assert authors.count("free") == 2
+
+
+def test_priority_classes_and_aging():
+    scheduler = FairScheduler(aging_interval=60.0)
+    scheduler.push(task("alice", time=0.0, priority="low"))
+    scheduler.push(task("bob", time=0.0, priority="high"))
+
+    assert scheduler.pop_batch(1, now=1.0)[0]["author"] == "bob"
+
+    scheduler.push(task("bob", time=100.0, priority="normal"))
+    # After two aging intervals, the low priority task of alice is promoted above bob's normal one.
+    assert scheduler.pop_batch(1, now=125.0)[0]["author"] == "alice"
+
+
+def test_aging_is_slow_by_default():
+    scheduler = get_scheduler("fair")
+
+    assert scheduler.effective_priority(task("alice", time=0.0, priority="low"), now=30.0) == 2
+
+
+@pytest.mark.parametrize("options", [{"quantum": 0.0}, {"quantum": -1.0}, {"weights": {"alice": 0.0}}])
+def test_fair_scheduler_rejects_non_positive_credits(options):
+    """A tenant earning no credits would make the selection loop spin forever."""
+    with pytest.raises(ValueError):
+        FairScheduler(**options)
+
+
+def test_remove_and_stats():
+    scheduler = FifoScheduler()
+    first, second = task("alice", time=0.0), task("bob", time=1.0)
+    scheduler.push(first)
+    scheduler.push(second)
+
+    assert scheduler.remove(first)
+    assert not scheduler.remove(first)
+    assert scheduler.oldest_time() == 1.0
+
+    scheduler.pop_batch(2, now=3.0)
+    stats = scheduler.stats()
+
+    assert stats["pending"] == 0
+    assert stats["tenants"]["bob"]["served"] == 1
+    assert stats["tenants"]["bob"]["max_wait"] == 2.0
@@ -0,0 +1,141 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import asyncio
+import contextlib
+import os
+from types import SimpleNamespace
+
+import pytest
+
+
+pytest.importorskip("aiobotocore")
+
+import uploads  # noqa: E402
+from uploads import UploadQueue  # noqa: E402
+
+
+class LocalS3:
+    """A local stand-in for the S3 client, keeping the objects in memory and failing its first `failures` calls."""
+
+    def __init__(self, failures: int = 0) -> None:
+        self.objects = {}
+        self.failures = failures
+        self.calls = 0
+
+    async def put_object(self, Bucket: str, Key: str, Body: bytes, ContentType: str) -> dict:
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise ConnectionError("The storage is down")
+        self.objects[(Bucket, Key)] = (Body, ContentType)
+
+        return {}
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    storage = LocalS3()
+
+    @contextlib.asynccontextmanager
+    async def create_client(service, config=None, **options):
+        yield storage
+
+    monkeypatch.setattr(uploads, "get_session", lambda: SimpleNamespace(create_client=create_client))
+
+    return storage
+
+
+def upload_queue(spool_path, **kwargs) -> UploadQueue:
+    return UploadQueue("bucket", "eu-west-1", "key", "secret", spool_path=str(spool_path), backoff=0.01, **kwargs)
+
+
+async def drain(queue: UploadQueue, timeout: float = 5.0) -> None:
+    """Wait until every pending upload is uploaded or given up."""
+    for _ in range(int(timeout / 0.01)):
+        if not queue.pending:
+            return
+        await asyncio.sleep(0.01)
+    raise TimeoutError("The uploads are still pending")
+
+
+def spooled(spool_path):
+    return sorted(name for name in os.listdir(spool_path) if name != "failed")
+
+
+def test_images_are_uploaded_then_removed_from_the_spool(storage, tmp_path):
+    queue = upload_queue(tmp_path)
+
+    async def scenario():
+        await queue.start()
+        await queue.enqueue(b"image", "art/1.png", "image/png")
+        await drain(queue)
+        await queue.stop()
+
+    asyncio.run(scenario())
+
+    assert storage.objects == {("bucket", "art/1.png"): (b"image", "image/png")}
+    assert spooled(tmp_path) == []
+    assert queue.stats()["uploaded"] == 1 and queue.stats()["pending"] == 0
+
+
+def test_failed_uploads_are_retried(storage, tmp_path):
+    storage.failures = 2
+    queue = upload_queue(tmp_path)
+
+    async def scenario():
+        await queue.start()
+        await queue.enqueue(b"image", "art/1.png", "image/png")
+        await drain(queue)
+        await queue.stop()
+
+    asyncio.run(scenario())
+
+    assert storage.calls == 3 and ("bucket", "art/1.png") in storage.objects
+    assert queue.stats()["retries"] == 2 and queue.stats()["uploaded"] == 1
+
+
+def test_uploads_failing_for_good_are_set_aside(storage, tmp_path):
+    storage.failures = 10
+    queue = upload_queue(tmp_path, max_retries=1)
+
+    async def scenario():
+        await queue.start()
+        upload_id = await queue.enqueue(b"image", "art/1.png", "image/png")
+        await drain(queue)
+        await queue.stop()
+
+        return upload_id
+
+    upload_id = asyncio.run(scenario())
+
+    assert storage.objects == {} and queue.stats()["failed"] == 1
+    assert spooled(tmp_path) == []
+    assert sorted(os.listdir(tmp_path / "failed")) == [f"{upload_id}.data", f"{upload_id}.json"]
+
+
+def test_pending_uploads_survive_a_restart(storage, tmp_path):
+    storage.failures = 10
+    queue = upload_queue(tmp_path, max_retries=100)
+
+    async def interrupted():
+        await queue.start()
+        await queue.enqueue(b"image", "art/1.png", "image/png")
+        await asyncio.sleep(0.05)
+        await queue.stop()
+
+    asyncio.run(interrupted())
+    assert len(spooled(tmp_path)) == 2
+
+    # A spool file left half written by a crash is dropped.
+    (tmp_path / "partial.data.tmp").write_bytes(b"ima")
+    storage.failures = 0
+    restarted = upload_queue(tmp_path)
+
+    async def resumed():
+        await restarted.start()
+        await drain(restarted)
+        await restarted.stop()
+
+    asyncio.run(resumed())
+
+    assert storage.objects == {("bucket", "art/1.png"): (b"image", "image/png")}
+    assert spooled(tmp_path) == []
@@ -0,0 +1,28 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+from types import SimpleNamespace
+
+import pytest
+
+
+pytest.importorskip("aiohttp")
+pytest.importorskip("fastapi")
+
+from utils import image_key  # noqa: E402
+
+
+def test_image_key_is_a_single_short_segment():
+    """The prompt can't add prefixes to the key nor make it exceed the S3 limit."""
+    key = image_key(SimpleNamespace(author="Thomas Chaigneau", prompt="A cat / on the moon, " * 100), "png")
+    author, name = key.split("/")
+
+    assert author == "thomas-chaigneau"
+    assert name.endswith(".png") and "_a-cat-on-the-moon-" in name
+    assert len(key.encode()) < 1024
+
+
+def test_image_key_without_prompt():
+    key = image_key(SimpleNamespace(author="/", prompt=None), "webp")
+
+    assert key.startswith("anonymous/") and "None" not in key
+    assert key.count("_") == 0
@@ -0,0 +1,93 @@
+# Copyright (c) 2023, Thomas Chaigneau. All rights reserved.
+
+import asyncio
+import functools
+import time
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import pytest
+
+
+torch = pytest.importorskip("torch")
+
+from diffusion_service import load_replica  # noqa: E402
+from PIL import Image  # noqa: E402
+from workers import (  # noqa: E402
+    WorkerCrashed,
+    WorkerReplica,
+    image_from_shared_memory,
+    image_to_shared_memory,
+    pixels_from_shared_memory,
+    pixels_to_shared_memory,
+    release_shared_memory,
+)
+
+
+def test_batch_pixels_round_trip_through_shared_memory():
+    pixels = np.random.default_rng(0).integers(0, 256, (2, 8, 16, 3), dtype=np.uint8)
+
+    descriptor = pixels_to_shared_memory(pixels)
+
+    assert np.array_equal(pixels_from_shared_memory(descriptor), pixels)
+    # The reading side owns the block of the batch, and frees it.
+    with pytest.raises(FileNotFoundError):
+        SharedMemory(name=descriptor["name"])
+
+
+def test_source_images_are_freed_by_their_owner():
+    image = Image.new("RGB", (4, 2), (10, 20, 30))
+
+    descriptor = image_to_shared_memory(image)
+    copy = image_from_shared_memory(descriptor, unlink=False)
+
+    assert np.array_equal(np.asarray(copy), np.asarray(image))
+    release_shared_memory(descriptor)
+    with pytest.raises(FileNotFoundError):
+        SharedMemory(name=descriptor["name"])
+    # Releasing twice is harmless, e.g. for a batch whose worker died.
+    release_shared_memory(descriptor)
+
+
+def test_a_dead_worker_fails_its_batches_and_is_restarted():
+    loader = functools.partial(
+        load_replica,
+        "text_to_image",
+        "model",
+        torch.float32,
+        "cpu",
+        backend="stub",
+        backend_options={"step_time": 0.5, "image_step_time": 0.0},
+    )
+    replica = WorkerReplica("cpu", loader, check_interval=0.1)
+    parameters = {"num_inference_steps": 2, "width": 8, "height": 8}
+
+    async def wait_until_ready(timeout=120.0):
+        start = time.perf_counter()
+        while not replica.ready:
+            assert time.perf_counter() - start < timeout, "The inference worker didn't start"
+            await asyncio.sleep(0.1)
+
+    async def scenario():
+        replica.start(asyncio.get_running_loop())
+        monitor = asyncio.ensure_future(replica.monitor())
+        try:
+            await wait_until_ready()
+            batch = asyncio.ensure_future(replica.submit({"prompt": ["a cat"]}, parameters, [1]))
+            await asyncio.sleep(0.2)
+            replica.process.kill()
+
+            with pytest.raises(WorkerCrashed):
+                await batch
+
+            await wait_until_ready()
+            return await replica.submit({"prompt": ["a cat", "a dog"]}, parameters, [1, 2])
+        finally:
+            monitor.cancel()
+            replica.requests.put(None)
+
+    pixels = asyncio.run(scenario())
+
+    assert replica.restarts == 1
+    assert pixels.shape == (2, 8, 8, 3) and pixels.dtype == np.uint8
+    assert not np.array_equal(pixels[0], pixels[1])